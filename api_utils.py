@@ -0,0 +1,181 @@
+# Shared helpers for making lots of HTTP API calls
+# Used by gen_student_journeys (Google Directions) and any other script
+# that needs pooled connections, rate limiting and retries
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# base backoff in seconds for each retryable HTTP status code
+# each retry doubles the base, up to max_backoff
+RETRY_STATUSES = {429: 10,
+                  500: 2,
+                  502: 2,
+                  503: 5,
+                  504: 5}
+max_backoff = 120
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket used to cap the number of requests per second.
+
+    Args:
+        rate (float): tokens added per second, i.e. the sustained QPS limit.
+            A rate of None or 0 disables limiting.
+        capacity (float, optional): maximum burst size. Defaults to rate.
+            At least 1, so rates below one per second still get a token.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(1.0, capacity or rate or 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, then consume it.
+        """
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_session(pool_size=10):
+    """
+    Create a requests Session whose connection pool can serve pool_size threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def backoff_delay(status, attempt):
+    """
+    Seconds to wait before retrying a request that failed with `status`.
+    Uses exponential backoff with "equal jitter" so that threads which
+    failed together do not all retry at the same moment.
+
+    Args:
+        status (int or str): HTTP status code, or a name for non-HTTP failures.
+        attempt (int): zero-based retry number.
+
+    Returns:
+        float: seconds to sleep.
+    """
+    base = RETRY_STATUSES.get(status, 1)
+    delay = min(max_backoff, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def api_label(url):
+    """
+    Short name for an endpoint to label its metrics with, e.g. 'directions'
+    for .../maps/api/directions/json or 'isochrone' for .../routers/x/isochrone.
+    """
+    parts = [p for p in urlparse(url).path.split('/') if p and p != 'json']
+    return parts[-1] if parts else urlparse(url).netloc
+
+
+def get_with_retry(url, params=None, headers=None, session=None, bucket=None,
+                   max_retries=5, timeout=60, is_retryable=None, label=None):
+    """
+    GET a URL, retrying on retryable status codes and connection errors.
+
+    Args:
+        url (str): endpoint to call.
+        params (dict, optional): query parameters.
+        headers (dict, optional): request headers.
+        session (requests.Session, optional): session to reuse connections from.
+        bucket (TokenBucket, optional): rate limiter to take a token from
+            before every attempt, including retries.
+        max_retries (int): number of retries after the first attempt.
+        timeout (float): per-request timeout in seconds.
+        is_retryable (function, optional): extra check on a response
+            with a non-retryable status code. Should return a status label
+            to back off on (e.g. Google's 'OVER_QUERY_LIMIT'), or None.
+        label (str, optional): API name for metrics. Defaults to api_label(url).
+            Every attempt's latency and status, and every retry, is recorded.
+
+    Returns:
+        requests.Response: the last response received.
+
+    Raises:
+        requests.RequestException: if the final attempt failed to connect.
+    """
+    getter = session.get if session is not None else requests.get
+    label = label or api_label(url)
+    attempt = 0
+    while True:
+        if bucket is not None:
+            bucket.acquire()
+        start = time.perf_counter()
+        try:
+            r = getter(url, params=params, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.observe(label, time.perf_counter() - start)
+            metrics.inc('requests', api=label, status=type(e).__name__)
+            if attempt >= max_retries:
+                raise
+            status = type(e).__name__
+        else:
+            metrics.observe(label, time.perf_counter() - start)
+            metrics.inc('requests', api=label, status=r.status_code)
+            status = r.status_code if r.status_code in RETRY_STATUSES else None
+            if status is None and is_retryable is not None:
+                status = is_retryable(r)
+            if status is None or attempt >= max_retries:
+                return r
+        print('{} from {}, retrying'.format(status, url))
+        metrics.inc('retries', api=label, reason=status)
+        time.sleep(backoff_delay(status, attempt))
+        attempt += 1
+
+
+def map_ordered(func, items, max_workers=8, max_in_flight=None):
+    """
+    Run func over items in a thread pool, yielding results in input order.
+
+    Only max_in_flight items are submitted at a time, so memory stays
+    bounded no matter how long items is.
+
+    Args:
+        func (function): function to apply to each item.
+        items (iterable): inputs to func.
+        max_workers (int): number of threads.
+        max_in_flight (int, optional): maximum number of submitted but
+            not yet yielded items. Defaults to 4 * max_workers.
+
+    Yields:
+        the result of func(item) for each item, in order.
+    """
+    max_in_flight = max_in_flight or 4 * max_workers
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,417 @@
+# Benchmark the pipeline on a synthetic district
+# Generates schools and students around a city center, serves fake Google
+# Geocoding, Directions and OTP isochrone responses from a local stub server,
+# and times each stage: rows per second, CPU time and peak memory.
+# Results are saved as JSON so runs can be compared over time, e.g.
+#   python benchmark.py --schools 20 --students 20000 --baseline outputs/benchmarks/[earlier].json
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import polyline
+
+# district settings
+n_schools = 10
+n_students = 5000
+sibling_share = 0.1  # share of students who share an address with another student
+center = (39.7684, -86.1581)  # lat, lon the district is built around
+seed = 0
+
+# stub server settings
+stub_latency = 0.0  # seconds each fake API response takes
+workers = 16
+qps = 10000  # rate limit passed to the API stages; high so the stub is the limit
+
+benchmark_dir = 'outputs/benchmarks'
+streets = ['MAIN', 'OAK', 'MERIDIAN', 'WASHINGTON', 'MARKET', 'OHIO', 'NEW YORK',
+           'VERMONT', 'MICHIGAN', 'ILLINOIS', 'DELAWARE', 'ALABAMA']
+
+
+def make_district(schools=n_schools, students=n_students, seed=seed):
+    """
+    Generate a synthetic district.
+
+    Returns:
+        tuple:
+            pandas DataFrame: schools, with the columns geocode_and_prep writes.
+            pandas DataFrame: students, with stu_sch_code and home_address.
+            dict: address -> (lat, lon) for the stub geocoder.
+    """
+    rng = np.random.default_rng(seed)
+    locations = {}
+
+    def address(i, lat, lon, zip_code):
+        addy = '{} {} ST, Indianapolis, IN {}'.format(100 + i, streets[i % len(streets)], zip_code)
+        locations[addy] = (round(float(lat), 6), round(float(lon), 6))
+        return addy
+
+    school_lat = center[0] + rng.normal(0, 0.08, schools)
+    school_lon = center[1] + rng.normal(0, 0.08, schools)
+    codes = ['{:03d}'.format(i + 100) for i in range(schools)]
+    school_df = pd.DataFrame({
+        'school_code': codes,
+        'school_name': ['SCHOOL {}'.format(i) for i in range(schools)],
+        'address': [address(i, lat, lon, 46200 + i % 50)
+                    for i, (lat, lon) in enumerate(zip(school_lat, school_lon))],
+        'am_latest_arr': rng.choice(['7:20 AM', '8:00 AM', '9:05 AM'], schools),
+        'pm_earliest_dep': rng.choice(['2:20 PM', '3:00 PM', '4:05 PM'], schools),
+        'tz': 'EDT'})
+
+    school_idx = rng.integers(0, schools, students)
+    lat = school_lat[school_idx] + rng.normal(0, 0.04, students)
+    lon = school_lon[school_idx] + rng.normal(0, 0.04, students)
+    homes = [address(1000 + i, lat[i], lon[i], 46200 + i % 50) for i in range(students)]
+    # siblings share an address
+    n_siblings = int(students * sibling_share)
+    if n_siblings:
+        homes_arr = np.array(homes, dtype=object)
+        homes_arr[rng.choice(students, n_siblings, replace=False)] = \
+            homes_arr[rng.choice(students, n_siblings)]
+        homes = list(homes_arr)
+    student_df = pd.DataFrame({'stu_sch_code': np.array(codes)[school_idx],
+                               'sch_name': school_df['school_name'].to_numpy()[school_idx],
+                               'home_address': homes})
+    return school_df, student_df, locations
+
+
+def fake_geocode(locations, address):
+    if address in locations:
+        lat, lon = locations[address]
+    else:
+        digest = int(hashlib.md5(address.encode('utf-8')).hexdigest()[:8], 16)
+        lat = center[0] + (digest % 1000 - 500) / 5000
+        lon = center[1] + (digest // 1000 % 1000 - 500) / 5000
+    return {'results': [{'formatted_address': address,
+                         'geometry': {'location': {'lat': lat, 'lng': lon},
+                                      'location_type': 'ROOFTOP'}}],
+            'status': 'OK'}
+
+
+def fake_directions(locations, params):
+    """
+    A transit Directions response shaped like Google's: a walk to a stop,
+    one or two transit legs and a walk to the destination.
+    """
+    origin = fake_geocode(locations, params['origin'])['results'][0]['geometry']['location']
+    dest = fake_geocode(locations, params['destination'])['results'][0]['geometry']['location']
+    rnd = random.Random(params['origin'] + params['destination'])
+    n_points = rnd.randint(20, 120)
+    t = np.linspace(0, 1, n_points)
+    lats = origin['lat'] + (dest['lat'] - origin['lat']) * t + np.sin(t * 9) * 0.002
+    lons = origin['lng'] + (dest['lng'] - origin['lng']) * t
+    meters = int(111000 * np.hypot(dest['lat'] - origin['lat'], dest['lng'] - origin['lng'])) + 500
+    steps = [{'travel_mode': 'WALKING', 'duration': {'value': 420}, 'distance': {'value': 500}}]
+    for i in range(rnd.randint(1, 2)):
+        steps.append({'travel_mode': 'TRANSIT',
+                      'duration': {'value': meters // 8},
+                      'distance': {'value': meters},
+                      'transit_details': {'departure_stop': {'name': 'STOP {}'.format(rnd.randint(1, 900))},
+                                          'arrival_stop': {'name': 'STOP {}'.format(rnd.randint(1, 900))},
+                                          'line': {'name': 'Route {}'.format(i), 'short_name': str(rnd.randint(1, 40))}}})
+    steps.append({'travel_mode': 'WALKING', 'duration': {'value': 300}, 'distance': {'value': 350}})
+    duration = sum(s['duration']['value'] for s in steps)
+    leg = {'start_address': params['origin'], 'start_location': origin,
+           'end_address': params['destination'], 'end_location': dest,
+           'departure_time': {'text': '6:40am'}, 'arrival_time': {'text': '7:15am'},
+           'duration': {'value': duration},
+           'distance': {'value': sum(s['distance']['value'] for s in steps)},
+           'steps': steps}
+    return {'geocoded_waypoints': [{'geocoder_status': 'OK'}, {'geocoder_status': 'OK'}],
+            'routes': [{'legs': [leg],
+                        'overview_polyline': {'points': polyline.encode(list(zip(lats, lons)))}}],
+            'status': 'OK'}
+
+
+def fake_isochrones(params):
+    lat, lon = map(float, params['fromPlace'].split(','))
+    features = []
+    for cutoff in params.get('cutoffSec', ['1800']):
+        radius = int(cutoff) / 1800 * 0.03
+        angles = np.linspace(0, 2 * np.pi, 64)
+        ring = [[lon + radius * np.cos(a), lat + radius * np.sin(a)] for a in angles]
+        ring.append(ring[0])
+        features.append({'type': 'Feature', 'properties': {'time': int(cutoff)},
+                         'geometry': {'type': 'MultiPolygon', 'coordinates': [[ring]]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def start_stub(locations, latency=stub_latency):
+    """
+    Serve fake API responses on a free local port.
+
+    Returns:
+        tuple: (server, base url, dict counting requests per endpoint)
+    """
+    counts = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v if len(v) > 1 else v[0] for k, v in parse_qs(url.query).items()}
+            if url.path.endswith('/geocode/json'):
+                kind, body = 'geocode', fake_geocode(locations, params['address'])
+            elif url.path.endswith('/directions/json'):
+                kind, body = 'directions', fake_directions(locations, params)
+            elif url.path.endswith('/isochrone'):
+                params['cutoffSec'] = parse_qs(url.query).get('cutoffSec', [])
+                kind, body = 'isochrone', fake_isochrones(params)
+            else:
+                kind, body = 'router', {'routerId': 'bench', 'buildTime': 0}
+            with lock:
+                counts[kind] = counts.get(kind, 0) + 1
+            if latency:
+                time.sleep(latency)
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port), counts
+
+
+def current_rss():
+    """
+    Resident memory of this process in bytes, or None if it can't be read.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class Stage:
+    """
+    Time a pipeline stage: wall time, CPU time and peak RSS, sampled every
+    few milliseconds in a background thread. Falls back to the process-wide
+    peak from getrusage where /proc is not available.
+    """
+    def __init__(self, name, rows, results, quiet=True, interval=0.005):
+        self.name = name
+        self.rows = rows
+        self.results = results
+        self.quiet = quiet
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, current_rss() or 0)
+
+    def __enter__(self):
+        print('Running {}...'.format(self.name))
+        self.peak = current_rss() or 0
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        self.redirect = contextlib.redirect_stdout(io.StringIO()) if self.quiet \
+            else contextlib.nullcontext()
+        self.redirect.__enter__()
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        self.redirect.__exit__(*exc)
+        self.done.set()
+        self.sampler.join()
+        peak = self.peak or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        result = {'stage': self.name,
+                  'rows': self.rows,
+                  'seconds': round(seconds, 3),
+                  'cpu_seconds': round(cpu, 3),
+                  'rows_per_second': round(self.rows / seconds, 1) if seconds else None,
+                  'peak_rss_mb': round(peak / 2 ** 20, 1)}
+        if exc[0] is None:
+            self.results.append(result)
+            print('  {rows} rows in {seconds}s ({rows_per_second} rows/s), '
+                  'peak RSS {peak_rss_mb} MB'.format(**result))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def run_benchmark(schools=n_schools, students=n_students, latency=stub_latency,
+                  work_dir=None, quiet=True):
+    """
+    Run every benchmarked stage on a synthetic district.
+
+    The pipeline scripts read config.ini and write to relative paths when
+    imported, so everything runs inside a temporary working directory
+    with a dummy config.ini.
+
+    Args:
+        schools (int): number of schools.
+        students (int): number of students.
+        latency (float): seconds each stub API response takes.
+        work_dir (str, optional): folder to run in. Defaults to a new
+            temporary folder, which is removed afterwards.
+        quiet (bool): hide the scripts' per-row progress output.
+
+    Returns:
+        dict: benchmark settings, environment and per-stage results.
+    """
+    school_df, student_df, locations = make_district(schools, students)
+    server, stub_url, counts = start_stub(locations, latency)
+    home = os.getcwd()
+    tmp = work_dir or tempfile.mkdtemp(prefix='benchmark_')
+    os.makedirs(os.path.join(tmp, 'district'), exist_ok=True)
+    os.makedirs(os.path.join(tmp, 'outputs'), exist_ok=True)
+    with open(os.path.join(tmp, 'config.ini'), 'w') as f:
+        f.write('[auth]\ngkey = benchmark\ngkey2 = benchmark\n')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tmp)
+    results = []
+    try:
+        # imported here, after config.ini exists in the working directory
+        import convert_geojson_to_kml
+        import create_od_records
+        import gen_student_journeys
+        import gen_transit_isochrones
+        import geocode_and_prep
+        import journey_store
+        import postprocess_journeys
+
+        geocode_and_prep.g_api = stub_url + '/maps/api/geocode/json'
+        directions_api = stub_url + '/maps/api/directions/json'
+        gen_transit_isochrones.otp_url = stub_url
+
+        with Stage('geocode schools', len(school_df), results, quiet):
+            schools_geo = geocode_and_prep.batch_geocode(school_df, 'address',
+                                                         workers=workers, qps=qps)
+        with Stage('batch_geocode', len(student_df), results, quiet):
+            students_geo = geocode_and_prep.batch_geocode(student_df, 'home_address',
+                                                          workers=workers, qps=qps)
+
+        schools_geo.to_csv('schools.csv', index=False)
+        for code, df in students_geo.groupby('stu_sch_code'):
+            df.to_csv(os.path.join('district', '{}_school_geocoded_students.csv'.format(code)),
+                      index=False)
+        create_od_records.school_data_path = 'schools.csv'
+        with Stage('batch_combine', len(student_df), results, quiet):
+            create_od_records.batch_combine('district', incremental=False)
+
+        with Stage('read od', len(student_df), results, quiet):
+            od = pd.concat([gen_student_journeys.read_od(path) for path in
+                            create_od_records.find_od_files('district').values()],
+                           ignore_index=True)
+        with Stage('batch_process', len(od), results, quiet):
+            responses = gen_student_journeys.batch_process(od, 'am', workers=workers, qps=qps,
+                                                           api=directions_api)
+
+        journey_path = os.path.join('outputs', 'bench_am_journeys.jsonl')
+        with journey_store.JourneyWriter(journey_path) as writer:
+            for idx, response in zip(od.index, responses):
+                writer.write(int(idx), response)
+        del responses
+        with Stage('gen_json', len(od), results, quiet):
+            postprocess_journeys.gen_json(journey_path,
+                                          os.path.join('outputs', 'bench_am_journey_attributes.json'),
+                                          write_file=True)
+        geojson_path = os.path.join('outputs', 'bench_am_journeys.geojson')
+        with Stage('gen_geojson', len(od), results, quiet):
+            postprocess_journeys.convert_to_geojson(journey_path, geojson_path)
+
+        with Stage('convert_geojson_to_kml', len(od), results, quiet):
+            convert_geojson_to_kml.write_kml([(('am_journeys',), geojson_path)],
+                                             geojson_path[:-len('.geojson')] + '.kmz')
+
+        locations_path = 'isochrone_schools.csv'
+        schools_geo.rename(columns={'lat': 'school_lat', 'lon': 'school_lon'}) \
+                   .to_csv(locations_path, index=False)
+        with Stage('isochrones', 2 * len(school_df), results, quiet):
+            gen_transit_isochrones.batch_process(locations_path, 'bench', use_cache=False)
+    finally:
+        os.chdir(home)
+        server.shutdown()
+        if work_dir is None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    return {'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'settings': {'schools': schools, 'students': students, 'stub_latency': latency,
+                         'workers': workers, 'qps': qps, 'seed': seed},
+            'api_requests': counts,
+            'stages': results}
+
+
+def compare(baseline, current):
+    """
+    Print each stage's throughput against a baseline run.
+    """
+    before = {s['stage']: s for s in baseline['stages'] if 'rows_per_second' in s}
+    for stage in current['stages']:
+        old = before.get(stage['stage'])
+        if old is None or 'rows_per_second' not in stage:
+            continue
+        change = stage['rows_per_second'] / old['rows_per_second'] - 1
+        print('{:<24} {:>10} -> {:>10} rows/s ({:+.0%})'.format(
+            stage['stage'], old['rows_per_second'], stage['rows_per_second'], change))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic district.')
+    parser.add_argument('--schools', type=int, default=n_schools)
+    parser.add_argument('--students', type=int, default=n_students)
+    parser.add_argument('--latency', type=float, default=stub_latency,
+                        help='seconds each stub API response takes')
+    parser.add_argument('--out-dir', default=benchmark_dir)
+    parser.add_argument('--baseline', help='earlier benchmark JSON to compare against')
+    parser.add_argument('--verbose', action='store_true', help="show the scripts' progress output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run_benchmark(args.schools, args.students, args.latency, quiet=not args.verbose)
+    os.makedirs(args.out_dir, exist_ok=True)
+    out_path = os.path.join(args.out_dir, 'benchmark_{}.json'.format(
+        datetime.now().strftime('%Y%m%d_%H%M%S')))
+    with open(out_path, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('Wrote to {}'.format(out_path))
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
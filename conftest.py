@@ -0,0 +1,79 @@
+# Shared pytest fixtures
+# stub_server runs a local HTTP server so API clients can be tested
+# without calling Google or a real OpenTripPlanner instance
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+
+class StubServer:
+    """
+    Local HTTP server answering GET requests with a handler function.
+
+    Args:
+        respond (function): called with the request path and a dict of
+            query parameters, returns (status code, JSON-serializable body).
+        delay (float): seconds to wait before answering each request.
+    """
+    def __init__(self, respond, delay=0):
+        self.respond = respond
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with stub.lock:
+                    stub.requests.append((url.path, params))
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    time.sleep(stub.delay)
+                    status, body = stub.respond(url.path, params)
+                finally:
+                    with stub.lock:
+                        stub.in_flight -= 1
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', 0), Handler)
+        self.url = 'http://localhost:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    """
+    Factory for StubServers, shut down at the end of the test.
+    """
+    servers = []
+
+    def start(respond, delay=0):
+        servers.append(StubServer(respond, delay))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
@@ -1,30 +1,410 @@
+# Convert isochrone and journey GeoJSONs to KML/KMZ for Google Maps and Google Earth
+# Walks output trees and writes one multi-layer file per school (or one for
+# the whole district), with a folder per source GeoJSON:
+#   isochrones: outputs/[router]/[school]/isos_*.geojson (from gen_transit_isochrones)
+#   journeys:   [code]_[school]_[am|pm]_journeys.geojson (from postprocess_journeys)
+# A school's isochrones and journeys are matched by school code (see school_key).
+# KML is written directly, without GDAL. Groups are converted in a process pool,
+# and outputs whose sources and settings are unchanged since the last run
+# (tracked in kml_manifest.json in the output folder) are skipped.
+# e.g. python convert_geojson_to_kml.py outputs/indy outputs/indy2 --simplify 10
+
+import argparse
+import hashlib
+import json
 import os
-from osgeo import gdal, ogr
-import geopandas as gpd
-
-
-for subdir, dirs, files in os.walk('outputs\\indy'):
-    for f in files:
-        if 'isos' in f:
-            # format output path
-            geoj_path = os.path.join(subdir, f)
-            new_file_name = f[8:10] + '_isochrones.kml'
-            out_path = os.path.join(subdir, new_file_name)
-            print(out_path)
-
-            # sometimes isos are mappable but encoded oddly
-            # this section below fixes that but is optional
-            #isos = gpd.read_file(geoj_path)
-            #isos['geometry'] = isos.buffer(0.00)
-            #isos.to_file(geoj_path, driver='GeoJSON')
-
-            # convert to kml
-            geo_data = gdal.OpenEx(geoj_path)
-            gdal.VectorTranslate(out_path, geo_data, format='kml')
-        if '_journeys.geojson' in f:
-            geoj_path = os.path.join(subdir, f)
-            new_file_name = f[0:11] + '.kml'
-            out_path = os.path.join(subdir, new_file_name)
-            print(out_path)
-            geo_data = gdal.OpenEx(geoj_path)
-            gdal.VectorTranslate(out_path, geo_data, format='kml')
+import re
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+
+import create_od_records
+import gen_transit_isochrones
+import geo_utils
+import metrics
+
+# settings
+root = 'outputs/indy'
+out_dir = None  # defaults to [root]/kml
+group_by = 'school'  # 'school' for one file per school, 'district' for one file
+file_format = 'kmz'  # 'kmz' (zipped) or 'kml'
+simplify_meters = None  # Douglas-Peucker tolerance; None keeps every vertex
+coordinate_precision = 6  # decimal places, 6 is about 10 cm
+# school list (school_code, school_name) used to match each school's isochrone
+# folder to its journey files by code; None matches them by name only
+school_list = 'outputs/geocoded_indy_schools.csv'
+
+# properties used to name placemarks, in order of preference
+name_fields = ['name', 'time', 'origin']
+
+manifest_name = 'kml_manifest.json'
+
+journey_pattern = re.compile(r'^(?P<school>.+)_(?P<ampm>am|pm)_journeys\.geojson$')
+isochrone_pattern = re.compile(r'^isos_.+\.geojson$')
+
+
+def school_codes(path):
+    """
+    Read a school list into a lookup from isochrone folder name
+    (gen_transit_isochrones.clean_name of the school name) to school code.
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    schools = pd.read_csv(path, dtype=str).dropna(subset=['school_code', 'school_name'])
+    return dict(zip(schools['school_name'].map(gen_transit_isochrones.clean_name),
+                    create_od_records.normalize_code(schools['school_code'])))
+
+
+def school_key(name, codes=None):
+    """
+    The key a school's journey files and isochrone folder share.
+
+    Journey files are named [code]_[school], and isochrone folders after the
+    school name alone, so with codes (see school_codes) both map to the
+    school code. Otherwise, or for names codes doesn't know, the key is the
+    letters of the name without its code.
+    """
+    match = re.match(r'^(\d+)_', name)
+    if codes and match is not None:
+        return match.group(1)
+    if codes and name in codes:
+        return codes[name]
+    return re.sub('[^a-z]', '', re.sub(r'^\d+_', '', name.lower()))
+
+
+def find_sources(directory, skip_dir=None, codes=None):
+    """
+    Find the isochrone and journey GeoJSONs under one or more directories,
+    by school, e.g. outputs/indy for journeys and outputs/indy2 for the
+    isochrones of the indy2 router.
+
+    Isochrone files belong to the school folder they are in, and journey
+    files to the school at the start of their name. Both are matched up
+    with school_key, and a school is named after its journey files if it
+    has any.
+
+    Args:
+        directory (str or list): folder or folders to search.
+        skip_dir (str, optional): folder not to search, e.g. the output folder.
+        codes (dict, optional): isochrone folder -> school code, from school_codes.
+
+    Returns:
+        dict: school -> sorted list of (layer name, path) pairs.
+    """
+    groups = {}
+    names = {}
+    directories = [directory] if isinstance(directory, str) else directory
+    walks = (walk for d in directories for walk in os.walk(d))
+    for subdir, dirs, files in walks:
+        if skip_dir is not None and os.path.abspath(subdir) == os.path.abspath(skip_dir):
+            dirs[:] = []
+            continue
+        dirs.sort()
+        for f in sorted(files):
+            match = journey_pattern.match(f)
+            if match is not None:
+                school = match.group('school')
+                layer = '{}_journeys'.format(match.group('ampm'))
+            elif isochrone_pattern.match(f):
+                school = os.path.basename(subdir)
+                layer = f[:-len('.geojson')]
+            else:
+                continue
+            key = school_key(school, codes)
+            if match is not None or key not in names:
+                names[key] = school
+            groups.setdefault(key, []).append((layer, os.path.join(subdir, f)))
+    return {names[key]: sorted(sources) for key, sources in
+            sorted(groups.items(), key=lambda item: names[item[0]])}
+
+
+def plan_outputs(directory, out_dir, group_by='school', file_format='kmz', codes=None):
+    """
+    Work out which sources go into which output file.
+
+    Returns:
+        dict: output path -> list of (folder names, path) pairs, where
+            folder names is the tuple of nested KML folders for the source.
+    """
+    groups = find_sources(directory, skip_dir=out_dir, codes=codes)
+    if group_by == 'district':
+        first = directory if isinstance(directory, str) else directory[0]
+        name = os.path.basename(os.path.normpath(first))
+        out_path = os.path.join(out_dir, '{}.{}'.format(name, file_format))
+        return {out_path: [((school, layer), path)
+                           for school, sources in groups.items()
+                           for layer, path in sources]} if groups else {}
+    return {os.path.join(out_dir, '{}.{}'.format(school, file_format)):
+            [((layer,), path) for layer, path in sources]
+            for school, sources in groups.items()}
+
+
+def format_coords(coords, precision):
+    fmt = '{{:.{0}f}},{{:.{0}f}}'.format(precision)
+    return ' '.join(fmt.format(x, y) for x, y in coords)
+
+
+def kml_ring(ring, precision, tolerance):
+    coords = np.asarray(ring, dtype=float)[:, :2]
+    simplified = geo_utils.simplify_line(coords, tolerance)
+    if len(simplified) >= 4:
+        coords = simplified
+    return '<LinearRing><coordinates>{}</coordinates></LinearRing>'.format(
+        format_coords(coords, precision))
+
+
+def kml_geometry(geometry, precision=coordinate_precision, tolerance=None):
+    """
+    Convert a GeoJSON geometry to a KML geometry element.
+
+    Args:
+        geometry (dict): GeoJSON geometry.
+        precision (int): decimal places to write coordinates with.
+        tolerance (float, optional): simplification tolerance in meters
+            for lines and polygon rings. Rings are never simplified below
+            a triangle.
+
+    Returns:
+        str: KML, or '' for a missing or empty geometry.
+    """
+    if not geometry:
+        return ''
+    kind = geometry.get('type')
+    coords = geometry.get('coordinates')
+    if kind == 'GeometryCollection':
+        parts = [kml_geometry(g, precision, tolerance) for g in geometry.get('geometries', [])]
+        parts = [p for p in parts if p]
+        return '<MultiGeometry>{}</MultiGeometry>'.format(''.join(parts)) if parts else ''
+    if not coords:
+        return ''
+    if kind == 'Point':
+        return '<Point><coordinates>{}</coordinates></Point>'.format(
+            format_coords([coords[:2]], precision))
+    if kind == 'LineString':
+        line = geo_utils.simplify_line(np.asarray(coords, dtype=float)[:, :2], tolerance)
+        return '<LineString><coordinates>{}</coordinates></LineString>'.format(
+            format_coords(line, precision))
+    if kind == 'Polygon':
+        parts = ['<Polygon><outerBoundaryIs>{}</outerBoundaryIs>'.format(
+            kml_ring(coords[0], precision, tolerance))]
+        for ring in coords[1:]:
+            parts.append('<innerBoundaryIs>{}</innerBoundaryIs>'.format(
+                kml_ring(ring, precision, tolerance)))
+        parts.append('</Polygon>')
+        return ''.join(parts)
+    if kind in ('MultiPoint', 'MultiLineString', 'MultiPolygon'):
+        single = kind[len('Multi'):]
+        parts = [kml_geometry({'type': single, 'coordinates': c}, precision, tolerance)
+                 for c in coords]
+        return '<MultiGeometry>{}</MultiGeometry>'.format(''.join(parts))
+    raise ValueError('Unsupported geometry type {}'.format(kind))
+
+
+def kml_placemark(feature, precision=coordinate_precision, tolerance=None):
+    """
+    Convert a GeoJSON feature to a KML Placemark, with its properties
+    as ExtendedData.
+    """
+    properties = feature.get('properties') or {}
+    name = next((properties[f] for f in name_fields if properties.get(f) is not None), '')
+    data = ''.join('<Data name="{}"><value>{}</value></Data>'.format(
+                       escape(str(key), {'"': '&quot;'}), escape('' if value is None else str(value)))
+                   for key, value in properties.items())
+    return '<Placemark><name>{}</name><ExtendedData>{}</ExtendedData>{}</Placemark>'.format(
+        escape(str(name)), data, kml_geometry(feature.get('geometry'), precision, tolerance))
+
+
+def write_kml(sources, out_path, simplify=None, precision=coordinate_precision):
+    """
+    Write several GeoJSON files to one KML or KMZ file, each in its own folder.
+    Module-level so it can run in a worker process.
+
+    Args:
+        sources (list): (folder names, GeoJSON path) pairs. Sources that share
+            leading folder names are nested in the same folder.
+        out_path (str): .kml or .kmz file to write. Replaced atomically.
+        simplify (float, optional): simplification tolerance in meters.
+        precision (int): decimal places to write coordinates with.
+
+    Returns:
+        dict: output path, number of features and bytes, and seconds taken.
+    """
+    start = time.perf_counter()
+    name = os.path.basename(out_path).rsplit('.', 1)[0]
+    parts = ['<?xml version="1.0" encoding="utf-8"?>\n',
+             '<kml xmlns="http://www.opengis.net/kml/2.2"><Document>',
+             '<name>{}</name>'.format(escape(name))]
+    open_folders = []
+    features = 0
+    for folders, path in sources:
+        # close folders this source is not in, then open the new ones
+        shared = 0
+        while (shared < len(open_folders) and shared < len(folders) - 1
+               and open_folders[shared] == folders[shared]):
+            shared += 1
+        parts.append('</Folder>' * (len(open_folders) - shared))
+        open_folders = open_folders[:shared]
+        for folder in folders[shared:]:
+            parts.append('<Folder><name>{}</name>'.format(escape(folder)))
+            open_folders.append(folder)
+        with open(path) as f:
+            geojson = json.load(f)
+        for feature in geojson.get('features', []):
+            parts.append(kml_placemark(feature, precision, simplify))
+            features += 1
+    parts.append('</Folder>' * len(open_folders))
+    parts.append('</Document></kml>\n')
+    kml = ''.join(parts).encode('utf-8')
+
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    tmp_path = out_path + '.tmp'
+    if out_path.endswith('.kmz'):
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as kmz:
+            kmz.writestr('doc.kml', kml)
+    else:
+        with open(tmp_path, 'wb') as f:
+            f.write(kml)
+    os.replace(tmp_path, out_path)
+    return {'out_path': out_path,
+            'features': features,
+            'bytes': os.path.getsize(out_path),
+            'seconds': round(time.perf_counter() - start, 2)}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_state(paths, previous):
+    """
+    Size, modification time and sha256 of each source file. Hashes are
+    reused from previous while a file's size and modification time match.
+    """
+    state = {}
+    for path in paths:
+        stat = os.stat(path)
+        known = previous.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            state[path] = known
+        else:
+            state[path] = [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+    return state
+
+
+def same_sources(state, previous):
+    if set(state) != set(previous):
+        return False
+    return all(state[p][2] == previous[p][2] for p in state)
+
+
+@metrics.timed('convert_geojson_to_kml')
+def batch_convert(directory, out_dir=None, group_by='school', file_format='kmz',
+                  simplify=None, workers=None, force=False, schools=None):
+    """
+    Convert every isochrone and journey GeoJSON under a directory in a
+    process pool, writing one multi-layer file per school or district.
+
+    Args:
+        directory (str or list): folder or folders to search, e.g. 'outputs/indy'.
+        out_dir (str, optional): folder to write to. Defaults to kml in
+            the first folder.
+        group_by (str): 'school' or 'district'.
+        file_format (str): 'kmz' or 'kml'.
+        simplify (float, optional): simplification tolerance in meters.
+        workers (int, optional): number of worker processes.
+            Defaults to the number of CPUs.
+        force (bool): rewrite outputs even if their sources are unchanged.
+        schools (str, optional): school list to match isochrone folders to
+            journey files with (see school_codes). Defaults to school_list.
+
+    Returns:
+        list: results from write_kml for the files written.
+    """
+    first = directory if isinstance(directory, str) else directory[0]
+    out_dir = out_dir or os.path.join(first, 'kml')
+    codes = school_codes(schools or school_list)
+    plan = plan_outputs(directory, out_dir, group_by, file_format, codes)
+    if not plan:
+        print('No GeoJSON files found in {}'.format(directory))
+        return []
+    manifest_path = os.path.join(out_dir, manifest_name)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    options = {'simplify': simplify, 'precision': coordinate_precision,
+               'name_fields': name_fields}
+
+    todo = {}
+    states = {}
+    for out_path, sources in plan.items():
+        entry = manifest.get(out_path, {})
+        states[out_path] = source_state([path for _, path in sources], entry.get('sources', {}))
+        if (force or not os.path.exists(out_path) or entry.get('options') != options
+                or not same_sources(states[out_path], entry.get('sources', {}))):
+            todo[out_path] = sources
+    print('{} of {} {} files to write'.format(len(todo), len(plan), file_format.upper()))
+
+    results = []
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(write_kml, sources, out_path, simplify,
+                                       coordinate_precision): out_path
+                       for out_path, sources in todo.items()}
+            for future in as_completed(futures):
+                out_path = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print('Could not write {}: {}'.format(out_path, e))
+                    continue
+                print('{out_path}: {features} features, {bytes} bytes in {seconds}s'.format(**result))
+                metrics.inc('bytes_written', result['bytes'], output='kml')
+                manifest[out_path] = {'sources': states[out_path], 'options': options}
+                results.append(result)
+    # only outputs still planned are kept, so removed schools drop out
+    manifest = {out_path: entry for out_path, entry in manifest.items() if out_path in plan}
+    os.makedirs(out_dir, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Convert isochrone and journey GeoJSONs '
+                                                 'to one KML/KMZ per school or district.')
+    parser.add_argument('root', nargs='*', default=[root], help='output folders to search')
+    parser.add_argument('--out-dir', default=out_dir,
+                        help='folder to write to (default: [root]/kml)')
+    parser.add_argument('--by', choices=['school', 'district'], default=group_by,
+                        dest='group_by', help='one file per school, or one for the district')
+    parser.add_argument('--format', choices=['kmz', 'kml'], default=file_format,
+                        dest='file_format')
+    parser.add_argument('--simplify', type=float, default=simplify_meters,
+                        help='simplification tolerance in meters')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--force', action='store_true', help='rewrite unchanged outputs')
+    parser.add_argument('--schools', default=school_list,
+                        help='school list to match isochrone folders to journey files by code')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    batch_convert(args.root, args.out_dir, args.group_by, args.file_format,
+                  args.simplify, args.workers, args.force, args.schools)
+    metrics.report()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,4 +1,5 @@
 from datetime import date, datetime
+from functools import lru_cache
 
 from dateutil import parser, tz
 from dateutil.relativedelta import WE, relativedelta
@@ -7,19 +8,32 @@ mt = tz.gettz('US/Mountain')
 ct = tz.gettz('US/Central')
 et = tz.gettz('US/Eastern')
 
-def get_next_wednesday():
+tzinfos = {'EDT': et,
+           'CDT': ct,
+           'MDT': mt}
+
+def get_next_wednesday(today=None):
     """
     Utility function to help generate a weekday in the future.
     Wednesdays were chosen because they are rarely holidays 
     with special schedules.
+
+    Args:
+        today (date, optional): date to count from. Defaults to today.
     """
-    today = date.today()
+    today = today or date.today()
     delta = relativedelta(days=1, weekday=WE(1))
     next_wednesday = today + delta
     return next_wednesday
 
 
-def create_timestamp(str_time, tz=None):
+@lru_cache(maxsize=1024)
+def _timestamp_on(str_time, ref_date):
+    full_dt = str(ref_date) + ' ' + str_time
+    return int(datetime.timestamp(parser.parse(full_dt, tzinfos=tzinfos)))
+
+
+def create_timestamp(str_time, tz=None, ref_date=None):
     """
     Args:
         str_time (str): Time to convert. 
@@ -29,20 +43,42 @@ def create_timestamp(str_time, tz=None):
             must be specified after the time.
 
         tz (str, optional): 3-character timezone string.
+        ref_date (date, optional): date to place the time on.
+            Defaults to next Wednesday. Pass a fixed date for reproducible runs.
     Returns:
         int: a POSIX timestamp (seconds from January 1, 1970 UTC)
-             representing str_time next Wednesday.
+             representing str_time on ref_date.
     """
-
-    tzinfo = {'EDT': et,
-              'CDT': ct,
-              'MDT': mt}
     if tz:
         str_time = str_time + ' ' + tz
-    n = get_next_wednesday()
-    full_dt = str(n) + ' ' + str_time
-    timestamp = datetime.timestamp(parser.parse(full_dt, tzinfos=tzinfo))
-    return int(timestamp)
+    # results are cached, so normalize spacing to get more cache hits
+    str_time = ' '.join(str_time.split())
+    return _timestamp_on(str_time, ref_date or get_next_wednesday())
+
+
+def create_timestamps(str_times, tzs=None, ref_date=None):
+    """
+    Convert a whole column of times to POSIX timestamps in one call.
+    Each distinct (time, tz) pair is only parsed once, and every time
+    is placed on the same date.
+
+    Args:
+        str_times (iterable of str): times to convert, see create_timestamp.
+        tzs (iterable of str, optional): a 3-character timezone string
+            for each time. If not given, times must include their time zone.
+        ref_date (date, optional): date to place the times on.
+            Defaults to next Wednesday, worked out once for the whole call.
+
+    Returns:
+        list: POSIX timestamps (ints), in the same order as str_times.
+    """
+    ref_date = ref_date or get_next_wednesday()
+    if tzs is None:
+        pairs = [(t, None) for t in str_times]
+    else:
+        pairs = list(zip(str_times, tzs))
+    converted = {pair: create_timestamp(pair[0], pair[1], ref_date) for pair in set(pairs)}
+    return [converted[pair] for pair in pairs]
 
 
 def test_functions():
@@ -2,11 +2,15 @@
 # Script builds off of the outputs of geocode_and_prep
 # Assumes the student data has a field called "home_address"
 # And the school data has a field called "school_address"
-# Before running single process, confirm join fields in line 61 are correct
+# Before running single process, confirm join fields in main() are correct
 
+import hashlib
+import json
 import pandas as pd
 import os
 import re
+import metrics
+import od_store
 
 # only useful for path completion when single-processing
 # ignore this variable when batch processing
@@ -16,35 +20,263 @@ student_data_path = 'temp/indy/{}_geocoded_students.csv'.format(school)
 school_data_path = 'outputs/geocoded_indy_schools.csv'
 combined_output_path = 'temp/indy/{}_od_df.csv'.format(school)
 
-def batch_combine(directory):
+# columns batch_combine requires, and columns it converts to numbers.
+# everything else is read as text so codes like "007" keep their zeros
+student_required_columns = ['stu_sch_code', 'home_address']
+school_required_columns = ['school_code', 'school_address']
+float_columns = ['home_lat', 'home_lon', 'school_lat', 'school_lon']
+
+# batch_combine records the student files it has processed here,
+# and rows that match no school here
+manifest_name = 'od_manifest.json'
+unmatched_name = 'unmatched_od_rows.csv'
+
+# 'parquet' writes od tables as a dataset partitioned by school in
+# [directory]/[od_store.od_dataset], 'csv' as [school]_od_df.csv files
+od_format = 'parquet'
+
+
+def normalize_code(codes):
     """
-    Go through the given directory and all its subfolders,
-    creating origin-destination files for each file ending in "geocoded_students.csv"
+    Normalize school codes for joining: strip whitespace and drop a
+    trailing ".0" left over from codes that were read as floats.
+    """
+    return codes.astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+
+
+def enforce_schema(df, required, path):
+    """
+    Check required columns exist and convert coordinate columns to floats.
+
+    Raises:
+        ValueError: if a required column is missing.
+    """
+    missing = [c for c in required if c not in df.columns]
+    if missing:
+        raise ValueError('{} is missing required columns {}'.format(path, missing))
+    for col in float_columns:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+
+def load_schools(path):
+    """
+    Load the geocoded school table, indexed by normalized school code.
     """
-    schools = pd.read_csv(school_data_path)
+    schools = pd.read_csv(path, dtype=str)
     schools = schools.rename(columns={'address': 'school_address',
                                       'lat': 'school_lat',
                                       'lon': 'school_lon'})
-    
-    # walk through the indy temp folder
-    for subdir, dirs, files in os.walk(directory):
-        for f in files:
-            # only process schools with program codes
-            if re.search('^\d', f) and f.endswith('geocoded_students.csv'):
-                # create the output file name
-                file_stem = re.search('\w+', f).group()[:-17]
-                file_name = '{}od_df.csv'.format(file_stem)
-                out_file = os.path.join(subdir, file_name)
-                print(out_file)
-
-                # perform the join
-                students = pd.read_csv(os.path.join(subdir, f))
-                students = students.rename(columns={'lat': 'home_lat',
-                                                    'lon': 'home_lon'})
-                joined = students.merge(schools, 
-                                        left_on='stu_sch_code', 
-                                        right_on='school_code')
-                joined.to_csv(out_file, index=False)
+    schools = enforce_schema(schools, school_required_columns, path)
+    schools = schools[schools['school_code'].notnull()]
+    schools.index = normalize_code(schools['school_code'])
+    duplicated = schools.index.duplicated()
+    if duplicated.any():
+        print('Dropping duplicate school codes: {}'.format(list(schools.index[duplicated])))
+        schools = schools[~duplicated]
+    return schools
+
+
+def load_students(paths):
+    """
+    Load several geocoded student files into one data frame,
+    with a source_file column recording where each row came from.
+    """
+    frames = []
+    for path in paths:
+        if od_store.is_parquet(path):
+            students = od_store.text_table(od_store.read_table(path))
+        else:
+            students = pd.read_csv(path, dtype=str)
+        students = students.rename(columns={'lat': 'home_lat',
+                                            'lon': 'home_lon'})
+        students = enforce_schema(students, student_required_columns, path)
+        students['source_file'] = path
+        frames.append(students)
+    return pd.concat(frames, ignore_index=True)
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def od_path(directory, school):
+    """
+    Where the od table for a school goes, in od_format.
+    """
+    if od_format == 'parquet':
+        return od_store.partition_path(os.path.join(directory, od_store.od_dataset), school)
+    return os.path.join(directory, '{}_od_df.csv'.format(school))
+
+
+def find_student_files(directory):
+    """
+    Find geocoded student files for schools with program codes,
+    mapped to the od table each one produces.
+    Finds [school]_geocoded_students.csv files and the partitions of
+    geocoded student datasets (see od_store).
+
+    Raises:
+        ValueError: if two student files would write the same od table,
+            e.g. a csv file and a partition for the same school.
+    """
+    files = {}
+    sources = {}
+    for subdir, dirs, filenames in os.walk(directory):
+        for f in filenames:
+            path = os.path.join(subdir, f)
+            if f.endswith('geocoded_students.csv'):
+                school = f[:-len('_geocoded_students.csv')]
+                if od_format == 'parquet':
+                    out_file = od_path(directory, school)
+                else:
+                    out_file = os.path.join(subdir, school + '_od_df.csv')
+            elif (f == od_store.part_name and
+                  os.path.basename(os.path.dirname(subdir)) == od_store.student_dataset):
+                school = od_store.partition_school(path)
+                out_file = od_path(directory, school)
+            else:
+                continue
+            if re.search(r'^\d', school):
+                if out_file in sources:
+                    raise ValueError('{} and {} would both write {}, remove one of them'
+                                     .format(sources[out_file], path, out_file))
+                sources[out_file] = path
+                files[path] = out_file
+    return files
+
+
+def find_od_files(directory):
+    """
+    Returns:
+        dict: school -> od table batch_combine wrote to the directory, in od_format.
+    """
+    if od_format == 'parquet':
+        return od_store.find_partitions(os.path.join(directory, od_store.od_dataset))
+    return {os.path.basename(path)[:-len('_od_df.csv')]: path
+            for path in sorted(find_student_files(directory).values())
+            if os.path.exists(path)}
+
+
+def changed_files(files, manifest, schools_hash):
+    """
+    Work out which student files need rebuilding: new files, files whose
+    contents changed (checked by hash only when the mtime moved),
+    files whose output is missing, or every file if the school table changed.
+
+    Returns:
+        tuple: (list of paths to rebuild, updated manifest)
+    """
+    rebuild_all = manifest.get('schools_hash') != schools_hash
+    entries = manifest.get('files', {})
+    new_entries = {}
+    to_build = []
+    for path, out_file in sorted(files.items()):
+        mtime = os.path.getmtime(path)
+        entry = entries.get(path, {})
+        if entry.get('mtime') == mtime:
+            digest = entry['sha256']
+        else:
+            digest = file_hash(path)
+        new_entries[path] = {'mtime': mtime, 'sha256': digest}
+        if rebuild_all or entry.get('sha256') != digest or not os.path.exists(out_file):
+            to_build.append(path)
+    return to_build, {'schools_hash': schools_hash, 'files': new_entries}
+
+
+@metrics.timed('batch_combine')
+def batch_combine(directory, incremental=True, school_path=None):
+    """
+    Go through the given directory and all its subfolders,
+    creating origin-destination tables for each file ending in "geocoded_students.csv"
+    and each partition of a geocoded student dataset (see find_student_files).
+    Tables are written in od_format.
+
+    All student files are loaded at once and joined to the school table
+    in a single indexed join, then written back out per school.
+    Rows whose school code has no match in the school table are reported
+    and written to unmatched_od_rows.csv in the directory, which is removed
+    once every row matches. A rebuilt file with no matched rows at all has
+    its old od table removed.
+
+    Args:
+        directory (str): folder to search for geocoded student files.
+        incremental (bool): only rebuild student files that changed since the
+            last run (tracked in od_manifest.json in the directory).
+        school_path (str, optional): geocoded school table.
+            Defaults to school_data_path.
+
+    Returns:
+        pandas DataFrame: the unmatched student rows.
+    """
+    manifest_path = os.path.join(directory, manifest_name)
+    manifest = {}
+    if incremental and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    school_path = school_path or school_data_path
+    files = find_student_files(directory)
+    to_build, manifest = changed_files(files, manifest, file_hash(school_path))
+    print('{} of {} student files to rebuild'.format(len(to_build), len(files)))
+    if not to_build:
+        return pd.DataFrame()
+
+    schools = load_schools(school_path)
+    students = load_students(to_build)
+    students['join_code'] = normalize_code(students['stu_sch_code'])
+
+    # perform the join
+    joined = students.merge(schools, left_on='join_code', right_index=True,
+                            how='left', indicator=True)
+    matched = joined['_merge'] == 'both'
+    joined = joined.drop(columns=['join_code', '_merge'])
+
+    unmatched = joined[~matched]
+    if len(unmatched) > 0:
+        print('{} rows did not match a school:'.format(len(unmatched)))
+        print(unmatched.groupby('source_file').size().to_string())
+    # keep earlier unmatched rows of student files that weren't rebuilt
+    report_path = os.path.join(directory, unmatched_name)
+    report = unmatched
+    if os.path.exists(report_path):
+        earlier = pd.read_csv(report_path, dtype=str)
+        earlier = earlier[earlier['source_file'].isin(files) & ~earlier['source_file'].isin(to_build)]
+        report = pd.concat([earlier, unmatched], ignore_index=True)
+    if len(report) > 0:
+        report.to_csv(report_path, index=False)
+    elif os.path.exists(report_path):
+        os.remove(report_path)
+
+    # rebuilt files without any matched rows don't keep their old od table
+    written = set(joined.loc[matched, 'source_file'])
+    for path in to_build:
+        if path not in written and os.path.exists(files[path]):
+            print('No rows of {} matched a school, removing {}'.format(path, files[path]))
+            os.remove(files[path])
+
+    # write one od file per student file
+    for path, od in joined[matched].groupby('source_file', sort=False):
+        out_file = files[path]
+        print(out_file)
+        od = od.drop(columns='source_file')
+        if od_format == 'parquet':
+            # school fields repeat on every row, so they are dictionary-encoded
+            od_store.write_partition(od, os.path.dirname(os.path.dirname(out_file)),
+                                     od_store.partition_school(out_file),
+                                     dictionary_columns=list(schools.columns))
+        else:
+            od.to_csv(out_file, index=False)
+        metrics.inc('bytes_written', os.path.getsize(out_file), output='od')
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return unmatched
 
 
 def main():
@@ -1,18 +1,60 @@
 import configparser
-import requests
-import json
 import time
+import requests
+import numpy as np
 import pandas as pd
+import api_utils
 import convert_times
+import geo_utils
+import journey_store
+import metrics
+import od_store
+import origin_clusters
+import postprocess_journeys
+import response_cache
+from collections import Counter, deque
 from datetime import datetime
 
 # variables
 school = '000_school_name'
 ampm = 'am'
 
+# concurrency settings
+max_workers = 8  # number of simultaneous requests
+max_qps = 10  # maximum requests per second across all workers
+
+# response cache settings
+cache_path = 'temp/directions_cache.sqlite'
+cache_max_age_days = 90  # set to None to keep responses indefinitely
+offline = False  # if True, only use cached responses and never call the API
+
+# triage settings -- rows that clearly don't need a transit search
+# get a synthetic record instead of a Directions API call
+triage_rows = True
+walk_only_miles = 0.5  # straight-line distance under which students are assumed to walk
+walk_speed_mph = 3.0
+walk_detour_factor = 1.3  # street distance per mile of straight-line distance
+invalid_coords = [(39.0, -86.0)]  # placeholder (lat, lon) left by failed geocodes
+
+# origin clustering -- route one representative home per cluster of nearby
+# homes and share its result with the rest of the cluster
+cluster_homes = False
+cluster_method = 'grid'  # 'grid' snaps homes to squares, 'radius' groups homes around a leader
+cluster_meters = 150  # grid cell size or cluster radius
+
 # path templates
-od_path = 'temp/indy/{}_od_df.csv'.format(school)
-out_path = 'temp/indy/{}_{}_journeys.json'.format(school, ampm)
+od_path = 'temp/indy/od/school={}'.format(school)  # od dataset partition, or a [school]_od_df.csv file
+out_path = 'temp/indy/{}_{}_journeys.jsonl'.format(school, ampm)
+
+# if True, rows already in out_path are skipped and new rows are appended
+resume = True
+progress_every = 1000  # rows between progress lines; request counts are in metrics
+
+# the od columns routing needs (format_params, triage and clustering);
+# only these are read from the od table
+od_columns = ['home_address', 'home_lat', 'home_lon',
+              'school_address', 'school_lat', 'school_lon',
+              'am_latest_arr', 'pm_earliest_dep', 'tz']
 
 # API variables
 dir_api = 'https://maps.googleapis.com/maps/api/directions/json'
@@ -21,13 +63,17 @@ config.read('config.ini')
 gkey = config['auth']['gkey2']
 
 
-def format_params(record, ampm):
+def format_params(record, ampm, ref_date=None, timestamp=None):
     """
     Create the parameters to pass to the Google Directions API
 
     Args:
         record (pandas Series): a row of student data from an od_df dataset.
         ampm (str): whether the journey is 'am' or 'pm'
+        ref_date (date, optional): date of the trip. Defaults to next Wednesday.
+        timestamp (int, optional): the arrival (AM) or departure (PM) time,
+            e.g. from convert_times.create_timestamps. Worked out from
+            record and ref_date if not given.
     
     Returns:
         dict: Dictionary of parameters needed for the Google Directions API
@@ -43,9 +89,10 @@ def format_params(record, ampm):
         params['destination'] = '{}'.format(record['school_address'])
         
         # format the arrival time to be school session time next Weds
-        arr_text = record['am_latest_arr'] + ' ' + record['tz']
-        arr_timestamp = convert_times.create_timestamp(arr_text)                                           
-        params['arrival_time'] = arr_timestamp
+        if timestamp is None:
+            arr_text = record['am_latest_arr'] + ' ' + record['tz']
+            timestamp = convert_times.create_timestamp(arr_text, ref_date=ref_date)
+        params['arrival_time'] = timestamp
 
     elif ampm=='pm':
         # add origin, destination, departure time for PM
@@ -53,57 +100,448 @@ def format_params(record, ampm):
         params['destination'] = '{}'.format(record['home_address'])
 
         # format departure time to be school end bell next Weds
-        dep_text = record['pm_earliest_dep'] + ' ' + record['tz']
-        dep_timestamp = convert_times.create_timestamp(dep_text)
-        params['departure_time'] = dep_timestamp
+        if timestamp is None:
+            dep_text = record['pm_earliest_dep'] + ' ' + record['tz']
+            timestamp = convert_times.create_timestamp(dep_text, ref_date=ref_date)
+        params['departure_time'] = timestamp
 
     return params
 
 
-def query_dir_api(params):
+def query_dir_api(params, session=None, bucket=None, api=dir_api):
     """
     Query the Google Directions API.
 
+    Retryable failures (HTTP 429/5xx, connection errors, OVER_QUERY_LIMIT)
+    are retried with exponential backoff and jitter.
+
     Args:
         params (dict): Parameters to use in the API call.
+        session (requests.Session, optional): session to reuse connections from.
+        bucket (api_utils.TokenBucket, optional): rate limiter shared by all workers.
+        api (str): Directions endpoint. Override to point at a stub server.
     
     Returns:
         dict: JSON-formatted response, if successful.
               If the API call failed, dict will contain status code and params.
     """
-    r = requests.get(dir_api, params=params)
-    time.sleep(.05)
+    try:
+        r = api_utils.get_with_retry(api, params=params, session=session,
+                                     bucket=bucket, is_retryable=over_query_limit,
+                                     label='directions')
+    except requests.RequestException as e:
+        return {'status': type(e).__name__, 'params': params}
+
     if r.status_code == 200:
         data = r.json()
     else:
         data = {}
         data['status'] = r.status_code
         data['params'] = params
-        print(r.status_code)
-        time.sleep(60)
     return data
 
 
-def batch_process(df, ampm):
-    all_journeys = []
-    for idx, row in df.iterrows():
-        print(idx)
-        params = format_params(row, ampm)
-        response = query_dir_api(params)
-        if response.get('status') != 'OK' and response.get('status') is not None:
+def over_query_limit(r):
+    """
+    Google reports quota problems with a 200 and an OVER_QUERY_LIMIT status.
+    Returns the status so api_utils.get_with_retry backs off on it.
+    """
+    if r.status_code == 200 and r.json().get('status') == 'OVER_QUERY_LIMIT':
+        return 'OVER_QUERY_LIMIT'
+    return None
+
+
+def cached_query(params, cache, **kwargs):
+    """
+    Query the Directions API through a ResponseCache.
+
+    Args:
+        params (dict): Parameters to use in the API call.
+        cache (response_cache.ResponseCache): cache to check first.
+            In offline mode, misses return a 'CACHE_MISS' status instead of
+            calling the API.
+        **kwargs: passed on to query_dir_api.
+
+    Returns:
+        dict: JSON-formatted response, from the cache if possible.
+    """
+    key = response_cache.directions_key(params)
+    data = cache.get(key)
+    if data is not None:
+        return data
+    if cache.offline:
+        return {'status': 'CACHE_MISS',
+                'params': response_cache.normalize_directions_params(params)}
+    data = query_dir_api(params, **kwargs)
+    if data.get('status') in response_cache.CACHEABLE_STATUSES:
+        cache.put(key, data)
+    return data
+
+
+def triage(df):
+    """
+    Sort od_df rows into those that need a transit search and those that don't,
+    using straight-line distances from home to school.
+
+    Rows are 'invalid' if either end has missing, out of range or placeholder
+    (invalid_coords) coordinates, 'walk_only' if home is within walk_only_miles
+    of school, and 'needs_transit' otherwise.
+
+    Args:
+        df (pandas DataFrame): od_df dataset.
+
+    Returns:
+        pandas DataFrame: 'category' and straight-line 'miles' for each row of df.
+    """
+    coords = {col: pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float)
+              for col in ('home_lat', 'home_lon', 'school_lat', 'school_lon')}
+    invalid = np.zeros(len(df), dtype=bool)
+    for end in ('home', 'school'):
+        lat = coords[end + '_lat']
+        lon = coords[end + '_lon']
+        invalid |= np.isnan(lat) | np.isnan(lon)
+        invalid |= (np.abs(lat) > 90) | (np.abs(lon) > 180)
+        invalid |= (lat == 0) & (lon == 0)
+        for bad_lat, bad_lon in invalid_coords:
+            invalid |= np.isclose(lat, bad_lat) & np.isclose(lon, bad_lon)
+    miles = geo_utils.haversine_miles(coords['home_lat'], coords['home_lon'],
+                                      coords['school_lat'], coords['school_lon'])
+    category = np.where(invalid, 'invalid',
+                        np.where(miles <= walk_only_miles, 'walk_only', 'needs_transit'))
+    return pd.DataFrame({'category': category, 'miles': miles}, index=df.index)
+
+
+def triage_response(record, ampm, category, miles):
+    """
+    Build a stand-in for a Directions API response for a row that triage
+    kept away from the API. Its 'record' holds journey attributes in the
+    postprocess_journeys.extract_properties format, which postprocessing
+    passes straight through.
+
+    Walk-only journeys are estimated from the straight-line distance,
+    walk_detour_factor and walk_speed_mph.
+
+    Args:
+        record (pandas Series): a row of student data from an od_df dataset.
+        ampm (str): whether the journey is 'am' or 'pm'
+        category (str): 'walk_only' or 'invalid', from triage.
+        miles (float): straight-line distance from home to school.
+
+    Returns:
+        dict: {'status': 'WALK_ONLY' or 'INVALID_COORDINATES', 'record': ...}
+    """
+    ends = [('home_address', 'home_lat', 'home_lon'),
+            ('school_address', 'school_lat', 'school_lon')]
+    if ampm == 'pm':
+        ends.reverse()
+    (origin, origin_lat, origin_lon), (dest, dest_lat, dest_lon) = ends
+    if category == 'invalid':
+        status = 'INVALID_COORDINATES'
+        properties = {'origin': record[origin],
+                      'dest': record[dest],
+                      'notes': status}
+    else:
+        status = 'WALK_ONLY'
+        walk_miles = round(miles * walk_detour_factor, 2)
+        walk_minutes = round(walk_miles / walk_speed_mph * 60, 1)
+        properties = {'origin': record[origin],
+                      'origin_lat': float(record[origin_lat]),
+                      'origin_lon': float(record[origin_lon]),
+                      'dest': record[dest],
+                      'dest_lat': float(record[dest_lat]),
+                      'dest_lon': float(record[dest_lon]),
+                      'departure_time': None,
+                      'arrival_time': None,
+                      'total_minutes': walk_minutes,
+                      'total_miles': walk_miles,
+                      'notes': status,
+                      'walk_time_minutes': walk_minutes,
+                      'walk_dist_miles': walk_miles,
+                      'transit_time_minutes': 0.0,
+                      'num_transfers': 0,
+                      'starting_stop': None,
+                      'end_stop': None,
+                      'routes_taken': ''}
+    return {'status': status, 'record': properties}
+
+
+def home_clusters(df, triaged=None):
+    """
+    Cluster the homes of the od_df rows that need a transit search
+    (see origin_clusters.cluster_origins), using cluster_method and cluster_meters.
+
+    Args:
+        df (pandas DataFrame): od_df dataset.
+        triaged (pandas DataFrame, optional): output of triage(df).
+            Rows it does not mark 'needs_transit' are left out.
+
+    Returns:
+        pandas DataFrame: cluster representative, size and snapping error
+            for each clustered row.
+    """
+    if triaged is not None:
+        df = df[triaged['category'] == 'needs_transit']
+    return origin_clusters.cluster_origins(df, cluster_method, cluster_meters)
+
+
+def member_response(response, record, ampm, cluster):
+    """
+    Copy a cluster representative's response for another member of the
+    cluster. The member's own home address and coordinates replace the
+    representative's, and a 'snap' entry records the snapping error.
+    The representative's response is left unchanged.
+
+    Args:
+        response (dict): the representative's Directions API response.
+        record (pandas Series): the member's row of the od_df dataset.
+        ampm (str): whether the journey is 'am' or 'pm'
+        cluster (pandas Series): the member's row from home_clusters.
+
+    Returns:
+        dict: the member's response.
+    """
+    response = dict(response)
+    snapped = cluster['representative'] != record.name
+    # the home is the origin of AM trips and the destination of PM trips
+    home = 0 if ampm == 'am' else 1
+    if snapped and 'params' in response:
+        response['params'] = dict(response['params'])
+        response['params'][('origin', 'destination')[home]] = '{}'.format(record['home_address'])
+    if snapped and 'geocoded_waypoints' in response:
+        waypoints = [dict(w) for w in response['geocoded_waypoints']]
+        if 'address' in waypoints[home]:
+            waypoints[home]['address'] = '{}'.format(record['home_address'])
+        response['geocoded_waypoints'] = waypoints
+    if snapped and response.get('routes'):
+        route = dict(response['routes'][0])
+        leg = dict(route['legs'][0])
+        end = ('start', 'end')[home]
+        leg[end + '_address'] = record['home_address']
+        leg[end + '_location'] = {'lat': float(record['home_lat']),
+                                  'lng': float(record['home_lon'])}
+        route['legs'] = [leg] + route['legs'][1:]
+        response['routes'] = [route] + response['routes'][1:]
+    if snapped and 'record' in response:
+        end = ('origin', 'dest')[home]
+        response['record'] = dict(response['record'], **{
+            end: record['home_address'],
+            end + '_lat': float(record['home_lat']),
+            end + '_lon': float(record['home_lon'])})
+    response['snap'] = {'representative': int(cluster['representative']),
+                        'cluster_size': int(cluster['cluster_size']),
+                        'snap_error_miles': float(cluster['snap_error_miles'])}
+    return response
+
+
+def iter_journeys(df, ampm, workers=None, qps=None, api=dir_api, cache=None,
+                  skip_rows=None, ref_date=None, use_triage=None, use_clusters=None,
+                  bucket=None):
+    """
+    Query the Directions API for every row of an od_df dataset,
+    yielding each response as soon as it (and every row before it) is done.
+
+    Requests are made concurrently over a pooled session and rate limited
+    to qps requests per second. Results come back in the same order as df.
+
+    Args:
+        df (pandas DataFrame): od_df dataset.
+        ampm (str): whether the journeys are 'am' or 'pm'
+        workers (int, optional): number of concurrent requests.
+            Defaults to max_workers.
+        qps (float, optional): requests per second limit. Defaults to max_qps.
+        api (str): Directions endpoint. Override to point at a stub server.
+        cache (response_cache.ResponseCache, optional): cache of earlier
+            responses. Only uncached rows are sent to the API.
+        skip_rows (set, optional): row indices to skip, e.g. rows already
+            written by an interrupted run.
+        ref_date (date, optional): date of the trips. Defaults to next
+            Wednesday, worked out once for the whole run.
+        use_triage (bool, optional): only send rows that triage marks as
+            'needs_transit' to the API, and yield a triage_response for the
+            rest. Defaults to triage_rows.
+        use_clusters (bool, optional): route one representative per cluster
+            of nearby homes (see home_clusters) and give every member a copy
+            of its response (see member_response). A representative's
+            response is only held until its last member has been yielded.
+            Defaults to cluster_homes.
+        bucket (api_utils.TokenBucket, optional): rate limiter to share with
+            other runs, so that together they stay under its rate.
+            Defaults to a new one at qps.
+
+    Yields:
+        tuple: (row index, Directions API response)
+    """
+    workers = workers or max_workers
+    bucket = bucket or api_utils.TokenBucket(qps or max_qps)
+    session = api_utils.make_session(workers)
+    skip_rows = skip_rows or set()
+    ref_date = ref_date or convert_times.get_next_wednesday()
+    use_triage = triage_rows if use_triage is None else use_triage
+    triaged = triage(df) if use_triage else None
+    if triaged is not None:
+        print('Triage: {}'.format(triaged['category'].value_counts().to_dict()))
+    use_clusters = cluster_homes if use_clusters is None else use_clusters
+    clusters = home_clusters(df, triaged) if use_clusters else None
+    if clusters is not None:
+        print('Clustering: {} homes into {} clusters'.format(
+            len(clusters), clusters['representative'].nunique()))
+
+    # convert the bell times of every row that may be routed in one call,
+    # so each distinct time is parsed once instead of once per row
+    if triaged is None:
+        transit_rows = df.index
+    else:
+        transit_rows = triaged.index[triaged['category'] == 'needs_transit']
+    time_col = 'am_latest_arr' if ampm == 'am' else 'pm_earliest_dep'
+    timestamps = dict(zip(transit_rows, convert_times.create_timestamps(
+        df.loc[transit_rows, time_col], df.loc[transit_rows, 'tz'], ref_date)))
+
+    def process_row(item):
+        idx, row = item
+        if triaged is not None and triaged.at[idx, 'category'] != 'needs_transit':
+            return idx, triage_response(row, ampm, triaged.at[idx, 'category'],
+                                        triaged.at[idx, 'miles'])
+        params = format_params(row, ampm, ref_date, timestamps[idx])
+        if cache is not None:
+            response = cached_query(params, cache, session=session, bucket=bucket, api=api)
+        else:
+            response = query_dir_api(params, session=session, bucket=bucket, api=api)
+        if response.get('status') != 'OK' and 'geocoded_waypoints' in response:
             response['geocoded_waypoints'][0]['address'] = params['origin']
             response['geocoded_waypoints'][1]['address'] = params['destination']
-        all_journeys.append(response)
-    return all_journeys
+        return idx, response
 
+    if clusters is None:
+        rows = (item for item in df.iterrows() if item[0] not in skip_rows)
+        try:
+            yield from api_utils.map_ordered(process_row, rows, max_workers=workers)
+        finally:
+            session.close()
+        return
 
-def main():
-    od = pd.read_csv(od_path)
-    full_results = batch_process(od, ampm)
+    # route each cluster's representative when its first remaining member
+    # comes up (even if the representative itself was done in an earlier run),
+    # so every row can be yielded in df order as soon as its response is back
+    todo = [idx for idx in df.index if idx not in skip_rows]
+    source = {idx: clusters.at[idx, 'representative'] if idx in clusters.index else idx
+              for idx in todo}
+    remaining = Counter(source.values())
+    to_route = dict.fromkeys(source[idx] for idx in todo)
+    rows = ((idx, df.loc[idx]) for idx in to_route)
+    routed = {}
+    pending = deque(todo)
+    try:
+        for src, response in api_utils.map_ordered(process_row, rows, max_workers=workers):
+            routed[src] = response
+            while pending and source[pending[0]] in routed:
+                idx = pending.popleft()
+                src = source[idx]
+                response = routed[src]
+                remaining[src] -= 1
+                if not remaining[src]:
+                    del routed[src]
+                if idx in clusters.index:
+                    response = member_response(response, df.loc[idx], ampm, clusters.loc[idx])
+                yield idx, response
+    finally:
+        session.close()
+
+
+@metrics.timed('directions')
+def batch_process(df, ampm, **kwargs):
+    """
+    Query the Directions API for every row of an od_df dataset.
+    See iter_journeys for arguments.
 
-    with open(out_path, 'w') as out:
-        json.dump(full_results, out)
-        print('wrote to {}'.format(out_path))
+    Returns:
+        list: Directions API responses, one per row of df.
+    """
+    return [response for idx, response in iter_journeys(df, ampm, **kwargs)]
+
+
+def snapping_accuracy(df, ampm, sample_size=100, seed=0, **kwargs):
+    """
+    Measure the accuracy cost of origin clustering by routing a sample of
+    snapped students (those who are not their cluster's representative)
+    exactly, and comparing against their representatives' results.
+    With a cache, representatives already routed by a clustered run are free.
+
+    Args:
+        df (pandas DataFrame): od_df dataset.
+        ampm (str): whether the journeys are 'am' or 'pm'
+        sample_size (int): number of snapped students to route exactly.
+        seed (int): random seed for the sample.
+        **kwargs: passed on to iter_journeys.
+
+    Returns:
+        dict: see origin_clusters.accuracy_report.
+    """
+    triaged = triage(df) if triage_rows else None
+    clusters = home_clusters(df, triaged)
+    snapped = clusters[clusters['snap_error_miles'] > 0]
+    snapped = snapped.sample(min(sample_size, len(snapped)), random_state=seed)
+    rows = df.loc[snapped.index.union(snapped['representative'])]
+    routed = dict(iter_journeys(rows, ampm, use_triage=False, use_clusters=False, **kwargs))
+    exact = pd.DataFrame([postprocess_journeys.extract_properties(routed[idx])
+                          for idx in snapped.index],
+                         columns=list(postprocess_journeys.RECORD_FIELDS))
+    shared = pd.DataFrame([postprocess_journeys.extract_properties(routed[idx])
+                           for idx in snapped['representative']],
+                          columns=list(postprocess_journeys.RECORD_FIELDS))
+    return origin_clusters.accuracy_report(exact, shared, snapped['snap_error_miles'])
+
+
+@metrics.timed('directions')
+def write_journeys(df, ampm, path, resume=False, **kwargs):
+    """
+    Query the Directions API for an od_df dataset and stream the responses
+    to a JSONL file (see journey_store), so memory use stays flat and
+    an interrupted run can be resumed.
+
+    Args:
+        df (pandas DataFrame): od_df dataset.
+        ampm (str): whether the journeys are 'am' or 'pm'
+        path (str): JSONL file to write to.
+        resume (bool): skip rows already in path and append the rest.
+        **kwargs: passed on to iter_journeys.
+
+    Returns:
+        int: number of responses written.
+    """
+    done = journey_store.completed_rows(path) if resume else set()
+    if done:
+        print('Resuming: {} rows already in {}'.format(len(done), path))
+    total = len(df) - len(done)
+    start = time.perf_counter()
+    with journey_store.JourneyWriter(path, append=resume) as writer:
+        for idx, response in iter_journeys(df, ampm, skip_rows=done, **kwargs):
+            writer.write(idx, response)
+            if progress_every and writer.count % progress_every == 0:
+                seconds = time.perf_counter() - start
+                print('{}: {} of {} rows in {:.0f}s ({:.1f} rows/s)'.format(
+                    path, writer.count, total, seconds, writer.count / seconds))
+    return writer.count
+
+
+def read_od(path):
+    """
+    Read the od_columns of an od table (see od_store.read_table).
+    """
+    return od_store.read_table(path, columns=od_columns)
+
+
+def main():
+    od = read_od(od_path)
+    cache = response_cache.ResponseCache(cache_path,
+                                         max_age_days=cache_max_age_days,
+                                         offline=offline)
+    try:
+        count = write_journeys(od, ampm, out_path, resume=resume, cache=cache)
+        print('wrote {} journeys to {}'.format(count, out_path))
+    finally:
+        print(cache.stats())
+        cache.close()
+        metrics.report()
 
 
 if __name__ == '__main__':
@@ -1,11 +1,30 @@
+import hashlib
 import json
 import os
+from datetime import datetime
+from urllib.parse import urlparse
 import requests
 import pandas as pd
+import api_utils
+import metrics
+import otp_routers
+import response_cache
+import start_otp
 
 # MODIFY THESE FOR BATCH PROCESSING
-school_list = 'outputs/geocoded_indy_schools.csv'
-router = 'indy2'
+# city -> school list. Router names come from otp_routers.routers,
+# and all the cities are served from one OTP server
+school_lists = {'indy': 'outputs/geocoded_indy_schools.csv'}
+max_workers = 4  # number of isochrone requests OTP works on at once
+
+# OpenTripPlanner server
+otp_url = 'http://localhost:{}'.format(start_otp.default_port)
+manage_server = True  # start OTP for the batch run (or reuse a running one) and stop it after
+otp_graphs_dir = 'otp/graphs'  # used to fingerprint each router's graph
+
+# isochrone cache -- entries are tied to the router graph they came from
+iso_cache_path = 'temp/isochrone_cache.sqlite'
+manifest_name = 'isochrone_manifest.json'
 
 # variables to run single process
 school = '31.7704619,-106.4687935'
@@ -15,40 +34,15 @@ ampm = triptime[-2:]
 file_name = 'outputs/{}/isos_{}.geojson'.format(city, triptime.replace(':', ''))
 
 
-def query_otp(coords, city, triptime, cutoffs=[30, 45, 60, 75, 90], 
-              maxwalkdist=None, ampm='am', test_mode=True):
+def otp_params(coords, triptime, cutoffs=[30, 45, 60, 75, 90], 
+               maxwalkdist=None, ampm='am'):
     """
-    Makes a call to a running OpenTripPlanner instance for transit isochrones.
-    More parameters are available than are included here. 
-    See http://dev.opentripplanner.org/apidoc/1.4.0/resource_LIsochrone.html for all options.
-    
-    Args:
-        coords (str): Coordinate pair to generate isochrone from, in lat, lon format.
-        city (str): Name of the city/router for OTP use. 
-            Assumes an OTP instance is running locally on port 8080 (the OTP default) with the given city name.
-        triptime (str): Time to pass to API. Expected format examples: '7:30am', '4:00pm'.
-            For PM trips this value will be used as the departure time.
-            For AM trips this value will be used as the arrive by time.
-        cutoffs (int or list of ints): Isochrone cutoff values in minutes.
-            To generate isochrones for several time cutoffs, pass a list.
-            Defaults to [30, 45, 60, 75, 90].
-        maxwalkdist (float): Maximum allowable walking distance, in miles. 
-            Defaults to None -- no limit on walk distance will be imposed.
-        ampm (str): Whether to query for AM or PM trips. 
-            Accepted values: ('am', 'pm').
-        test_mode (bool): Whether to call the function in test mode. 
-            If True, the API will not be called. Parameters and endpoint URL will be returned instead.
-            Defaults to True.
+    Build the OpenTripPlanner isochrone request parameters.
+    See query_otp for arguments.
 
     Returns:
-        (if test_mode == False)
-            json: JSON isochrone results.
-        (if test_mode == True)
-            str: fully-formed API URL.
-            params: parameters passed to OpenTripPlanner.
+        dict: parameters to pass to OpenTripPlanner.
     """
-    api = 'http://localhost:8080/otp/routers/{}/isochrone'.format(city)
-    header = {'Accept' : 'application/json'}
     cutoffs = [i * 60 for i in cutoffs]
 
     # PARAMETERS TO PASS TO OTP
@@ -77,24 +71,204 @@ def query_otp(coords, city, triptime, cutoffs=[30, 45, 60, 75, 90],
     elif ampm == 'pm':
         params['arriveBy'] = False
 
+    return params
+
+
+def query_otp(coords, city, triptime, cutoffs=[30, 45, 60, 75, 90], 
+              maxwalkdist=None, ampm='am', test_mode=True, session=None):
+    """
+    Makes a call to a running OpenTripPlanner instance for transit isochrones.
+    More parameters are available than are included here. 
+    See http://dev.opentripplanner.org/apidoc/1.4.0/resource_LIsochrone.html for all options.
+    
+    Args:
+        coords (str): Coordinate pair to generate isochrone from, in lat, lon format.
+        city (str): Name of the city/router for OTP use. 
+            Assumes an OTP instance is running locally on port 8080 (the OTP default) with the given city name.
+        triptime (str): Time to pass to API. Expected format examples: '7:30am', '4:00pm'.
+            For PM trips this value will be used as the departure time.
+            For AM trips this value will be used as the arrive by time.
+        cutoffs (int or list of ints): Isochrone cutoff values in minutes.
+            To generate isochrones for several time cutoffs, pass a list.
+            Defaults to [30, 45, 60, 75, 90].
+        maxwalkdist (float): Maximum allowable walking distance, in miles. 
+            Defaults to None -- no limit on walk distance will be imposed.
+        ampm (str): Whether to query for AM or PM trips. 
+            Accepted values: ('am', 'pm').
+        test_mode (bool): Whether to call the function in test mode. 
+            If True, the API will not be called. Parameters and endpoint URL will be returned instead.
+            Defaults to True.
+        session (requests.Session, optional): session to reuse connections from.
+
+    Returns:
+        (if test_mode == False)
+            json: JSON isochrone results, or None if the request failed.
+        (if test_mode == True)
+            str: fully-formed API URL.
+            params: parameters passed to OpenTripPlanner.
+    """
+    api = '{}/otp/routers/{}/isochrone'.format(otp_url, city)
+    header = {'Accept' : 'application/json'}
+    params = otp_params(coords, triptime, cutoffs, maxwalkdist, ampm)
+
     # debugging mode: return api endpoint and params    
     if test_mode:
-        print(api)
-        print(params)
         return api, params
 
     # request mode    
-    r = requests.get(api, headers=header, params=params)
+    try:
+        r = api_utils.get_with_retry(api, params=params, headers=header,
+                                     session=session, max_retries=3, timeout=300,
+                                     label='otp_isochrone')
+    except requests.RequestException as e:
+        print('{} {} failed: {}'.format(coords, triptime, e))
+        return None
     if r.status_code == 200:
         return r.json()
 
 
-def batch_process(locations, city='indy2'):
+def clean_name(name):
+    return name.replace(' ', '_')\
+               .replace('@', 'at')\
+               .replace('.', '')\
+               .replace('/', '_')\
+               .replace('\\', '_')\
+               .lower()
+
+
+def router_fingerprint(city):
+    """
+    Identify the graph a router is serving, so cached isochrones can be
+    invalidated when the graph is rebuilt (e.g. for a new GTFS feed).
+
+    Uses the hash of the inputs the graph was built from (see otp_routers),
+    else the size and modification time of the router's Graph.obj if it is
+    in otp_graphs_dir, otherwise the router metadata reported by the server.
+
+    Returns:
+        str: fingerprint of the router's graph.
+    """
+    graph_file = os.path.join(otp_graphs_dir, city, 'Graph.obj')
+    build_file = os.path.join(otp_graphs_dir, city, otp_routers.build_manifest_name)
+    if os.path.exists(graph_file) and os.path.exists(build_file):
+        with open(build_file) as f:
+            fingerprint = 'inputs:' + json.load(f)['input_hash']
+    elif os.path.exists(graph_file):
+        stat = os.stat(graph_file)
+        fingerprint = 'graph:{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+    else:
+        r = requests.get('{}/otp/routers/{}'.format(otp_url, city),
+                         headers={'Accept': 'application/json'}, timeout=60)
+        r.raise_for_status()
+        fingerprint = 'server:' + hashlib.sha256(r.content).hexdigest()
+    return fingerprint
+
+
+def load_manifest(city):
+    path = os.path.join('outputs', city, manifest_name)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(city, manifest):
+    path = os.path.join('outputs', city, manifest_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def make_jobs(locations, city):
+    """
+    List the isochrone requests needed for every school in a locations file.
+
+    Args:
+        locations (str): path to csv for locations to use. See batch_process.
+        city (str): name of the OpenTripPlanner router to use.
+
+    Returns:
+        list: dicts with the school name, ampm, coordinates, trip time
+            and output file of each request.
+    """
+    all_schools = pd.read_csv(locations)
+    # get only schools that have session times
+    all_schools = all_schools[all_schools['am_latest_arr'].notnull()]
+
+    jobs = []
+    for idx, row in all_schools.iterrows():
+        school_name = clean_name(row['school_name'])
+        coordinates = '{lat},{lon}'.format(lat=row['school_lat'], 
+                                           lon=row['school_lon'])
+        for ampm, col in (('am', 'am_latest_arr'), ('pm', 'pm_earliest_dep')):
+            triptime = row[col].replace(' ', '').lower()
+            out_file = 'outputs/{}/{}/isos_{}_jun17.geojson'.format(city, 
+                                                                  school_name, 
+                                                                  triptime.replace(':', ''))
+            jobs.append({'school_name': school_name,
+                         'ampm': ampm,
+                         'coords': coordinates,
+                         'triptime': triptime,
+                         'maxwalkdist': 1.5,
+                         'out_file': out_file})
+    return jobs
+
+
+def run_job(job, city, session=None, cache=None):
+    """
+    Request one school's isochrones and write them to job['out_file'].
+
+    Args:
+        job (dict): a request from make_jobs.
+        city (str): name of the OpenTripPlanner router to use.
+        session (requests.Session, optional): session to reuse connections from.
+        cache (response_cache.ResponseCache, optional): isochrone cache.
+            Looked up with job['key'] before calling OTP.
+
+    Returns:
+        bool: whether the isochrones were written.
+    """
+    isos = cache.get(job['key']) if cache is not None else None
+    if isos is None:
+        isos = query_otp(job['coords'], 
+                         city=city, 
+                         triptime=job['triptime'], 
+                         ampm=job['ampm'],
+                         maxwalkdist=job['maxwalkdist'],
+                         test_mode=False,
+                         session=session)
+        if isos is not None and cache is not None:
+            cache.put(job['key'], isos)
+    if isos is None:
+        print('No {} isochrones for {}'.format(job['ampm'], job['school_name']))
+        return False
+    isos['name'] = '{}_{}_isochrones'.format(job['school_name'], job['ampm'])
+    for f in isos['features']:
+        f['properties']['time'] = f['properties']['time']/60
+    os.makedirs(os.path.dirname(job['out_file']), exist_ok=True)
+    with open(job['out_file'], 'w') as out:
+        json.dump(isos, out)
+    metrics.inc('bytes_written', os.path.getsize(job['out_file']), output='isochrones')
+    return True
+
+
+@metrics.timed('isochrones')
+def batch_process(locations, city, workers=None, use_cache=True):
     """
     Process several school locations using the same OpenTripPlanner router.
     Function will create an AM isochrone and PM isochrone file for each school.
-    Files will be saved
+    Files will be saved in outputs/[city]/[school name]/
     
+    Requests are sent concurrently over a pooled session, with at most
+    `workers` requests in flight so a local OTP server is not swamped.
+    Schools whose requests fail are reported and skipped.
+
+    With use_cache, each request is keyed on the router's graph fingerprint
+    and its full OTP parameters. Outputs whose key matches the one recorded in
+    outputs/[city]/isochrone_manifest.json are left alone, and other requests
+    are served from the isochrone cache when possible, so only schools whose
+    inputs changed (or all of them, after a graph rebuild) hit OTP.
+
     Args:
         locations (str): path to csv for locations to use.
             Function will process all records with an am_latest_arr time.
@@ -103,74 +277,68 @@ def batch_process(locations, city='indy2'):
               pm_earliest_dep
               school_lat
               school_lon
-              campus: school name
+              school_name
         city (str): name of the OpenTripPlanner router to use.
+        workers (int, optional): number of concurrent requests.
+            Defaults to max_workers.
+        use_cache (bool): skip unchanged outputs and reuse cached isochrones.
 
     Returns:
-        None
+        list: jobs (see make_jobs) whose isochrones could not be made.
     
     """
-    all_schools = pd.read_csv(locations)
-    # get only schools that have session times
-    all_schools = all_schools[all_schools['am_latest_arr'].notnull()]
+    workers = workers or max_workers
+    jobs = make_jobs(locations, city)
+    cache = None
+    manifest = {}
+    if use_cache:
+        fingerprint = router_fingerprint(city)
+        cache = response_cache.ResponseCache(iso_cache_path, namespace='isochrones')
+        manifest = load_manifest(city)
+    for job in jobs:
+        job['params'] = otp_params(job['coords'], job['triptime'],
+                                   maxwalkdist=job['maxwalkdist'], ampm=job['ampm'])
+        if use_cache:
+            job['key'] = response_cache.make_key({'router': city,
+                                                  'fingerprint': fingerprint,
+                                                  'params': job['params']})
 
-    for idx, row in all_schools.iterrows():
-        # make a school-specific directory
-        school_name = row['school_name'].replace(' ', '_')\
-                                        .replace('@', 'at')\
-                                        .replace('.', '')\
-                                        .replace('/', '_')\
-                                        .replace('\\', '_')\
-                                        .lower()
-        os.makedirs('outputs/{}/{}'.format(city, school_name), exist_ok=True)
-
-        # get details for API call
-        coordinates = '{lat},{lon}'.format(lat=row['school_lat'], 
-                                           lon=row['school_lon'])
-        am_time = row['am_latest_arr'].replace(' ', '').lower()
-        pm_time = row['pm_earliest_dep'].replace(' ', '').lower()
-
-        # format output paths
-        am_out_file = '''outputs/{}/{}/isos_{}_jun17.geojson'''.format(city, 
-                                                                school_name, 
-                                                                am_time.replace(':', ''))
-        
-        pm_out_file = '''outputs/{}/{}/isos_{}_jun17.geojson'''.format(city, 
-                                                                school_name, 
-                                                                pm_time.replace(':', ''))
-        
-        # query and write am isochrones
-        am = query_otp(coordinates, 
-                       city=city, 
-                       triptime=am_time, 
-                       ampm='am',
-                       maxwalkdist=1.5,
-                       test_mode=False)
-        am['name'] = '{}_am_isochrones'.format(school_name)
-        for f in am['features']:
-            f['properties']['time'] = f['properties']['time']/60
-        with open(am_out_file, 'w') as am_out:
-            json.dump(am, am_out)
-
-        # query and write pm isochrones
-        pm = query_otp(coordinates, 
-                       city=city, 
-                       triptime=pm_time, 
-                       ampm='pm',
-                       maxwalkdist=1.5,
-                       test_mode=False)
-        pm['name'] = '{}_pm_isochrones'.format(school_name)
-        for f in pm['features']:
-            f['properties']['time'] = f['properties']['time']/60
-        with open(pm_out_file, 'w') as pm_out:
-            json.dump(pm, pm_out)
-
-        print('Made isochrones for {}'.format(school_name))
+    # outputs produced by exactly this request and graph don't need regenerating
+    todo = [job for job in jobs
+            if not (use_cache
+                    and manifest.get(job['out_file'], {}).get('key') == job['key']
+                    and os.path.exists(job['out_file']))]
+    print('{} of {} isochrone files to regenerate'.format(len(todo), len(jobs)))
+    session = api_utils.make_session(workers)
+
+    def run(job):
+        return job, run_job(job, city, session, cache)
+
+    failed = []
+    for job, ok in api_utils.map_ordered(run, todo, max_workers=workers,
+                                         max_in_flight=workers):
+        if ok:
+            print('Made {} isochrones for {}'.format(job['ampm'], job['school_name']))
+            if use_cache:
+                manifest[job['out_file']] = {'router': city,
+                                             'fingerprint': fingerprint,
+                                             'params': job['params'],
+                                             'key': job['key'],
+                                             'generated': datetime.now().isoformat(timespec='seconds')}
+        else:
+            failed.append(job)
+    session.close()
+    if use_cache:
+        save_manifest(city, manifest)
+        print(cache.stats())
+        cache.close()
+    print('{} of {} isochrone requests failed'.format(len(failed), len(jobs)))
+    return failed
 
 
 def single_process():
     ans = query_otp(school, 
-                    city=city,
+                    city=otp_routers.router_name(city),
                     triptime=triptime, 
                     cutoffs=[30, 45, 60, 75, 90],
                     ampm=ampm,
@@ -182,5 +350,23 @@ def single_process():
         print('Wrote file {}'.format(file_name))
 
 
-batch_process(school_list, router)
-#single_process()
\ No newline at end of file
+def main():
+    batch = {otp_routers.router_name(c): locations for c, locations in school_lists.items()}
+    if not manage_server:
+        for router, locations in batch.items():
+            batch_process(locations, router)
+        metrics.report()
+        return
+    # rebuild only graphs whose inputs changed, then serve every router at once
+    otp_routers.ensure_graphs(list(batch))
+    with start_otp.OTPServer(list(batch), port=urlparse(otp_url).port) as server:
+        server.warm_up()
+        for router, locations in batch.items():
+            batch_process(locations, router)
+        print(server.timings)
+    metrics.report()
+
+
+if __name__ == '__main__':
+    main()
+    #single_process()
\ No newline at end of file
@@ -0,0 +1,150 @@
+# Vectorized geometry helpers
+# Decodes many Google encoded polylines at once into flat NumPy arrays,
+# packs those arrays into WKB without building per-point Python objects,
+# computes distances between many points at once, and simplifies lines
+
+import numpy as np
+
+
+def decode_polylines(encoded, precision=5):
+    """
+    Decode many Google encoded polylines in one vectorized pass.
+
+    Args:
+        encoded (list of str): encoded polylines, e.g. each route's
+            overview_polyline['points']. Empty strings decode to empty lines.
+        precision (int): number of decimal places encoded. Google uses 5.
+
+    Returns:
+        tuple:
+            numpy array: (n_points, 2) float64 array of (lon, lat) pairs
+                for all lines, one after another.
+            numpy array: int64 offsets of length len(encoded) + 1.
+                Line i is coords[offsets[i]:offsets[i + 1]].
+    """
+    lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+    char_offsets = np.concatenate([[0], np.cumsum(lengths)])
+    raw = np.frombuffer(''.join(encoded).encode('ascii'), dtype=np.uint8)
+    chars = raw.astype(np.int64) - 63
+
+    # each value is a run of 5-bit chunks; a chunk without the 0x20 bit ends it
+    ends = np.flatnonzero((chars & 0x20) == 0)
+    starts = np.concatenate([[0], ends + 1])[:len(ends)]
+    value_id = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = 5 * (np.arange(len(chars)) - starts[value_id])
+    values = np.bincount(value_id, weights=(chars & 0x1f) << shift,
+                         minlength=len(ends)).astype(np.int64)
+    # undo zigzag encoding of negative numbers
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+
+    # values alternate lat, lon deltas; every line holds an even number of them
+    values_per_line = (np.searchsorted(ends, char_offsets[1:])
+                       - np.searchsorted(ends, char_offsets[:-1]))
+    offsets = np.concatenate([[0], np.cumsum(values_per_line // 2)])
+    lat = np.cumsum(deltas[0::2])
+    lon = np.cumsum(deltas[1::2])
+    # restart the running sums at the first point of every line
+    npts = np.diff(offsets)
+    line_starts = offsets[:-1][npts > 0]
+    lat -= np.repeat(np.concatenate([[0], lat])[line_starts], npts[npts > 0])
+    lon -= np.repeat(np.concatenate([[0], lon])[line_starts], npts[npts > 0])
+
+    coords = np.column_stack([lon, lat]) / 10 ** precision
+    return coords, offsets
+
+
+def linestrings_to_wkb(coords, offsets):
+    """
+    Pack flat coordinate and offset arrays into little-endian WKB LineStrings.
+
+    Args:
+        coords (numpy array): (n_points, 2) float64 coordinates.
+        offsets (numpy array): line offsets into coords, as from decode_polylines.
+
+    Returns:
+        tuple:
+            numpy array: uint8 buffer holding every WKB geometry back to back.
+            numpy array: int64 byte offsets of length len(offsets),
+                geometry i is buffer[wkb_offsets[i]:wkb_offsets[i + 1]].
+    """
+    npts = np.diff(offsets)
+    sizes = 9 + 16 * npts
+    wkb_offsets = np.concatenate([[0], np.cumsum(sizes)])
+    out = np.empty(wkb_offsets[-1], dtype=np.uint8)
+
+    # 1 byte order flag, uint32 geometry type (2 = LineString), uint32 point count
+    header = np.zeros((len(npts), 9), dtype=np.uint8)
+    header[:, 0] = 1
+    header[:, 1:5] = np.array([2], dtype='<u4').view(np.uint8)
+    header[:, 5:9] = npts.astype('<u4').view(np.uint8).reshape(-1, 4)
+    out[wkb_offsets[:-1, None] + np.arange(9)] = header
+
+    point_bytes = np.ascontiguousarray(coords, dtype='<f8').view(np.uint8).reshape(-1, 16)
+    point_pos = (np.repeat(wkb_offsets[:-1] + 9 - 16 * offsets[:-1], npts)
+                 + 16 * np.arange(len(coords)))
+    out[point_pos[:, None] + np.arange(16)] = point_bytes
+    return out, wkb_offsets
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in meters. Arguments can be scalars or
+    NumPy arrays, and broadcast against each other.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64))
+                              for a in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(a))
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in miles. See haversine_m.
+    """
+    return haversine_m(lat1, lon1, lat2, lon2) * 0.00062137
+
+
+def simplify_line(coords, tolerance):
+    """
+    Simplify a line or ring with the Douglas-Peucker algorithm.
+    Distances are measured on a local flat projection, which is
+    accurate enough at city scale.
+
+    Args:
+        coords (numpy array): (n_points, 2) array of (lon, lat) pairs.
+        tolerance (float): largest distance in meters a removed point
+            may be from the simplified line.
+
+    Returns:
+        numpy array: the points kept, always including the first and last.
+    """
+    n = len(coords)
+    if n < 3 or not tolerance:
+        return coords
+    meters_per_degree = 111320.0
+    xy = np.column_stack([coords[:, 0] * np.cos(np.radians(coords[:, 1].mean())),
+                          coords[:, 1]]) * meters_per_degree
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        start = xy[i]
+        direction = xy[j] - start
+        rel = xy[i + 1:j] - start
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            # closed ring: measure from the shared start and end point
+            dist = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            dist = np.abs(direction[0] * rel[:, 1] - direction[1] * rel[:, 0]) / length
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance:
+            split = i + 1 + k
+            keep[split] = True
+            stack.append((i, split))
+            stack.append((split, j))
+    return coords[keep]
@@ -2,9 +2,14 @@
 # This script preps files for create_od_records and gen_transit_isochrones
 
 import configparser
+import os
 import pandas as pd
 import requests
 import re
+import api_utils
+import metrics
+import od_store
+import response_cache
 
 # change these as needed before running the script
 school = ''  # if no school identifier exists
@@ -12,6 +17,13 @@ school_address_path = 'inputs/indy/indy_schools.csv'
 school_out_path = 'outputs/geocoded_indy_schools.csv'
 student_address_path = 'inputs/indy/ips_data/IPS Fall 2020-2021 HS.xlsx'
 student_out_path = 'temp/indy/hs_walking/more_geocoded_students.csv'
+student_out_dir = 'temp/indy'  # where process_indy_students writes per-school files
+
+# 'parquet' writes the per-school student files as a dataset partitioned by
+# school in [student_out_dir]/[od_store.student_dataset], 'csv' as
+# [code]_[school]_geocoded_students.csv files
+student_format = 'parquet'
+student_dictionary_columns = ['stu_sch_code', 'sch_name']  # repeated for every student of a school
 
 # Google Geocoder API Parameters
 g_api = 'https://maps.googleapis.com/maps/api/geocode/json'
@@ -20,6 +32,11 @@ config.read('config.ini')
 gkey = config['auth']['gkey']
 gparams = {'key': gkey}
 
+# geocoding concurrency and cache settings
+max_workers = 8  # number of simultaneous requests
+max_qps = 25  # maximum requests per second across all workers
+geocode_cache_path = 'temp/geocode_cache.sqlite'
+
 
 def consolidate_addresses(df):
     """
@@ -64,48 +81,207 @@ def rename_school_cols(df):
     return schools
 
 
-def google_geocode_address(addy):
-    ans = (None, None)
-    gparams['address'] = addy
-    r = requests.get(g_api, params=gparams)
+def normalize_address(addy):
+    """
+    Normalize an address string so trivially different spellings
+    (case, extra spaces, periods, spacing around commas) match.
+    """
+    addy = str(addy).upper().replace('.', '')
+    addy = re.sub(r'\s*,\s*', ', ', addy)
+    return ' '.join(addy.split())
+
+
+def retryable_status(r):
+    """
+    Google reports quota problems with a 200 and an OVER_QUERY_LIMIT status,
+    and server errors with UNKNOWN_ERROR, which may succeed on a retry.
+    Returns the status so api_utils.get_with_retry backs off on it.
+    """
     if r.status_code == 200:
-        data = r.json()
-        results = data['results']
-        if len(results) > 0:
-            coords = results[0]['geometry']['location']
-            ans = (coords['lng'], coords['lat'])
+        status = r.json().get('status')
+        if status in ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'):
+            return status
+    return None
+
+
+def google_geocode_address(addy, session=None, bucket=None):
+    """
+    Geocode one address with the Google Geocoding API.
+    Does not modify any shared state, so it is safe to call from several threads.
+
+    Args:
+        addy (str): address to geocode.
+        session (requests.Session, optional): session to reuse connections from.
+        bucket (api_utils.TokenBucket, optional): rate limiter shared by all workers.
+
+    Returns:
+        tuple: (lon, lat), or (None, None) if the address could not be geocoded.
+            Failures other than ZERO_RESULTS are counted in metrics as
+            geocode_failures.
+
+    Raises:
+        RuntimeError: if Google is still over the query limit after retrying,
+            or denies the request (e.g. a bad key), since every other
+            address would fail the same way.
+    """
+    ans = (None, None)
+    params = dict(gparams, address=addy)
+    try:
+        r = api_utils.get_with_retry(g_api, params=params, session=session, bucket=bucket,
+                                     is_retryable=retryable_status, label='geocode')
+    except requests.RequestException as e:
+        metrics.inc('geocode_failures', status=type(e).__name__)
+        return ans
+    if r.status_code != 200:
+        metrics.inc('geocode_failures', status=r.status_code)
+        return ans
+    data = r.json()
+    status = data.get('status')
+    if status in ('OVER_QUERY_LIMIT', 'REQUEST_DENIED'):
+        raise RuntimeError('Geocoding {} failed with {}: {}'.format(
+            addy, status, data.get('error_message', '')))
+    if status == 'OK' and len(data['results']) > 0:
+        coords = data['results'][0]['geometry']['location']
+        ans = (coords['lng'], coords['lat'])
+    elif status != 'ZERO_RESULTS':
+        metrics.inc('geocode_failures', status=status)
     return ans
 
 
-def batch_geocode(df, address_field):
-    results = []
-    for idx, row in df.iterrows():
-        print(idx)
-        results.append(google_geocode_address(row[address_field]))
+def geocode_unique(addresses, cache=None, workers=None, qps=None):
+    """
+    Geocode a collection of addresses, sending each distinct normalized
+    address to the API at most once.
+
+    Args:
+        addresses (iterable): address strings.
+        cache (response_cache.ResponseCache, optional): persistent geocode cache.
+            Successful results are stored in it for future runs.
+        workers (int, optional): number of concurrent requests.
+            Defaults to max_workers.
+        qps (float, optional): requests per second limit. Defaults to max_qps.
+
+    Returns:
+        dict: normalized address -> (lon, lat)
+
+    Raises:
+        RuntimeError: see google_geocode_address. Addresses geocoded
+            before the error are already in the cache.
+    """
+    unique = {normalize_address(a): a for a in addresses if pd.notnull(a)}
+    coords = {}
+    to_query = []
+    for norm, addy in unique.items():
+        cached = cache.get(response_cache.make_key(norm)) if cache is not None else None
+        if cached is not None:
+            coords[norm] = tuple(cached)
+        else:
+            to_query.append((norm, addy))
+    print('{} distinct addresses, {} to geocode'.format(len(unique), len(to_query)))
+
+    workers = workers or max_workers
+    bucket = api_utils.TokenBucket(qps or max_qps)
+    session = api_utils.make_session(workers)
+
+    def geocode(item):
+        norm, addy = item
+        return norm, google_geocode_address(addy, session=session, bucket=bucket)
+
+    try:
+        # only found addresses are cached, so failed ones are retried next run
+        for norm, result in api_utils.map_ordered(geocode, to_query, max_workers=workers):
+            coords[norm] = result
+            if cache is not None and result[0] is not None:
+                cache.put(response_cache.make_key(norm), list(result))
+    finally:
+        session.close()
+    if cache is not None:
+        print(cache.stats())
+    return coords
+
+
+@metrics.timed('batch_geocode')
+def batch_geocode(df, address_field, cache=None, workers=None, qps=None):
+    """
+    Geocode every row of a data frame, adding lat and lon columns.
+    Rows sharing an address (e.g. siblings) are only geocoded once.
+
+    Args:
+        df (pandas DataFrame): data to geocode.
+        address_field (str): column containing the addresses.
+        cache (response_cache.ResponseCache, optional): persistent geocode cache.
+        workers (int, optional): number of concurrent requests.
+        qps (float, optional): requests per second limit.
+
+    Returns:
+        pandas DataFrame: df with lat and lon columns added.
+    """
+    coords = geocode_unique(df[address_field], cache=cache, workers=workers, qps=qps)
+    results = [coords.get(normalize_address(a), (None, None)) if pd.notnull(a) else (None, None)
+               for a in df[address_field]]
 
-    lons = pd.Series([i[0] for i in results], name='lon')
-    lats = pd.Series([j[1] for j in results], name='lat')
+    lons = pd.Series([i[0] for i in results], name='lon', index=df.index)
+    lats = pd.Series([j[1] for j in results], name='lat', index=df.index)
     geocoded_df = pd.concat([df, lats, lons], axis=1)
     return geocoded_df
 
 
-def process_indy_students():
+def read_student_file(path, cache_dir=student_out_dir):
+    """
+    Read a district student file, keeping a pickled copy in cache_dir.
+    Reading Excel is slow, so later runs read the pickle instead
+    as long as it is newer than the source file.
+
+    Args:
+        path (str): Excel (or csv) student file.
+        cache_dir (str): folder to keep the fast-format copy in.
+
+    Returns:
+        pandas DataFrame: the student data.
+    """
+    cache_path = os.path.join(cache_dir, os.path.basename(path) + '.pkl')
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        print('Reading cached copy {}'.format(cache_path))
+        return pd.read_pickle(cache_path)
+    if path.endswith('.csv'):
+        data = pd.read_csv(path)
+    else:
+        data = pd.read_excel(path, sheet_name=0)
+    os.makedirs(cache_dir, exist_ok=True)
+    data.to_pickle(cache_path)
+    return data
+
+
+def process_indy_students(geocode=True, out_dir=student_out_dir, path=None):
     """different workflow for indianapolis student file.
-    splits the district-wide file by school, geocodes, and saves as individual files.
+    reads the district-wide file once, geocodes each distinct address once,
+    then splits the data by school and saves individual files in one pass.
+
+    Args:
+        geocode (bool): whether to geocode home addresses.
+        out_dir (str): folder to write the per-school files to, in student_format.
+        path (str, optional): district student file. Defaults to student_address_path.
     """
-    data = pd.read_excel(student_address_path, sheet_name=0)
+    data = read_student_file(path or student_address_path)
     data = consolidate_addresses(data)
 
-    # split data frame by school code, geocode and write individual school datasets to file
-    dfs_by_school = [pd.DataFrame(y) for x, y in data.groupby('stu_sch_code', as_index=False)]
-    for df in dfs_by_school:
-        #df = batch_geocode(df, 'home_address')
-        school_name = list(df['sch_name'].unique())[0]
-        school_code = list(df['stu_sch_code'].unique())[0]
-        school_name = clean_school_name(str(school_name))
+    if geocode:
+        cache = response_cache.ResponseCache(geocode_cache_path, namespace='geocodes')
+        data = batch_geocode(data, 'home_address', cache=cache)
+        cache.close()
+
+    # write individual school datasets to file, one group at a time
+    for school_code, df in data.groupby('stu_sch_code', sort=False):
+        school_name = clean_school_name(str(df['sch_name'].iloc[0]))
         print(school_name)
-        file_name = 'temp/indy/{}_{}_geocoded_students.csv'.format(school_code, school_name)
-        df.to_csv(file_name, index=False)
+        school = '{}_{}'.format(school_code, school_name)
+        if student_format == 'parquet':
+            file_name = od_store.write_partition(df, os.path.join(out_dir, od_store.student_dataset), school,
+                                                 dictionary_columns=student_dictionary_columns)
+        else:
+            file_name = os.path.join(out_dir, '{}_geocoded_students.csv'.format(school))
+            df.to_csv(file_name, index=False)
+        metrics.inc('bytes_written', os.path.getsize(file_name), output='geocoded')
 
     print('done')
 
@@ -139,15 +315,19 @@ def process_file(address_df, address_field, out_path, call_api=True, cleaning_fu
         address_df = cleaning_func(address_df)
     
     # code to geocode the whole file
+    data = address_df
     if call_api:
-        data = batch_geocode(address_df, address_field)
+        cache = response_cache.ResponseCache(geocode_cache_path, namespace='geocodes')
+        data = batch_geocode(address_df, address_field, cache=cache)
+        cache.close()
     data.to_csv(out_path, index=False)
+    metrics.inc('bytes_written', os.path.getsize(out_path), output='geocoded')
     print('Wrote to {}'.format(out_path))
 
 
 def main():
     schools = pd.read_csv(school_address_path)
-    students = pd.read_excel(student_address_path, sheet_name=0)
+    students = read_student_file(student_address_path)
 
     process_file(schools, 
                  'school_address', 
@@ -158,6 +338,7 @@ def main():
                  student_out_path, 
                  call_api=False, 
                  cleaning_func=consolidate_addresses)
+    metrics.report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+# Append-only JSONL storage for raw Directions API responses
+# Each line is {"row": <od_df row index>, "response": <API response>}
+# Lines are written as soon as a response comes back, so a crash or Ctrl-C
+# only loses the rows that were in flight, and a re-run can resume
+
+import json
+import os
+import metrics
+
+
+def completed_rows(path):
+    """
+    Find the od_df row indices already written to a JSONL journey file.
+
+    A partially written last line (e.g. from a crash mid-write) is
+    truncated off the file so that appending can continue cleanly.
+    A record only counts once its newline is written, so a last line
+    without one is truncated too, even if it parses.
+
+    Args:
+        path (str): JSONL journey file.
+
+    Returns:
+        set: row indices present in the file. Empty if the file does not exist.
+    """
+    rows = set()
+    if not os.path.exists(path):
+        return rows
+    good_bytes = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                rows.add(json.loads(line)['row'])
+            except (ValueError, KeyError):
+                break
+            good_bytes += len(line)
+    if good_bytes < os.path.getsize(path):
+        print('Truncating partial record at end of {}'.format(path))
+        with open(path, 'r+b') as f:
+            f.truncate(good_bytes)
+    return rows
+
+
+class JourneyWriter:
+    """
+    Streaming writer for JSONL journey files.
+
+    Args:
+        path (str): file to write to.
+        append (bool): append to an existing file instead of overwriting it.
+        fsync_every (int): flush and fsync after this many records,
+            bounding how much work a crash can lose.
+    """
+    def __init__(self, path, append=False, fsync_every=100):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.count = 0
+        self.file = open(path, 'a' if append else 'w')
+
+    def write(self, row, response):
+        line = json.dumps({'row': row, 'response': response}) + '\n'
+        self.file.write(line)
+        metrics.inc('bytes_written', len(line), output='journeys')
+        self.count += 1
+        if self.count % self.fsync_every == 0:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_jsonl(path):
+    """
+    Iterate over a JSONL journey file written by JourneyWriter.
+
+    Yields:
+        dict: the envelope for each line, i.e. {'row': ..., 'response': ...}
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """
+    Incrementally parse a (legacy) file holding one big JSON array,
+    yielding one element at a time without loading the whole file.
+
+    Args:
+        path (str): JSON file whose top level is an array.
+        chunk_size (int): number of characters to read at a time.
+
+    Yields:
+        each element of the array.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buf = f.read(chunk_size).lstrip()
+        if not buf.startswith('['):
+            raise ValueError('{} does not contain a JSON array'.format(path))
+        pos = 1
+        eof = False
+        while True:
+            # skip whitespace and separators between elements
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                more = f.read(chunk_size)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield obj
+            pos = end
+            # drop consumed text so the buffer stays small
+            if pos > chunk_size:
+                buf = buf[pos:]
+                pos = 0
+
+
+def iter_responses(path):
+    """
+    Iterate over the raw Directions API responses in a journey file,
+    either JSONL (.jsonl, from JourneyWriter) or a legacy JSON array (.json).
+
+    Yields:
+        dict: a single Directions API response.
+    """
+    if path.endswith('.jsonl'):
+        for envelope in iter_jsonl(path):
+            yield envelope['response']
+    else:
+        yield from iter_json_array(path)
@@ -0,0 +1,228 @@
+# Shared instrumentation for the pipeline scripts
+# Records per-stage wall and CPU time, per-request API latencies,
+# request, retry and error counts, and bytes written to output files.
+# Results can be written as structured JSON log lines and as a
+# Prometheus text file, and stages can optionally be run under cProfile
+
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+# outputs -- set to a path to enable
+log_path = None  # JSON lines: one per finished stage, plus a summary from report()
+prometheus_path = None  # Prometheus text exposition format, rewritten by report()
+
+# profiling -- set to a folder to profile every stage with cProfile,
+# writing [stage].prof files (only the stage's own thread is profiled)
+profile_dir = None
+
+# latency percentiles to report
+percentiles = (50, 95, 99)
+
+
+class Metrics:
+    """
+    Thread-safe store of stage timings, request latencies and counters.
+    Scripts share the module-level instance through the functions below.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.latencies = {}
+            self.counters = {}
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add value to a counter, e.g. inc('requests', api='directions', status=200).
+        """
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, api, seconds):
+        """
+        Record the latency of one request to an API.
+        """
+        with self.lock:
+            self.latencies.setdefault(api, []).append(seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name, profile=None):
+        """
+        Time a block of work as a named stage. Stages with the same name
+        accumulate. CPU time is for the whole process, so it includes
+        worker threads.
+
+        Args:
+            name (str): stage name, e.g. 'batch_geocode'.
+            profile (bool, optional): run the stage under cProfile.
+                Defaults to whether profile_dir is set.
+        """
+        profile = profile_dir is not None if profile is None else profile
+        profiler = cProfile.Profile() if profile else None
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:
+                # a stage nested in a profiled stage is already covered
+                profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            with self.lock:
+                stats = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0,
+                                                      'cpu_seconds': 0.0})
+                stats['calls'] += 1
+                stats['wall_seconds'] += wall
+                stats['cpu_seconds'] += cpu
+            entry = {'stage': name, 'wall_seconds': round(wall, 3), 'cpu_seconds': round(cpu, 3)}
+            if profiler is not None:
+                os.makedirs(profile_dir or '.', exist_ok=True)
+                entry['profile'] = os.path.join(profile_dir or '.', '{}.prof'.format(name))
+                profiler.dump_stats(entry['profile'])
+            log('stage', **entry)
+
+    def timed(self, name):
+        """
+        Decorator that runs a function as a stage (see stage).
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """
+        Returns:
+            dict: stage timings, latency percentiles per API and counters.
+        """
+        with self.lock:
+            latencies = {api: np.array(values) for api, values in self.latencies.items()}
+            stages = {name: dict(stats) for name, stats in self.stages.items()}
+            counters = dict(self.counters)
+        for stats in stages.values():
+            stats['wall_seconds'] = round(stats['wall_seconds'], 3)
+            stats['cpu_seconds'] = round(stats['cpu_seconds'], 3)
+        apis = {}
+        for api, values in latencies.items():
+            apis[api] = {'requests': len(values),
+                         'mean_seconds': round(float(values.mean()), 4)}
+            for p in percentiles:
+                apis[api]['p{}_seconds'.format(p)] = round(float(np.percentile(values, p)), 4)
+        counts = {}
+        for (name, labels), value in sorted(counters.items()):
+            label_text = ','.join('{}={}'.format(k, v) for k, v in labels)
+            counts.setdefault(name, {})[label_text] = value
+        return {'stages': stages, 'latency': apis, 'counters': counts}
+
+    def prometheus_text(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        """
+        def fmt_labels(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                                  for k, v in labels) + '}'
+
+        with self.lock:
+            latencies = {api: np.array(values) for api, values in self.latencies.items()}
+            stages = {name: dict(stats) for name, stats in self.stages.items()}
+            counters = dict(self.counters)
+        lines = []
+        for metric in ('wall_seconds', 'cpu_seconds'):
+            lines.append('# TYPE pipeline_stage_{} counter'.format(metric))
+            for name, stats in sorted(stages.items()):
+                lines.append('pipeline_stage_{}{} {}'.format(
+                    metric, fmt_labels([('stage', name)]), stats[metric]))
+        lines.append('# TYPE pipeline_request_latency_seconds summary')
+        for api, values in sorted(latencies.items()):
+            for p in percentiles:
+                lines.append('pipeline_request_latency_seconds{} {}'.format(
+                    fmt_labels([('api', api), ('quantile', p / 100)]), np.percentile(values, p)))
+            lines.append('pipeline_request_latency_seconds_sum{} {}'.format(
+                fmt_labels([('api', api)]), values.sum()))
+            lines.append('pipeline_request_latency_seconds_count{} {}'.format(
+                fmt_labels([('api', api)]), len(values)))
+        names = sorted({name for name, labels in counters})
+        for name in names:
+            lines.append('# TYPE pipeline_{}_total counter'.format(name))
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append('pipeline_{}_total{} {}'.format(name, fmt_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+inc = metrics.inc
+observe = metrics.observe
+stage = metrics.stage
+timed = metrics.timed
+summary = metrics.summary
+reset = metrics.reset
+
+
+def log(event, **fields):
+    """
+    Append a structured JSON log line to log_path, if it is set.
+    """
+    if log_path is None:
+        return
+    entry = {'time': datetime.now().isoformat(timespec='milliseconds'), 'event': event}
+    entry.update(fields)
+    with metrics.lock:
+        with open(log_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+def write_prometheus(path):
+    """
+    Write the Prometheus text file atomically, so a collector never
+    reads a half-written file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(metrics.prometheus_text())
+    os.replace(tmp_path, path)
+
+
+def report():
+    """
+    Print a summary of everything recorded so far, log it, and write
+    the Prometheus file if prometheus_path is set.
+
+    Returns:
+        dict: see Metrics.summary.
+    """
+    result = summary()
+    for name, stats in result['stages'].items():
+        print('{}: {wall_seconds}s wall, {cpu_seconds}s CPU'.format(name, **stats))
+    for api, stats in result['latency'].items():
+        print('{} latency: '.format(api) + ', '.join(
+            '{} {}'.format(k, v) for k, v in stats.items()))
+    for name, values in result['counters'].items():
+        print('{}: {}'.format(name, values))
+    log('summary', **result)
+    if prometheus_path is not None:
+        write_prometheus(prometheus_path)
+    return result
@@ -0,0 +1,167 @@
+# Parquet storage for geocoded student and origin-destination tables
+# A table is a dataset partitioned by school, [root]/school=[school]/part-0.parquet,
+# written with an explicit schema: coordinates are floats, columns repeated
+# for every student of a school are dictionary-encoded, and everything else
+# is text, so wide, mostly empty student columns cost almost nothing.
+# Readers can pull just the columns they need. CSV files can still be read
+
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for parquet datasets
+    pa = None
+
+# columns stored as float64; every other column is text
+float_columns = ['lat', 'lon', 'home_lat', 'home_lon', 'school_lat', 'school_lon']
+
+part_name = 'part-0.parquet'
+
+# dataset folders, under the district's work folder
+student_dataset = 'geocoded_students'  # written by geocode_and_prep
+od_dataset = 'od'  # written by create_od_records
+
+
+def partition_path(root, school):
+    return os.path.join(root, 'school={}'.format(school), part_name)
+
+
+def partition_school(path):
+    """
+    The school a partition file or folder belongs to, or None if the
+    path is not in a school=[school] folder.
+    """
+    folder = os.path.basename(os.path.dirname(path) if path.endswith('.parquet') else path)
+    return folder[len('school='):] if folder.startswith('school=') else None
+
+
+def find_partitions(root):
+    """
+    Returns:
+        dict: school -> partition file, for every partition under root.
+    """
+    found = {}
+    if os.path.isdir(root):
+        for folder in sorted(os.listdir(root)):
+            path = os.path.join(root, folder, part_name)
+            school = partition_school(path)
+            if school is not None and os.path.exists(path):
+                found[school] = path
+    return found
+
+
+def table_schema(df, dictionary_columns=()):
+    """
+    Build the schema a table is stored with.
+
+    Args:
+        df (pandas DataFrame): the table.
+        dictionary_columns (list): text columns to dictionary-encode,
+            e.g. school fields repeated on every row.
+    """
+    fields = []
+    for col in df.columns:
+        if col in float_columns:
+            kind = pa.float64()
+        elif col in dictionary_columns:
+            kind = pa.dictionary(pa.int32(), pa.string())
+        else:
+            kind = pa.string()
+        fields.append(pa.field(str(col), kind))
+    return pa.schema(fields)
+
+
+def to_arrow(df, dictionary_columns=()):
+    """
+    Convert a table to a pyarrow Table with the schema from table_schema.
+    Text columns are stored as strings whatever their pandas dtype, so a
+    code like "007" read as text and 7 read as a number don't clash.
+    """
+    if pa is None:
+        raise ImportError('pyarrow is required to write parquet datasets')
+    schema = table_schema(df, dictionary_columns)
+    arrays = []
+    for field in schema:
+        values = df[field.name]
+        if pa.types.is_floating(field.type):
+            arrays.append(pa.array(pd.to_numeric(values, errors='coerce').to_numpy(dtype=float),
+                                   from_pandas=True))
+            continue
+        values = values.astype(object)
+        text = values.where(values.isna(), values.astype(str)).to_numpy()
+        array = pa.array(text, type=pa.string(), from_pandas=True)
+        if pa.types.is_dictionary(field.type):
+            array = array.dictionary_encode()
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_partition(df, root, school, dictionary_columns=()):
+    """
+    Write one school's rows as a partition of the dataset at root,
+    replacing the partition atomically.
+
+    Returns:
+        str: path of the partition file.
+    """
+    path = partition_path(root, school)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = to_arrow(df.reset_index(drop=True), dictionary_columns)
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def is_parquet(path):
+    return os.path.isdir(path) or path.endswith('.parquet')
+
+
+def read_table(path, columns=None, **kwargs):
+    """
+    Read a student or OD table, with only the given columns.
+
+    Args:
+        path (str): a csv file, a partition file or folder, or a dataset root.
+            A dataset root is read whole, with a categorical school column.
+        columns (list, optional): columns to read. Defaults to all.
+        **kwargs: passed on to pandas.read_csv for csv files, e.g. dtype=str.
+
+    Returns:
+        pandas DataFrame: rows in the order they were written.
+    """
+    if not is_parquet(path):
+        return pd.read_csv(path, usecols=columns, **kwargs)
+    if pa is None:
+        raise ImportError('pyarrow is required to read {}'.format(path))
+    if os.path.isdir(path) and partition_school(path) is None:
+        partitions = find_partitions(path)
+        frames = []
+        for school, part in partitions.items():
+            df = read_table(part, columns)
+            df.insert(0, 'school', school)
+            frames.append(df)
+        if not frames:
+            return pd.DataFrame(columns=['school'] + list(columns or []))
+        df = pd.concat(frames, ignore_index=True)
+        df['school'] = df['school'].astype(pd.CategoricalDtype(list(partitions)))
+        return df
+    if os.path.isdir(path):
+        path = os.path.join(path, part_name)
+    return pq.read_table(path, columns=columns).to_pandas()
+
+
+def text_table(df):
+    """
+    Turn every column except float_columns into plain text (object) columns,
+    with NaN for missing values, like pd.read_csv(..., dtype=str).
+    """
+    df = df.copy()
+    for col in df.columns:
+        if col not in float_columns:
+            values = df[col].astype(object)
+            df[col] = values.where(values.notna(), np.nan)
+    return df
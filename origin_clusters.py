@@ -0,0 +1,197 @@
+# Origin clustering for student journeys
+# Students on the same block or in the same apartment complex get the same
+# transit directions, so routing one representative home per cluster and
+# sharing its result cuts the number of routing requests on dense districts
+
+import numpy as np
+import pandas as pd
+
+import geo_utils
+
+# od_df columns that must match for two students to share a route
+group_columns = ['school_address', 'am_latest_arr', 'pm_earliest_dep', 'tz']
+
+
+def project(lat, lon, lat0):
+    """
+    Project lon/lat to local equirectangular meters around latitude lat0.
+
+    Returns:
+        tuple of numpy arrays: x and y in meters.
+    """
+    radius = 6371008.8
+    x = np.radians(lon) * np.cos(np.radians(lat0)) * radius
+    y = np.radians(lat) * radius
+    return x, y
+
+
+def grid_clusters(lat, lon, cell_meters):
+    """
+    Snap points to a square grid and label them by grid cell.
+
+    Args:
+        lat, lon (numpy array): point coordinates. Points with missing
+            coordinates get label -1.
+        cell_meters (float): grid cell size.
+
+    Returns:
+        numpy array: int64 cluster label for each point.
+    """
+    labels = np.full(len(lat), -1, dtype=np.int64)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    if not valid.any():
+        return labels
+    x, y = project(lat[valid], lon[valid], np.mean(lat[valid]))
+    cells = np.column_stack([np.floor(x / cell_meters), np.floor(y / cell_meters)])
+    labels[valid] = np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+    return labels
+
+
+def radius_clusters(lat, lon, radius_meters):
+    """
+    Greedy leader clustering: each point joins the first cluster whose
+    leader is within radius_meters of it, or starts a new cluster.
+    Leaders are looked up through a hash grid, so this is linear in
+    the number of points.
+
+    Args:
+        lat, lon (numpy array): point coordinates. Points with missing
+            coordinates get label -1.
+        radius_meters (float): largest distance from a point to its leader.
+
+    Returns:
+        numpy array: int64 cluster label for each point.
+    """
+    labels = np.full(len(lat), -1, dtype=np.int64)
+    valid = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    if not len(valid):
+        return labels
+    x, y = project(lat[valid], lon[valid], np.mean(lat[valid]))
+    cells = {}
+    leaders = []
+    for i, px, py in zip(valid, x, y):
+        cx, cy = int(px // radius_meters), int(py // radius_meters)
+        label = -1
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for leader in cells.get((cx + dx, cy + dy), ()):
+                    lx, ly = leaders[leader]
+                    if (px - lx) ** 2 + (py - ly) ** 2 <= radius_meters ** 2:
+                        label = leader
+                        break
+                if label >= 0:
+                    break
+            if label >= 0:
+                break
+        if label < 0:
+            label = len(leaders)
+            leaders.append((px, py))
+            cells.setdefault((cx, cy), []).append(label)
+        labels[i] = label
+    return labels
+
+
+def medoids(lat, lon, labels):
+    """
+    Find the member of each cluster closest to the cluster's centroid.
+
+    Args:
+        lat, lon (numpy array): point coordinates.
+        labels (numpy array): cluster labels from 0 to n_clusters - 1.
+
+    Returns:
+        numpy array: position of each cluster's medoid.
+    """
+    counts = np.bincount(labels)
+    centroid_lat = np.bincount(labels, weights=lat) / counts
+    centroid_lon = np.bincount(labels, weights=lon) / counts
+    dist = geo_utils.haversine_m(lat, lon, centroid_lat[labels], centroid_lon[labels])
+    # sort by cluster, then distance; the first point of each cluster is its medoid
+    order = np.lexsort([dist, labels])
+    first = np.concatenate([[True], labels[order][1:] != labels[order][:-1]])
+    return order[first]
+
+
+def cluster_origins(df, method='grid', meters=150):
+    """
+    Cluster od_df homes so each cluster can be routed once.
+
+    Homes only share a cluster if they also share a school and bell times
+    (see group_columns). Each cluster is represented by its medoid, the
+    member closest to the cluster centroid, so the routed origin is always
+    a real student address. Rows with missing coordinates are left as
+    clusters of one.
+
+    Args:
+        df (pandas DataFrame): od_df dataset.
+        method (str): 'grid' to snap homes to meters x meters squares, or
+            'radius' to group homes within meters of a cluster leader.
+        meters (float): grid cell size or cluster radius.
+
+    Returns:
+        pandas DataFrame: indexed like df, with the 'representative' row index
+            of each row's cluster, the 'cluster_size' and the 'snap_error_miles'
+            from each home to its representative's home.
+    """
+    if method not in ('grid', 'radius'):
+        raise ValueError('Unknown clustering method: {}'.format(method))
+    lat = pd.to_numeric(df['home_lat'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(df['home_lon'], errors='coerce').to_numpy(dtype=float)
+    cluster = grid_clusters if method == 'grid' else radius_clusters
+    labels = cluster(lat, lon, meters)
+
+    # split clusters by school and bell times, and make unlocated rows singletons
+    cols = [c for c in group_columns if c in df.columns]
+    groups = df.groupby(cols, sort=False, dropna=False).ngroup().to_numpy() if cols \
+        else np.zeros(len(df), dtype=np.int64)
+    singles = labels < 0
+    labels[singles] = labels.max() + 1 + np.arange(singles.sum())
+    labels = np.unique(np.column_stack([groups, labels]), axis=0,
+                       return_inverse=True)[1].ravel()
+
+    rep_pos = medoids(np.nan_to_num(lat), np.nan_to_num(lon), labels)[labels]
+    error = geo_utils.haversine_miles(lat, lon, lat[rep_pos], lon[rep_pos])
+    error[rep_pos == np.arange(len(df))] = 0.0
+    return pd.DataFrame({'representative': df.index[rep_pos],
+                         'cluster_size': np.bincount(labels)[labels],
+                         'snap_error_miles': np.round(error, 3)},
+                        index=df.index)
+
+
+def accuracy_report(exact, snapped, snap_error_miles=None):
+    """
+    Measure how much snapping changed routing results.
+
+    Args:
+        exact (pandas DataFrame): journey records from routing each home exactly.
+        snapped (pandas DataFrame): journey records for the same students,
+            in the same order, taken from their cluster representatives.
+        snap_error_miles (array-like, optional): each student's snapping error.
+
+    Returns:
+        dict: agreement and travel time error statistics.
+    """
+    exact = exact.reset_index(drop=True)
+    snapped = snapped.reset_index(drop=True)
+    exact_routed = exact['total_minutes'].notna()
+    snapped_routed = snapped['total_minutes'].notna()
+    both = exact_routed & snapped_routed
+    error = (snapped['total_minutes'] - exact['total_minutes'])[both].abs()
+    report = {'students': len(exact),
+              'routed_exact': int(exact_routed.sum()),
+              'routed_snapped': int(snapped_routed.sum()),
+              'routable_agreement': round(float((exact_routed == snapped_routed).mean()), 3),
+              'minutes_error_mean': round(float(error.mean()), 1),
+              'minutes_error_p50': round(float(error.quantile(0.5)), 1),
+              'minutes_error_p90': round(float(error.quantile(0.9)), 1),
+              'minutes_error_max': round(float(error.max()), 1),
+              'within_5_minutes': round(float((error <= 5).mean()), 3),
+              'same_transfers': round(float((exact['num_transfers'][both]
+                                             == snapped['num_transfers'][both]).mean()), 3),
+              'same_routes': round(float((exact['routes_taken'][both]
+                                          == snapped['routes_taken'][both]).mean()), 3)}
+    if snap_error_miles is not None:
+        snap_error_miles = np.asarray(snap_error_miles, dtype=float)
+        report['snap_error_miles_mean'] = round(float(snap_error_miles.mean()), 3)
+        report['snap_error_miles_max'] = round(float(snap_error_miles.max()), 3)
+    return report
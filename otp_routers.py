@@ -0,0 +1,176 @@
+# Registry of OpenTripPlanner routers, one per analysis city
+# Each router's graph is built from the OSM, GTFS and config files in
+# otp/graphs/[router], and is only rebuilt when those files change.
+# The serialized Graph.obj is reused otherwise, and several routers
+# can be served from one OTP process (see start_otp.OTPServer)
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+import start_otp
+
+# city -> router name (folder in otp/graphs) and optional input file patterns
+routers = {'indy': {'router': 'indy2'},
+           'elpaso': {'router': 'elpaso'},
+           'houston': {'router': 'houston'},
+           'twincities': {'router': 'twincities'}}
+
+# files OTP 1.4 reads when building a graph
+input_patterns = ['*.osm', '*.osm.pbf', '*.zip', 'build-config.json', 'router-config.json']
+
+# written next to Graph.obj after each build
+build_manifest_name = 'graph_inputs.json'
+
+
+def router_name(city):
+    """
+    Look up a city's router name in the registry.
+    """
+    if city not in routers:
+        raise KeyError('No OTP router registered for {}, add it to otp_routers.routers'.format(city))
+    return routers[city]['router']
+
+
+def router_dir(router):
+    return os.path.join(start_otp.otp_dir, start_otp.graphs_dir, router)
+
+
+def input_files(router):
+    """
+    List the graph inputs in a router's folder.
+
+    Returns:
+        list: sorted file names.
+    """
+    patterns = input_patterns
+    for entry in routers.values():
+        if entry['router'] == router:
+            patterns = entry.get('inputs', input_patterns)
+    return sorted(f for f in os.listdir(router_dir(router))
+                  if any(fnmatch.fnmatch(f, p) for p in patterns))
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def input_hashes(router):
+    """
+    Returns:
+        dict: input file name -> sha256 of its contents.
+    """
+    return {f: file_hash(os.path.join(router_dir(router), f)) for f in input_files(router)}
+
+
+def combined_hash(hashes):
+    return hashlib.sha256(json.dumps(hashes, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_build_manifest(router):
+    path = os.path.join(router_dir(router), build_manifest_name)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def graph_is_current(router, hashes=None):
+    """
+    Check whether a router's Graph.obj was built from its current inputs.
+    """
+    if not os.path.exists(os.path.join(router_dir(router), 'Graph.obj')):
+        return False
+    hashes = hashes if hashes is not None else input_hashes(router)
+    return load_build_manifest(router).get('input_hash') == combined_hash(hashes)
+
+
+def build_graph(router, heap=start_otp.default_heap, hashes=None):
+    """
+    Build and serialize a router's graph with OTP, then record the inputs
+    it was built from.
+
+    Returns:
+        float: build time in seconds.
+    """
+    hashes = hashes if hashes is not None else input_hashes(router)
+    if not hashes:
+        raise FileNotFoundError('No graph inputs found in {}'.format(router_dir(router)))
+    cmd = [start_otp.java, '-Xmx{}'.format(heap), '-jar', start_otp.otp_jar,
+           '--build', os.path.join(start_otp.graphs_dir, router)]
+    log_path = os.path.join(router_dir(router), 'build.log')
+    print('Building {} graph: {}'.format(router, ' '.join(cmd)))
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        result = subprocess.run(cmd, cwd=start_otp.otp_dir, stdout=log, stderr=subprocess.STDOUT)
+    seconds = round(time.perf_counter() - start, 1)
+    if result.returncode != 0 or not os.path.exists(os.path.join(router_dir(router), 'Graph.obj')):
+        raise RuntimeError('Building the {} graph failed, see {}'.format(router, log_path))
+    manifest = {'router': router,
+                'input_hash': combined_hash(hashes),
+                'inputs': hashes,
+                'built': datetime.now().isoformat(timespec='seconds'),
+                'build_seconds': seconds}
+    with open(os.path.join(router_dir(router), build_manifest_name), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print('Built {} graph in {}s'.format(router, seconds))
+    return seconds
+
+
+def ensure_graphs(router_names, heap=start_otp.default_heap, force=False):
+    """
+    Build the graphs of any routers whose inputs changed since their last build.
+
+    Args:
+        router_names (list): routers to check.
+        heap (str): JVM heap for graph builds.
+        force (bool): rebuild even if the graph is current.
+
+    Returns:
+        dict: router -> build time in seconds, or None if the graph was reused.
+    """
+    builds = {}
+    for router in router_names:
+        hashes = input_hashes(router)
+        if not force and graph_is_current(router, hashes):
+            print('{} graph is up to date'.format(router))
+            builds[router] = None
+        else:
+            builds[router] = build_graph(router, heap, hashes)
+    return builds
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Build OTP graphs for registered cities, '
+                                                 'rebuilding only those whose inputs changed.')
+    parser.add_argument('--city', action='append', choices=sorted(routers),
+                        help='city to build; repeat for several. Defaults to all cities.')
+    parser.add_argument('--heap', default=start_otp.default_heap, help='JVM heap size, e.g. 8g')
+    parser.add_argument('--force', action='store_true', help='rebuild even unchanged graphs')
+    parser.add_argument('--serve', action='store_true',
+                        help='then serve all the routers from one OTP server')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = [router_name(city) for city in (args.city or sorted(routers))]
+    print(ensure_graphs(names, args.heap, args.force))
+    if args.serve:
+        serve_args = ['--heap', args.heap]
+        for name in names:
+            serve_args += ['--router', name]
+        start_otp.main(serve_args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
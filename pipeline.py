@@ -0,0 +1,574 @@
+# Runs the whole district workflow as a graph of stages
+# Each stage declares the files it reads and writes. A stage is skipped when
+# the hashes of its input files, parameters and code match its last successful
+# run, and stages that don't depend on each other run at the same time,
+# e.g. the AM and PM journeys of different schools while isochrones are made.
+# State is kept in state_path, so after a small change (one school's students,
+# a triage setting) a rerun only redoes the stages downstream of it
+
+import argparse
+import glob
+import hashlib
+import inspect
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from functools import partial
+from types import CodeType, ModuleType
+from urllib.parse import urlparse
+
+import pandas as pd
+
+import api_utils
+import convert_geojson_to_kml
+import create_od_records
+import gen_student_journeys
+import gen_transit_isochrones
+import geocode_and_prep
+import metrics
+import od_store
+import otp_routers
+import postprocess_journeys
+import response_cache
+import start_otp
+
+state_path = 'temp/pipeline_state.json'
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+max_workers = 4  # number of stages run at once
+
+# stages that use the same API run one at a time, since each stage already
+# runs its own pool of requests up to the script's max_qps. Journey stages
+# run concurrently instead, sharing one rate limiter (see school_stages)
+resource_limits = {'geocode': 1, 'otp': 1}
+
+# district settings
+city = 'indy'
+school_address_path = geocode_and_prep.school_address_path
+school_out_path = geocode_and_prep.school_out_path
+student_address_path = geocode_and_prep.student_address_path
+work_dir = geocode_and_prep.student_out_dir  # geocoded students, od and journey files
+out_dir = 'outputs/indy'  # attribute tables
+ampms = ['am', 'pm']
+make_geojson = False  # also write [school]_[ampm]_journeys.geojson to out_dir
+make_kml = False  # and convert each school's geojsons to [out_dir]/kml/[school].kmz
+make_isochrones = True
+district_table = 'outputs/indy/district_journey_attributes.csv'
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    Args:
+        name (str): unique name, e.g. 'journeys:123_school:am'.
+        func (function): called with no arguments to run the stage.
+        inputs (list): files or glob patterns the stage reads. An input written
+            exactly like another stage's output makes this stage depend on it.
+        outputs (list): files or glob patterns the stage writes.
+        params (dict, optional): settings that change the outputs.
+        after (list, optional): names of other stages to wait for.
+        resource (str, optional): key of resource_limits the stage counts against.
+    """
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, after=(),
+                 resource=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.after = list(after)
+        self.resource = resource
+
+    def __repr__(self):
+        return 'Stage({!r})'.format(self.name)
+
+
+def is_pattern(path):
+    return any(c in path for c in '*?[')
+
+
+def expand(path):
+    """
+    Returns:
+        list: the files a path or glob pattern currently refers to.
+    """
+    if is_pattern(path):
+        return sorted(p for p in glob.glob(path) if os.path.isfile(p))
+    return [path] if os.path.exists(path) else []
+
+
+def load_state(path=None):
+    path = path or state_path
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'stages': {}, 'files': {}}
+
+
+def save_state(state, path=None):
+    path = path or state_path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def file_hash(path, state):
+    """
+    sha256 of a file, reusing the hash stored in state while the
+    file's size and modification time are unchanged.
+    """
+    stat = os.stat(path)
+    known = state['files'].get(path)
+    if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return known[2]
+    digest = create_od_records.file_hash(path)
+    state['files'][path] = [stat.st_size, stat.st_mtime_ns, digest]
+    return digest
+
+
+def file_hashes(paths, state):
+    """
+    Returns:
+        dict: file -> sha256 for every file the paths or patterns refer to.
+    """
+    return {f: file_hash(f, state) for path in paths for f in expand(path)}
+
+
+def local_module(obj):
+    """
+    Returns:
+        module: the module of this repository obj is or was defined in, or None.
+    """
+    module = obj if isinstance(obj, ModuleType) else sys.modules.get(getattr(obj, '__module__', None))
+    path = getattr(module, '__file__', None)
+    if path and os.path.dirname(os.path.abspath(path)) == repo_dir:
+        return module
+    return None
+
+
+def global_names(code):
+    """
+    Names a function's code, and the code of functions nested in it, looks up.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= global_names(const)
+    return names
+
+
+def code_files(func):
+    """
+    Source files of the repository's modules a stage runs: the module of a
+    function imported from another script, or for a function of this script,
+    the modules it calls. Both include the modules those import in turn, so
+    e.g. a change to gen_student_journeys.format_params reruns the journeys stages.
+
+    Returns:
+        list: file paths.
+    """
+    while isinstance(func, partial):
+        func = func.func
+    module = local_module(func)
+    if module is None:
+        return []
+    if module is sys.modules[__name__]:
+        found = {local_module(module.__dict__[name]) for name in global_names(func.__code__)
+                 if name in module.__dict__}
+        todo = [m for m in found if m is not None and m is not module]
+    else:
+        todo = [module]
+    seen = {}
+    while todo:
+        module = todo.pop()
+        if module.__name__ in seen:
+            continue
+        seen[module.__name__] = os.path.abspath(module.__file__)
+        todo += [m for m in map(local_module, vars(module).values())
+                 if m is not None and m.__name__ not in seen]
+    return sorted(set(seen.values()))
+
+
+def code_hash(func, state):
+    """
+    Hash of the function a stage runs: its own source, for functions
+    of this script, and the source files of the modules it calls.
+    """
+    code = {path: file_hash(path, state) for path in code_files(func)}
+    while isinstance(func, partial):
+        func = func.func
+    if local_module(func) is sys.modules[__name__]:
+        try:
+            code['source'] = inspect.getsource(func)
+        except (OSError, TypeError):
+            code['source'] = func.__qualname__
+    return hashlib.sha256(json.dumps(code, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def stage_key(stage, state):
+    """
+    Hash everything that determines a stage's outputs: its input files,
+    its parameters and the source of the code it runs (see code_files).
+
+    Raises:
+        FileNotFoundError: if an input that is not a glob pattern is missing.
+    """
+    for path in stage.inputs:
+        if not is_pattern(path) and not os.path.exists(path):
+            raise FileNotFoundError('{} needs {}'.format(stage.name, path))
+    key = {'inputs': file_hashes(stage.inputs, state),
+           'params': stage.params,
+           'code': code_hash(stage.func, state)}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def dependencies(stages):
+    """
+    Work out which stages each stage waits for, and check there are no cycles.
+
+    Returns:
+        dict: stage name -> set of stage names.
+    """
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError('Stage names must be unique')
+    producers = {path: s.name for s in stages for path in s.outputs}
+    deps = {}
+    for s in stages:
+        missing = [n for n in s.after if n not in names]
+        if missing:
+            raise ValueError('{} waits for unknown stages {}'.format(s.name, missing))
+        deps[s.name] = ({producers[p] for p in s.inputs if p in producers} | set(s.after)) - {s.name}
+
+    # Kahn's algorithm, only to detect cycles
+    remaining = {name: set(d) for name, d in deps.items()}
+    while remaining:
+        ready = [name for name, d in remaining.items() if not d]
+        if not ready:
+            raise ValueError('Stages depend on each other in a cycle: {}'.format(sorted(remaining)))
+        for name in ready:
+            del remaining[name]
+        for d in remaining.values():
+            d.difference_update(ready)
+    return deps
+
+
+def run_stage(stage):
+    start = time.perf_counter()
+    with metrics.stage('pipeline:' + stage.name):
+        stage.func()
+    return round(time.perf_counter() - start, 2)
+
+
+def run(stages, workers=None, force=(), dry_run=False, path=None):
+    """
+    Run stages in dependency order, skipping those whose inputs, parameters
+    and code are unchanged since their last successful run and whose outputs
+    are as that run left them.
+
+    A failed stage is reported and the stages downstream of it are not run,
+    but independent branches carry on.
+
+    Args:
+        stages (list): Stage objects.
+        workers (int, optional): stages to run at once. Defaults to max_workers.
+        force (iterable): stage names to run even if they are up to date.
+            Pass True to run every stage.
+        dry_run (bool): only print which stages would run.
+        path (str, optional): state file. Defaults to state_path.
+
+    Returns:
+        dict: stage name -> 'ran', 'skipped', 'failed' or 'blocked'.
+            With dry_run, 'ran' means the stage would run.
+    """
+    workers = workers or max_workers
+    deps = dependencies(stages)
+    state = load_state(path)
+    status = {}
+    pending = list(stages)
+    running = {}
+    in_use = {}
+
+    def finish(stage, result, message):
+        status[stage.name] = result
+        print('[{}] {}: {}'.format(result, stage.name, message))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for stage in list(pending):
+                upstream = deps[stage.name]
+                if any(status.get(n) in ('failed', 'blocked') for n in upstream):
+                    pending.remove(stage)
+                    finish(stage, 'blocked', 'an upstream stage failed')
+                    continue
+                if not all(n in status for n in upstream):
+                    continue
+                limit = resource_limits.get(stage.resource, workers)
+                if stage.resource and in_use.get(stage.resource, 0) >= limit:
+                    continue
+                pending.remove(stage)
+
+                upstream_ran = any(status[n] == 'ran' for n in upstream)
+                try:
+                    key = stage_key(stage, state)
+                except FileNotFoundError as e:
+                    if dry_run and upstream_ran:
+                        finish(stage, 'ran', 'would run')
+                    else:
+                        finish(stage, 'failed', e)
+                    continue
+                last = state['stages'].get(stage.name, {})
+                up_to_date = (last.get('key') == key
+                              and last.get('outputs') == file_hashes(stage.outputs, state)
+                              and all(expand(p) for p in stage.outputs)
+                              and not (dry_run and upstream_ran))
+                if up_to_date and not (force is True or stage.name in force):
+                    finish(stage, 'skipped', 'up to date')
+                    continue
+                if dry_run:
+                    finish(stage, 'ran', 'would run')
+                    continue
+                if stage.resource:
+                    in_use[stage.resource] = in_use.get(stage.resource, 0) + 1
+                print('[start] {}'.format(stage.name))
+                running[executor.submit(run_stage, stage)] = (stage, key)
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, key = running.pop(future)
+                if stage.resource:
+                    in_use[stage.resource] -= 1
+                try:
+                    seconds = future.result()
+                except Exception:
+                    traceback.print_exc()
+                    finish(stage, 'failed', 'raised an exception')
+                    continue
+                missing = [p for p in stage.outputs if not expand(p)]
+                if missing:
+                    finish(stage, 'failed', 'did not write {}'.format(missing))
+                    continue
+                state['stages'][stage.name] = {'key': key,
+                                               'outputs': file_hashes(stage.outputs, state),
+                                               'finished': datetime.now().isoformat(timespec='seconds'),
+                                               'seconds': seconds}
+                save_state(state, path)
+                finish(stage, 'ran', '{}s'.format(seconds))
+    if not dry_run:
+        save_state(state, path)
+    return status
+
+
+def geocode_schools():
+    geocode_and_prep.process_file(pd.read_csv(school_address_path), 'school_address',
+                                  school_out_path, cleaning_func=geocode_and_prep.rename_school_cols)
+
+
+def journeys(od_path, ampm, out_path, bucket=None):
+    cache = response_cache.ResponseCache(gen_student_journeys.cache_path,
+                                         max_age_days=gen_student_journeys.cache_max_age_days,
+                                         offline=gen_student_journeys.offline)
+    try:
+        count = gen_student_journeys.write_journeys(gen_student_journeys.read_od(od_path), ampm,
+                                                     out_path, cache=cache, bucket=bucket)
+        print('wrote {} journeys to {}'.format(count, out_path))
+    finally:
+        cache.close()
+
+
+def kml(school, geojsons, schools_path, out_path):
+    """
+    Write a school's journey GeoJSONs and isochrones to one KML/KMZ.
+    The isochrone files are looked up when the stage runs, after the
+    isochrones stage has made them, and matched to the school with
+    convert_geojson_to_kml.school_key.
+    """
+    sources = list(geojsons)
+    if make_isochrones:
+        codes = convert_geojson_to_kml.school_codes(schools_path)
+        key = convert_geojson_to_kml.school_key(school, codes)
+        iso_dir = os.path.join('outputs', otp_routers.router_name(city))
+        for name, found in convert_geojson_to_kml.find_sources(iso_dir, codes=codes).items():
+            if convert_geojson_to_kml.school_key(name, codes) == key:
+                sources += [((layer,), path) for layer, path in found
+                            if convert_geojson_to_kml.isochrone_pattern.match(os.path.basename(path))]
+    convert_geojson_to_kml.write_kml(sources, out_path, convert_geojson_to_kml.simplify_meters)
+
+
+def isochrone_locations(schools_path, locations):
+    """
+    Write a school list in the form gen_transit_isochrones.batch_process
+    reads, with geocoded lat/lon columns renamed to school_lat/school_lon.
+    """
+    schools = pd.read_csv(schools_path)
+    if 'school_lat' not in schools.columns:
+        schools = schools.rename(columns={'lat': 'school_lat', 'lon': 'school_lon'})
+    schools.to_csv(locations, index=False)
+
+
+def isochrones(locations, router):
+    if not gen_transit_isochrones.manage_server:
+        failed = gen_transit_isochrones.batch_process(locations, router)
+    else:
+        otp_routers.ensure_graphs([router])
+        port = urlparse(gen_transit_isochrones.otp_url).port
+        with start_otp.OTPServer(router, port=port) as server:
+            server.warm_up()
+            failed = gen_transit_isochrones.batch_process(locations, router)
+    if failed:
+        raise RuntimeError('{} isochrone requests failed'.format(len(failed)))
+
+
+def journey_params():
+    """
+    Settings of gen_student_journeys that change its responses.
+    """
+    names = ['triage_rows', 'walk_only_miles', 'walk_speed_mph', 'walk_detour_factor',
+             'invalid_coords', 'cluster_homes', 'cluster_method', 'cluster_meters', 'dir_api']
+    return {name: getattr(gen_student_journeys, name) for name in names}
+
+
+def prep_stages():
+    """
+    Geocoding and origin-destination stages for the district.
+    """
+    # batch_combine reads geocoded students in either format
+    student_files = [od_store.partition_path(os.path.join(work_dir, od_store.student_dataset), '*'),
+                     os.path.join(work_dir, '*_geocoded_students.csv')]
+    geocoded = student_files[0 if geocode_and_prep.student_format == 'parquet' else 1]
+    if create_od_records.od_format == 'parquet':
+        od_tables = od_store.partition_path(os.path.join(work_dir, od_store.od_dataset), '*')
+    else:
+        od_tables = os.path.join(work_dir, '*_od_df.csv')
+    return [
+        Stage('geocode_schools', geocode_schools,
+              inputs=[school_address_path], outputs=[school_out_path],
+              resource='geocode'),
+        Stage('geocode_students',
+              partial(geocode_and_prep.process_indy_students, out_dir=work_dir,
+                      path=student_address_path),
+              inputs=[student_address_path], outputs=[geocoded],
+              resource='geocode'),
+        Stage('od_records',
+              partial(create_od_records.batch_combine, work_dir, school_path=school_out_path),
+              inputs=student_files + [school_out_path],
+              outputs=[od_tables]),
+    ]
+
+
+def school_stages():
+    """
+    Journey, attribute table and isochrone stages. Built from the od tables
+    on disk, so run prep_stages first.
+    """
+    stages = []
+    tables = []
+    # one limiter for every journey stage, so running them at once still
+    # keeps the district under gen_student_journeys.max_qps
+    bucket = api_utils.TokenBucket(gen_student_journeys.max_qps)
+    # the city's school list from the isochrone script, by default
+    # the geocoded schools
+    schools_path = gen_transit_isochrones.school_lists.get(city, school_out_path)
+    router = otp_routers.router_name(city)
+    iso_manifest = os.path.join('outputs', router, gen_transit_isochrones.manifest_name)
+    for school, od_path in create_od_records.find_od_files(work_dir).items():
+        geojsons = []
+        for ampm in ampms:
+            journey_path = os.path.join(work_dir, '{}_{}_journeys.jsonl'.format(school, ampm))
+            table_path = os.path.join(out_dir, '{}_{}_journey_attributes.csv'.format(school, ampm))
+            stages.append(Stage('journeys:{}:{}'.format(school, ampm),
+                                partial(journeys, od_path, ampm, journey_path, bucket),
+                                inputs=[od_path], outputs=[journey_path],
+                                params=dict(journey_params(), ampm=ampm)))
+            stages.append(Stage('attributes:{}:{}'.format(school, ampm),
+                                partial(postprocess_journeys.process_journey_file,
+                                        journey_path, school, ampm, table_path),
+                                inputs=[journey_path], outputs=[table_path],
+                                params={'fields': postprocess_journeys.RECORD_FIELDS}))
+            tables.append(table_path)
+            if make_geojson:
+                geojson_path = os.path.join(out_dir, '{}_{}_journeys.geojson'.format(school, ampm))
+                stages.append(Stage('geojson:{}:{}'.format(school, ampm),
+                                    partial(postprocess_journeys.convert_to_geojson,
+                                            journey_path, geojson_path),
+                                    inputs=[journey_path], outputs=[geojson_path]))
+                geojsons.append((('{}_journeys'.format(ampm),), geojson_path))
+        if make_geojson and make_kml:
+            kml_path = os.path.join(out_dir, 'kml', '{}.kmz'.format(school))
+            # isochrones come in through the isochrone stage's manifest
+            inputs = [path for _, path in geojsons]
+            if make_isochrones:
+                inputs += [schools_path, iso_manifest]
+            stages.append(Stage('kml:{}'.format(school),
+                                partial(kml, school, geojsons, schools_path, kml_path),
+                                inputs=inputs, outputs=[kml_path],
+                                params={'simplify': convert_geojson_to_kml.simplify_meters,
+                                        'precision': convert_geojson_to_kml.coordinate_precision,
+                                        'name_fields': convert_geojson_to_kml.name_fields}))
+    if tables and district_table:
+        stages.append(Stage('district_table',
+                            partial(postprocess_journeys.merge_tables, tables, district_table),
+                            inputs=tables, outputs=[district_table]))
+    if make_isochrones:
+        graph_inputs = []
+        if os.path.isdir(otp_routers.router_dir(router)):
+            graph_inputs = [os.path.join(otp_routers.router_dir(router), f)
+                            for f in otp_routers.input_files(router)]
+        locations = os.path.join(work_dir, 'isochrone_locations.csv')
+        stages.append(Stage('isochrone_locations',
+                            partial(isochrone_locations, schools_path, locations),
+                            inputs=[schools_path], outputs=[locations]))
+        stages.append(Stage('isochrones:{}'.format(router),
+                            partial(isochrones, locations, router),
+                            inputs=[locations] + graph_inputs,
+                            outputs=[iso_manifest],
+                            resource='otp'))
+    return stages
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the district pipeline, redoing only '
+                                                 'stages whose inputs changed.')
+    parser.add_argument('--workers', type=int, default=max_workers, help='stages to run at once')
+    parser.add_argument('--force', action='append', default=[],
+                        help='stage to rerun even if it is up to date; repeat for several, '
+                             'or use "all"')
+    parser.add_argument('--dry-run', action='store_true', help='only list the stages that would run')
+    parser.add_argument('--skip-prep', action='store_true',
+                        help='start from the od files already in work_dir')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    force = True if 'all' in args.force else set(args.force)
+    os.makedirs(out_dir, exist_ok=True)
+    status = {}
+    if not args.skip_prep:
+        status.update(run(prep_stages(), args.workers, force, args.dry_run))
+    # per-school stages depend on which od files exist, so they are planned
+    # once the prep stages are done
+    if all(s in ('ran', 'skipped') for s in status.values()):
+        if args.dry_run and 'ran' in status.values():
+            print('Per-school stages are planned from the od files now on disk, '
+                  'so stages downstream of changed od files may also run')
+        status.update(run(school_stages(), args.workers, force, args.dry_run))
+    counts = {}
+    for result in status.values():
+        counts[result] = counts.get(result, 0) + 1
+    print(counts)
+    if not args.dry_run:
+        metrics.report()
+    return status
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
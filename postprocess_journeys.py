@@ -1,6 +1,21 @@
+import argparse
 import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 import polyline
+import geo_utils
+import journey_store
+import metrics
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for parquet output
+    pa = None
 
 # school/time variables -- change before running
 school = ''  # see schools list in main()
@@ -12,6 +27,35 @@ ampm = 'pm'
 #json_out_path = 'outputs/indy/{}_{}_journey_attributes.json'.format(school, ampm)
 #csv_out_path = 'outputs/indy/{}_{}_journey_attributes.csv'.format(school, ampm)
 
+# columns of a journey attribute record, with their types.
+# routes the API could not find only fill in origin, dest and notes,
+# and snap_error_miles is only filled in for clustered origins
+RECORD_FIELDS = {'origin': 'str',
+                 'origin_lat': 'float',
+                 'origin_lon': 'float',
+                 'dest': 'str',
+                 'dest_lat': 'float',
+                 'dest_lon': 'float',
+                 'departure_time': 'str',
+                 'arrival_time': 'str',
+                 'total_minutes': 'float',
+                 'total_miles': 'float',
+                 'notes': 'str',
+                 'walk_time_minutes': 'float',
+                 'walk_dist_miles': 'float',
+                 'transit_time_minutes': 'float',
+                 'num_transfers': 'int',
+                 'starting_stop': 'str',
+                 'end_stop': 'str',
+                 'routes_taken': 'str',
+                 'snap_error_miles': 'float'}
+
+# number of records to hold in memory before writing them out
+chunk_size = 5000
+
+# journey files are named [school]_[am|pm]_journeys.json(l)
+journey_file_pattern = re.compile(r'^(?P<school>.+)_(?P<ampm>am|pm)_journeys\.jsonl?$')
+
 
 def load_data(file_path):
     """
@@ -43,7 +87,7 @@ def extract_overview_line(result):
     return pts
 
 
-def extract_leg_attributes(leg):
+def extract_leg_attributes(leg, record=None):
     """
     Get basic itinerary attributes (origin, destination, start and end time, 
     trip duration) from a Google Directions API result leg.
@@ -52,37 +96,30 @@ def extract_leg_attributes(leg):
     routes will have 'None' for those attributes.
 
     Args:
-        trip (dict): a single Google Directions API response.
+        leg (dict): the first leg of a Google Directions API route.
+        record (dict or JourneyRow, optional): record to fill in.
+            Defaults to a new dict.
 
     Returns:
-        dict: a dictionary of itinerary attributes.
-    """
-    start_address = leg['start_address']
-    start_lat = leg['start_location']['lat']
-    start_lon = leg['start_location']['lng']
-    end_address = leg['end_address']
-    end_lat = leg['end_location']['lat']
-    end_lon = leg['end_location']['lng']
+        the record, with the itinerary attributes filled in.
+    """
+    record = {} if record is None else record
+    record['origin'] = leg['start_address']
+    record['origin_lat'] = leg['start_location']['lat']
+    record['origin_lon'] = leg['start_location']['lng']
+    record['dest'] = leg['end_address']
+    record['dest_lat'] = leg['end_location']['lat']
+    record['dest_lon'] = leg['end_location']['lng']
     # account for walking-only routes not having departure and arrival times
-    dep_time = leg.get('departure_time', {}).get('text')
-    arr_time = leg.get('arrival_time', {}).get('text')
-    duration_minutes = round(leg['duration']['value'] / 60, 1)
-    dist_miles = round(leg['distance']['value'] * 0.00062137, 2)
-    attributes = {'origin': start_address,
-                  'origin_lat': start_lat,
-                  'origin_lon': start_lon,
-                  'dest': end_address,
-                  'dest_lat': end_lat,
-                  'dest_lon': end_lon,
-                  'departure_time': dep_time,
-                  'arrival_time': arr_time,
-                  'total_minutes': duration_minutes,
-                  'total_miles': dist_miles,
-                  'notes': ''}
-    return attributes
-
-
-def extract_aggregate_step_attributes(steps):
+    record['departure_time'] = leg.get('departure_time', {}).get('text')
+    record['arrival_time'] = leg.get('arrival_time', {}).get('text')
+    record['total_minutes'] = round(leg['duration']['value'] / 60, 1)
+    record['total_miles'] = round(leg['distance']['value'] * 0.00062137, 2)
+    record['notes'] = ''
+    return record
+
+
+def extract_aggregate_step_attributes(steps, record=None):
     """
     Get further itinerary attributes (walk time, transit time, 
     number of transfers, specific routes taken) from a Google Directions API result leg.
@@ -90,9 +127,11 @@ def extract_aggregate_step_attributes(steps):
     Args:
         steps (list): the list of steps in a Google Directions API leg.
                       e.g. in `result['routes'][0]['legs'][0]['steps']`
+        record (dict or JourneyRow, optional): record to fill in.
+            Defaults to a new dict.
 
     Returns:
-        dict: dictionary of itinerary attributes
+        the record, with the itinerary attributes filled in.
     """
     
     total_walking_time = 0
@@ -122,29 +161,261 @@ def extract_aggregate_step_attributes(steps):
     else:
         num_transfers = 0
 
-    agg_attributes = {'walk_time_minutes': round(total_walking_time / 60, 1),
-                      'walk_dist_miles': round(total_walking_dist * 0.00062137, 2),
-                      'transit_time_minutes': round(total_transit_time / 60, 1),
-                      'num_transfers': num_transfers,
-                      'starting_stop': starting_stop,
-                      'end_stop': end_stop,
-                      'routes_taken': ', '.join(transit_routes)
-                     }
-    return agg_attributes
+    record = {} if record is None else record
+    record['walk_time_minutes'] = round(total_walking_time / 60, 1)
+    record['walk_dist_miles'] = round(total_walking_dist * 0.00062137, 2)
+    record['transit_time_minutes'] = round(total_transit_time / 60, 1)
+    record['num_transfers'] = num_transfers
+    record['starting_stop'] = starting_stop
+    record['end_stop'] = end_stop
+    record['routes_taken'] = ', '.join(transit_routes)
+    return record
+
 
+def extract_properties(result, record=None):
+    """
+    Get the journey attributes (see RECORD_FIELDS) of one response.
+    Routes the API could not find only fill in origin, dest and notes.
 
-def extract_properties(result):
-    if len(result['routes']) > 0:
+    Args:
+        result (dict): a Google Directions API response, as stored in a journey file.
+        record (dict or JourneyRow, optional): record to fill in.
+            Defaults to a new dict.
+
+    Returns:
+        the record, with the journey attributes filled in.
+    """
+    record = {} if record is None else record
+    if 'record' in result:
+        # rows gen_student_journeys.triage kept away from the API
+        # already carry their attributes
+        record.update(result['record'])
+    elif len(result.get('routes', [])) > 0:
         leg = result['routes'][0]['legs'][0]
-        properties = extract_leg_attributes(leg)
-        agg_details = extract_aggregate_step_attributes(leg['steps'])
-        properties.update(agg_details)
-    else:
+        extract_leg_attributes(leg, record)
+        extract_aggregate_step_attributes(leg['steps'], record)
+    elif 'geocoded_waypoints' in result:
         waypts = result['geocoded_waypoints']      
-        properties = {'notes': result['status'],
-                      'origin': waypts[0].get('address'),
-                      'dest': waypts[1].get('address')}
-    return properties
+        record['notes'] = result['status']
+        record['origin'] = waypts[0].get('address')
+        record['dest'] = waypts[1].get('address')
+    else:
+        # failed requests (HTTP errors, cache misses) only record their params
+        params = result.get('params', {})
+        record['notes'] = str(result.get('status'))
+        record['origin'] = params.get('origin')
+        record['dest'] = params.get('destination')
+    if 'snap' in result:
+        # journeys shared with the rest of a cluster of nearby homes
+        record['snap_error_miles'] = result['snap']['snap_error_miles']
+    return record
+
+
+class JourneyRow:
+    """
+    Write access to one row of a JourneyTable, so the extract_* functions
+    can fill a table the same way they fill a dict. Missing values read
+    back as None.
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index=0):
+        self.table = table
+        self.index = index
+
+    def __setitem__(self, key, value):
+        self.table.set(self.index, key, value)
+
+    def __getitem__(self, key):
+        return self.table.get(self.index, key)
+
+    def update(self, values):
+        for key, value in values.items():
+            self.table.set(self.index, key, value)
+
+
+class JourneyTable:
+    """
+    Column store of journey attribute records with a fixed schema (RECORD_FIELDS).
+
+    Float columns are NumPy float64 arrays, with NaN for missing values,
+    and integer columns int32 arrays, with missing_int for missing values.
+    Text columns (addresses, times, stops, routes) are dictionary-encoded:
+    an int32 array of codes, -1 for missing, into a list of distinct values.
+    A record takes about 120 bytes plus its share of the distinct values,
+    against a few kilobytes for a dict of Python objects, and the columns
+    convert to pandas categoricals and Arrow dictionary arrays, without
+    copying the data if copy=False.
+
+        table = JourneyTable()
+        for response in journey_store.iter_responses(path):
+            table.append(response, ampm)
+        df = table.to_pandas()
+
+    Args:
+        capacity (int): number of rows to allocate at first. Grows as needed.
+    """
+    missing_int = np.iinfo(np.int32).min
+
+    def __init__(self, capacity=1024):
+        self.floats = [col for col, kind in RECORD_FIELDS.items() if kind == 'float']
+        self.ints = [col for col, kind in RECORD_FIELDS.items() if kind == 'int']
+        self.texts = [col for col, kind in RECORD_FIELDS.items() if kind == 'str']
+        self.size = 0
+        self.columns = {}
+        self.values = {col: [] for col in self.texts}
+        self.codes = {col: {} for col in self.texts}
+        self.row = JourneyRow(self)
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        columns = {}
+        for col in self.floats:
+            columns[col] = np.full(capacity, np.nan)
+        for col in self.ints:
+            columns[col] = np.full(capacity, self.missing_int, dtype=np.int32)
+        for col in self.texts:
+            columns[col] = np.full(capacity, -1, dtype=np.int32)
+        for col, array in self.columns.items():
+            columns[col][:self.size] = array[:self.size]
+        self.columns = columns
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.size
+
+    def set(self, index, key, value):
+        if key in self.codes:
+            if value is None or value != value:  # None or NaN
+                code = -1
+            else:
+                value = str(value)
+                codes = self.codes[key]
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes)
+                    self.values[key].append(value)
+            self.columns[key][index] = code
+        elif key in self.ints:
+            missing = value is None or value != value
+            self.columns[key][index] = self.missing_int if missing else value
+        else:
+            self.columns[key][index] = np.nan if value is None else value
+
+    def get(self, index, key):
+        value = self.columns[key][index]
+        if key in self.codes:
+            return None if value < 0 else self.values[key][value]
+        if key in self.ints:
+            return None if value == self.missing_int else int(value)
+        return None if np.isnan(value) else float(value)
+
+    def new_row(self):
+        """
+        Add an empty row.
+
+        Returns:
+            JourneyRow: the table's row writer, pointed at the new row.
+        """
+        if self.size == self.capacity:
+            self.allocate(self.capacity * 2)
+        self.row.index = self.size
+        self.size += 1
+        return self.row
+
+    def append(self, result, ampm=None):
+        """
+        Add the journey attributes of one Directions API response.
+
+        Args:
+            result (dict): a response, as stored in a journey file.
+            ampm (str, optional): if 'am', flag journeys that depart in the PM.
+        """
+        row = extract_properties(result, self.new_row())
+        if ampm == 'am' and 'pm' in str(row['departure_time']):
+            row['notes'] = (row['notes'] or '') + 'PM Departure'
+
+    def append_record(self, record):
+        """
+        Add a journey attribute dict, e.g. from raptor.route_od.
+        """
+        self.new_row().update(record)
+
+    def clear(self):
+        """
+        Remove all rows, keeping the allocated arrays. The text dictionaries
+        start over too, so each batch only carries the values it uses.
+        """
+        for col in self.floats:
+            self.columns[col][:self.size] = np.nan
+        for col in self.ints:
+            self.columns[col][:self.size] = self.missing_int
+        for col in self.texts:
+            self.columns[col][:self.size] = -1
+        self.values = {col: [] for col in self.texts}
+        self.codes = {col: {} for col in self.texts}
+        self.size = 0
+
+    def nbytes(self):
+        """
+        Approximate memory used by the rows and the distinct text values.
+        """
+        arrays = sum(array[:self.size].nbytes for array in self.columns.values())
+        return arrays + sum(len(v) for values in self.values.values() for v in values)
+
+    def to_pandas(self, extra_columns=None, copy=True):
+        """
+        Args:
+            extra_columns (dict, optional): constant columns to add first.
+            copy (bool): copy the columns. With copy=False the frame shares
+                this table's arrays, so it changes when the table is cleared
+                or refilled, e.g. by iter_tables; only use it before then.
+
+        Returns:
+            pandas DataFrame: float64 columns, nullable Int32 integer columns
+                and categorical text columns.
+        """
+        data = {col: pd.Series([value] * self.size, dtype='category')
+                for col, value in (extra_columns or {}).items()}
+        for col in RECORD_FIELDS:
+            array = self.columns[col][:self.size]
+            if copy:
+                array = array.copy()
+            if col in self.codes:
+                data[col] = pd.Categorical.from_codes(array, categories=self.values[col],
+                                                      validate=False)
+            elif col in self.ints:
+                data[col] = pd.arrays.IntegerArray(array, array == self.missing_int)
+            else:
+                data[col] = array
+        return pd.DataFrame(data, copy=False)
+
+    def to_arrow(self, extra_columns=None, copy=True):
+        """
+        Build a pyarrow Table with the schema from record_schema.
+        With copy=False, float columns and dictionary codes are passed to
+        Arrow without copying, so the same caveat applies as for to_pandas.
+        """
+        if pa is None:
+            raise ImportError('pyarrow is required to convert journey tables to Arrow')
+        schema = record_schema(extra_columns)
+        arrays = []
+        for col, value in (extra_columns or {}).items():
+            arrays.append(pa.DictionaryArray.from_arrays(
+                pa.array(np.zeros(self.size, dtype=np.int32)), pa.array([str(value)])))
+        for col in RECORD_FIELDS:
+            array = self.columns[col][:self.size]
+            if copy:
+                array = array.copy()
+            if col in self.codes:
+                arrays.append(pa.DictionaryArray.from_arrays(
+                    pa.array(array, mask=array < 0),
+                    pa.array(self.values[col], type=pa.string())))
+            elif col in self.ints:
+                arrays.append(pa.array(array, mask=array == self.missing_int, type=pa.int32()))
+            else:
+                arrays.append(pa.array(array, from_pandas=True))
+        return pa.Table.from_arrays(arrays, schema=schema)
 
 
 def make_feature(result):
@@ -159,7 +430,7 @@ def make_feature(result):
         dict: A single geojson-formatted feature.
     """
     obj = {'type': 'Feature'}
-    if len(result['routes']) > 0:
+    if len(result.get('routes', [])) > 0:
         geom = extract_overview_line(result)
         obj['geometry'] = {'type': 'LineString',
                            'coordinates': geom}
@@ -202,16 +473,17 @@ def write_geojson(geojson, out_path):
     """
     with open(out_path, 'w') as outfile:
         json.dump(geojson, outfile)    
+    metrics.inc('bytes_written', os.path.getsize(out_path), output='geojson')
     print('Wrote to {}'.format(out_path))
 
 
+@metrics.timed('gen_geojson')
 def convert_to_geojson(result_file, geo_out_path):
     """
     Load a JSON of Google Directions API results,
     convert it to a geojson, and write it to file.
     """
-    data = load_data(result_file)
-    print(len(data))
+    data = journey_store.iter_responses(result_file)
     geoj = gen_geojson(data)
 
     # add any notes
@@ -222,24 +494,211 @@ def convert_to_geojson(result_file, geo_out_path):
     write_geojson(geoj, geo_out_path)
 
 
-def gen_json(result_file, out_path='', write_file=False):
+@metrics.timed('gen_geoparquet')
+def convert_to_geoparquet(result_file, out_path, ampm=None):
     """
-    Given a json file of Directions API results, 
-    produce a json dataset for analysis, and write it to file.
+    Convert a file of Google Directions API results to a GeoParquet file
+    of journey lines with the same attributes as the CSV outputs.
+
+    Responses are read chunk_size at a time. Each chunk's polylines are
+    decoded in one vectorized pass and written straight to WKB buffers,
+    so no per-point Python objects are created.
+    Trips the API could not route get an empty LineString.
+
+    Args:
+        result_file (str): path to a *_journeys.jsonl or *_journeys.json file.
+        out_path (str): .parquet file to write. Requires pyarrow.
+        ampm (str, optional): if 'am', flag journeys that depart in the PM.
+
+    Returns:
+        int: number of journeys written.
     """
-    data = load_data(result_file)
-    records = []
-    for journey in data:
+    if pa is None:
+        raise ImportError('pyarrow is required to write {}'.format(out_path))
+    geo_metadata = {'version': '1.0.0',
+                    'primary_column': 'geometry',
+                    'columns': {'geometry': {'encoding': 'WKB',
+                                             'geometry_types': ['LineString']}}}
+    schema = record_schema().append(pa.field('geometry', pa.binary()))
+    schema = schema.with_metadata({'geo': json.dumps(geo_metadata)})
+
+    writer = pq.ParquetWriter(out_path, schema)
+    count = 0
+    lines = []
+    records = JourneyTable(chunk_size)
+
+    def flush():
+        coords, offsets = geo_utils.decode_polylines(lines)
+        wkb, wkb_offsets = geo_utils.linestrings_to_wkb(coords, offsets)
+        geometry = pa.Array.from_buffers(pa.binary(), len(lines),
+                                         [None,
+                                          pa.py_buffer(wkb_offsets.astype(np.int32)),
+                                          pa.py_buffer(wkb)])
+        table = records.to_arrow(copy=False)
+        writer.write_table(table.append_column(schema.field('geometry'), geometry))
+        lines.clear()
+        records.clear()
+
+    for journey in journey_store.iter_responses(result_file):
+        if len(journey.get('routes', [])) > 0:
+            lines.append(journey['routes'][0]['overview_polyline']['points'])
+        else:
+            lines.append('')
+        records.append(journey, ampm)
+        count += 1
+        if len(lines) >= chunk_size:
+            flush()
+    if lines or count == 0:
+        flush()
+    writer.close()
+    metrics.inc('bytes_written', os.path.getsize(out_path), output='geoparquet')
+    print('Wrote {} journeys to {}'.format(count, out_path))
+    return count
+
+
+def iter_records(result_file, ampm=None):
+    """
+    Stream journey attribute records out of a file of Directions API results.
+    Works on JSONL journey files and legacy JSON array files alike,
+    holding only one response in memory at a time.
+
+    Args:
+        result_file (str): path to a *_journeys.jsonl or *_journeys.json file.
+        ampm (str, optional): if 'am', flag journeys that depart in the PM.
+
+    Yields:
+        dict: journey attributes, as produced by extract_properties.
+    """
+    for journey in journey_store.iter_responses(result_file):
         record = extract_properties(journey)
         dep_time = record.get('departure_time', '')
-        if '_am_' in out_path and 'pm' in str(dep_time):
+        if ampm == 'am' and 'pm' in str(dep_time):
             record['notes'] += 'PM Departure'
-        records.append(record)
+        yield record
+
+
+def iter_tables(result_file, ampm=None, size=None):
+    """
+    Stream journey attribute records out of a file of Directions API results
+    in JourneyTables of up to size rows, so memory use does not grow with the input.
+    The same table is cleared and refilled, so use each one before asking for the
+    next; frames from table.to_pandas() are copies and can be kept.
+
+    Args:
+        result_file (str): path to a *_journeys.jsonl or *_journeys.json file.
+        ampm (str, optional): if 'am', flag journeys that depart in the PM.
+        size (int, optional): rows per table. Defaults to chunk_size.
+
+    Yields:
+        JourneyTable: the next size journeys (the last table may be shorter).
+    """
+    size = size or chunk_size
+    table = JourneyTable(size)
+    for journey in journey_store.iter_responses(result_file):
+        table.append(journey, ampm)
+        if len(table) >= size:
+            yield table
+            table.clear()
+    if len(table):
+        yield table
+
+
+def records_to_tables(records, size=None):
+    """
+    Batch journey attribute dicts into JourneyTables (see iter_tables).
+    """
+    size = size or chunk_size
+    table = JourneyTable(size)
+    for record in records:
+        table.append_record(record)
+        if len(table) >= size:
+            yield table
+            table.clear()
+    if len(table):
+        yield table
+
+
+@metrics.timed('write_records')
+def write_tables(tables, out_path, extra_columns=None):
+    """
+    Write JourneyTables to one CSV or Parquet file, one table at a time.
+
+    Args:
+        tables (iterable): JourneyTables, e.g. from iter_tables.
+        out_path (str): file to write. Parquet is used if it ends in
+            '.parquet' (requires pyarrow), CSV otherwise.
+        extra_columns (dict, optional): constant columns to add to every
+            record, e.g. {'school': ..., 'ampm': ...}.
+
+    Returns:
+        int: number of records written.
+    """
+    parquet = out_path.endswith('.parquet')
+    if parquet and pa is None:
+        raise ImportError('pyarrow is required to write {}'.format(out_path))
+
+    writer = None
+    count = 0
+    for table in tables:
+        if parquet:
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, record_schema(extra_columns))
+            writer.write_table(table.to_arrow(extra_columns, copy=False))
+        else:
+            table.to_pandas(extra_columns, copy=False).to_csv(
+                out_path, mode='w' if writer is None else 'a', header=writer is None, index=False)
+            writer = True
+        count += len(table)
+    if writer is None:
+        # no records: still write the header / schema
+        if parquet:
+            writer = pq.ParquetWriter(out_path, record_schema(extra_columns))
+        else:
+            JourneyTable(1).to_pandas(extra_columns).to_csv(out_path, index=False)
+    if parquet:
+        writer.close()
+    metrics.inc('bytes_written', os.path.getsize(out_path), output='records')
+    print('Wrote {} records to {}'.format(count, out_path))
+    return count
+
+
+def write_records(records, out_path, extra_columns=None):
+    """
+    Write journey attribute dicts to a CSV or Parquet file (see write_tables).
+
+    Returns:
+        int: number of records written.
+    """
+    return write_tables(records_to_tables(records), out_path, extra_columns)
+
+
+def record_schema(extra_columns=None):
+    """
+    Build the pyarrow schema for journey attribute records.
+    Text columns are dictionary-encoded, as in JourneyTable.
+    """
+    text = pa.dictionary(pa.int32(), pa.string())
+    types = {'float': pa.float64(), 'int': pa.int32(), 'str': text}
+    fields = [pa.field(col, text) for col in (extra_columns or {})]
+    for col, kind in RECORD_FIELDS.items():
+        fields.append(pa.field(col, types[kind]))
+    return pa.schema(fields)
+
+
+@metrics.timed('gen_json')
+def gen_json(result_file, out_path='', write_file=False):
+    """
+    Given a json file of Directions API results, 
+    produce a json dataset for analysis, and write it to file.
+    """
+    ampm = 'am' if '_am_' in out_path else None
+    records = list(iter_records(result_file, ampm))
     
     if write_file:
         with open(out_path, 'w') as outfile:
             json.dump(records, outfile)
             print('Wrote to {}'.format(out_path))
+        metrics.inc('bytes_written', os.path.getsize(out_path), output='records_json')
 
     return records
 
@@ -251,24 +710,166 @@ def convert_json_to_csv(json_path):
     data.to_csv(csv_path, index=False)
 
 
+def find_journey_files(directory):
+    """
+    Find all journey files under a directory and its subfolders.
+    If a school has both a .jsonl and a legacy .json file, the .jsonl is used.
+
+    Args:
+        directory (str): folder to search, e.g. 'temp/indy'
+
+    Returns:
+        list: (path, school, ampm) tuples, sorted by path.
+    """
+    found = {}
+    for subdir, dirs, files in os.walk(directory):
+        for f in files:
+            match = journey_file_pattern.match(f)
+            if match is None:
+                continue
+            key = (subdir, match.group('school'), match.group('ampm'))
+            if key not in found or f.endswith('.jsonl'):
+                found[key] = os.path.join(subdir, f)
+    return sorted((path, school, ampm) for (subdir, school, ampm), path in found.items())
+
+
+def process_journey_file(result_file, school, ampm, out_path):
+    """
+    Convert one journey file to an attribute table with school and ampm columns.
+    Module-level so it can run in a worker process.
+
+    Returns:
+        dict: input and output paths, number of records and seconds taken.
+    """
+    start = time.perf_counter()
+    count = write_tables(iter_tables(result_file, ampm), out_path,
+                         extra_columns={'school': school, 'ampm': ampm})
+    return {'file': result_file,
+            'out_path': out_path,
+            'records': count,
+            'seconds': round(time.perf_counter() - start, 2)}
+
+
+def merge_tables(paths, out_path):
+    """
+    Concatenate attribute tables with the same columns into one file,
+    reading chunk_size rows at a time.
+    """
+    if out_path.endswith('.parquet'):
+        if pa is None:
+            raise ImportError('pyarrow is required to write {}'.format(out_path))
+        with pq.ParquetWriter(out_path, record_schema({'school': '', 'ampm': ''})) as writer:
+            for path in paths:
+                writer.write_table(pq.read_table(path))
+    else:
+        first = True
+        for path in paths:
+            for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=str):
+                chunk.to_csv(out_path, mode='w' if first else 'a',
+                             header=first, index=False)
+                first = False
+    print('Wrote to {}'.format(out_path))
+
+
+def batch_postprocess(directory, out_dir, workers=None, district_out=None,
+                      file_format='csv'):
+    """
+    Convert every journey file under a directory in a process pool,
+    then merge the results into one district-wide attribute table.
+
+    Args:
+        directory (str): folder to search for journey files.
+        out_dir (str): folder to write per-school attribute tables to.
+        workers (int, optional): number of worker processes.
+            Defaults to the number of CPUs.
+        district_out (str, optional): path of the merged table.
+            Defaults to [out_dir]/district_journey_attributes.[file_format]
+        file_format (str): 'csv' or 'parquet'.
+
+    Returns:
+        list: per-file results from process_journey_file, in file order.
+
+    Raises:
+        ValueError: if journey files in different subfolders would
+            write the same attribute table.
+    """
+    jobs = find_journey_files(directory)
+    if not jobs:
+        print('No journey files found in {}'.format(directory))
+        return []
+    sources = {}
+    out_paths = []
+    for path, school, ampm in jobs:
+        out_path = os.path.join(out_dir, '{}_{}_journey_attributes.{}'.format(
+            school, ampm, file_format))
+        if out_path in sources:
+            raise ValueError('{} and {} would both write {}, remove one of them'
+                             .format(sources[out_path], path, out_path))
+        sources[out_path] = path
+        out_paths.append(out_path)
+    os.makedirs(out_dir, exist_ok=True)
+    district_out = district_out or os.path.join(
+        out_dir, 'district_journey_attributes.{}'.format(file_format))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for (path, school, ampm), out_path in zip(jobs, out_paths):
+            futures.append(executor.submit(process_journey_file, path, school, ampm, out_path))
+        for future in as_completed(futures):
+            result = future.result()
+            print('{file}: {records} records in {seconds}s'.format(**result))
+        results = [future.result() for future in futures]
+
+    merge_tables([r['out_path'] for r in results], district_out)
+    total = sum(r['records'] for r in results)
+    print('Processed {} journeys from {} files in {:.1f}s'.format(
+        total, len(results), time.perf_counter() - start))
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=
+        'Extract journey attributes from Directions API results. '
+        'Without --dir, processes the schools listed in main().')
+    parser.add_argument('--dir', help='folder to search for *_journeys.json(l) files')
+    parser.add_argument('--out-dir', default='outputs/indy',
+                        help='folder to write attribute tables to')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        dest='file_format', help='output table format')
+    parser.add_argument('--district-out', default=None,
+                        help='path of the merged district-wide table')
+    return parser.parse_args(argv)
+
+
 def main():
     schools = ['000_example_school',
                '999_school_two'
               ]
     
     for school in schools:
-        trip_path = 'temp/indy/{}_{}_journeys.json'.format(school, ampm)
+        trip_path = 'temp/indy/{}_{}_journeys.jsonl'.format(school, ampm)
 
         # uncomment to get geojson files
         #geojson_out_path = 'outputs/indy/{}_{}_journeys.geojson'.format(school, ampm)
         #convert_to_geojson(trip_path, geojson_out_path)
+        # or, for large districts, a GeoParquet file (requires pyarrow)
+        #geoparquet_out_path = 'outputs/indy/{}_{}_journeys.parquet'.format(school, ampm)
+        #convert_to_geoparquet(trip_path, geoparquet_out_path, ampm)
 
         csv_out_path = 'outputs/indy/{}_{}_journey_attributes.csv'.format(school, ampm)
-        j = gen_json(trip_path, write_file=False)
-        jdf = pd.DataFrame.from_dict(j)
-        jdf.to_csv(csv_out_path, index=False)
-        print('Wrote to {}'.format(csv_out_path))
+        write_tables(iter_tables(trip_path, ampm), csv_out_path)
+    metrics.report()
 
 
 if __name__ == '__main__':
-    main()
+    args = parse_args()
+    if args.dir:
+        batch_postprocess(args.dir, args.out_dir, workers=args.workers,
+                          district_out=args.district_out,
+                          file_format=args.file_format)
+        metrics.report()
+    else:
+        main()
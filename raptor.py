@@ -0,0 +1,758 @@
+# In-process transit routing with RAPTOR (Round-bAsed Public Transit Routing)
+# Builds compact array timetables from a GTFS feed and computes student-to-school
+# journeys for a whole district without calling the Google Directions API.
+# One search per school and bell time covers every student at that school:
+#   PM trips search forward from the school at the departure bell,
+#   AM trips search backward (on a time-reversed timetable) from the arrival bell.
+# Walking (access, egress, transfers and walk-only trips) uses straight-line
+# distance times a detour factor instead of routing on the OSM street network.
+
+import os
+import zipfile
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from dateutil import parser
+
+import convert_times
+import geo_utils
+import od_store
+
+# variables
+school = '000_school_name'
+ampm = 'am'
+
+# path templates
+gtfs_path = 'otp/graphs/indy2/gtfs.zip'
+od_path = 'temp/indy/od/school={}'.format(school)  # or a [school]_od_df.csv file
+out_path = 'outputs/indy/{}_{}_raptor_attributes.csv'.format(school, ampm)
+
+# walking assumptions
+walk_speed = 1.34  # meters per second, about 3 mph
+detour_factor = 1.3  # street distance / straight-line distance
+max_walk_miles = 1.0  # furthest a student will walk to or from a stop
+max_transfer_miles = 0.25  # furthest a rider will walk between stops
+
+max_rounds = 4  # maximum number of vehicles per trip (transfers + 1)
+unreachable = np.iinfo(np.int64).max // 4
+
+
+def read_gtfs_table(path, name, **kwargs):
+    """
+    Read one GTFS table from a feed .zip or directory.
+
+    Returns:
+        pandas DataFrame, or None if the feed does not include the table.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            if name not in zf.namelist():
+                return None
+            with zf.open(name) as f:
+                return pd.read_csv(f, dtype=str, **kwargs)
+    table_path = os.path.join(path, name)
+    if not os.path.exists(table_path):
+        return None
+    return pd.read_csv(table_path, dtype=str, **kwargs)
+
+
+def gtfs_seconds(times):
+    """
+    Convert GTFS 'H:MM:SS' times (which can run past 24:00:00) to
+    seconds after midnight. Missing times become NaN.
+    """
+    parts = times.str.strip().str.split(':', expand=True).astype(float)
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def clock_seconds(str_time):
+    """
+    Convert a bell time like '7:20 AM' to seconds after midnight.
+    """
+    t = parser.parse(str(str_time)).time()
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+def format_clock(seconds):
+    """
+    Format seconds after midnight the way the Directions API does, e.g. '6:45am'.
+    """
+    seconds = int(round(seconds)) % 86400
+    hour, minute = seconds // 3600, seconds % 3600 // 60
+    return '{}:{:02d}{}'.format(hour % 12 or 12, minute, 'am' if hour < 12 else 'pm')
+
+
+def walk_seconds(meters):
+    return meters * detour_factor / walk_speed
+
+
+def active_services(calendar, calendar_dates, service_date):
+    """
+    Find the GTFS service_ids running on a date.
+    """
+    ymd = service_date.strftime('%Y%m%d')
+    active = set()
+    if calendar is not None:
+        weekday = service_date.strftime('%A').lower()
+        running = ((calendar['start_date'] <= ymd)
+                   & (calendar['end_date'] >= ymd)
+                   & (calendar[weekday] == '1'))
+        active.update(calendar.loc[running, 'service_id'])
+    if calendar_dates is not None:
+        today = calendar_dates[calendar_dates['date'] == ymd]
+        active.update(today.loc[today['exception_type'] == '1', 'service_id'])
+        active.difference_update(today.loc[today['exception_type'] == '2', 'service_id'])
+    return active
+
+
+def default_service_date(calendar, calendar_dates):
+    """
+    Pick a Wednesday the feed has service on: next Wednesday if the feed
+    covers it, otherwise the Wednesday nearest to the feed's date range.
+    """
+    wednesday = convert_times.get_next_wednesday()
+    if calendar is not None and len(calendar) > 0:
+        start = datetime.strptime(calendar['start_date'].min(), '%Y%m%d').date()
+        end = datetime.strptime(calendar['end_date'].max(), '%Y%m%d').date()
+    elif calendar_dates is not None and len(calendar_dates) > 0:
+        dates = pd.to_datetime(calendar_dates['date'], format='%Y%m%d')
+        start, end = dates.min().date(), dates.max().date()
+    else:
+        return wednesday
+    while wednesday > end:
+        wednesday -= timedelta(days=7)
+    if wednesday < start:
+        wednesday = convert_times.get_next_wednesday(start - timedelta(days=1))
+    return wednesday
+
+
+class Timetable:
+    """
+    Array-based timetable for RAPTOR.
+
+    Trips that serve the same stops in the same order on the same route
+    are grouped into patterns. Each pattern stores its stop indices and two
+    (n_trips, n_stops) int arrays of arrival and departure seconds, with trips
+    sorted so every column is non-decreasing (no trip overtakes another).
+
+    Attributes:
+        stop_ids, stop_names (numpy arrays): GTFS stop ids and names.
+        stop_lat, stop_lon (numpy arrays): stop coordinates.
+        pattern_stops (list of numpy arrays): stop indices served by each pattern.
+        arrivals, departures (list of numpy arrays): trip times for each pattern.
+        pattern_routes (list of str): route name of each pattern.
+        stop_pattern_ptr, stop_patterns, stop_pattern_pos (numpy arrays):
+            CSR index of the (pattern, position) pairs serving each stop.
+        transfer_ptr, transfer_to, transfer_secs (numpy arrays):
+            CSR list of walking transfers from each stop.
+    """
+    def __init__(self, stop_ids, stop_names, stop_lat, stop_lon,
+                 pattern_stops, arrivals, departures, pattern_routes,
+                 transfers=None):
+        self.stop_ids = np.asarray(stop_ids)
+        self.stop_names = np.asarray(stop_names)
+        self.stop_lat = np.asarray(stop_lat, dtype=np.float64)
+        self.stop_lon = np.asarray(stop_lon, dtype=np.float64)
+        self.pattern_stops = pattern_stops
+        self.arrivals = arrivals
+        self.departures = departures
+        self.pattern_routes = pattern_routes
+        self.n_stops = len(self.stop_ids)
+
+        # stop -> (pattern, position) index
+        pattern_ids = np.concatenate([np.full(len(s), p, dtype=np.int64)
+                                      for p, s in enumerate(pattern_stops)] or [np.empty(0, np.int64)])
+        positions = np.concatenate([np.arange(len(s)) for s in pattern_stops] or [np.empty(0, np.int64)])
+        stops = np.concatenate(pattern_stops or [np.empty(0, np.int64)])
+        order = np.argsort(stops, kind='stable')
+        self.stop_patterns = pattern_ids[order]
+        self.stop_pattern_pos = positions[order]
+        self.stop_pattern_ptr = np.concatenate([[0], np.cumsum(np.bincount(stops, minlength=self.n_stops))])
+
+        # distance along each pattern, for trip lengths
+        self.pattern_dist = [np.concatenate([[0], np.cumsum(geo_utils.haversine_m(
+                                 self.stop_lat[s[:-1]], self.stop_lon[s[:-1]],
+                                 self.stop_lat[s[1:]], self.stop_lon[s[1:]]))])
+                             for s in pattern_stops]
+
+        if transfers is None:
+            transfers = self.find_transfers()
+        self.transfer_ptr, self.transfer_to, self.transfer_secs = transfers
+
+    def find_transfers(self, chunk=1000):
+        """
+        Build walking transfers between all stops within max_transfer_miles.
+        """
+        max_m = max_transfer_miles / 0.00062137
+        origins, targets, secs = [], [], []
+        for start in range(0, self.n_stops, chunk):
+            dist = geo_utils.haversine_m(self.stop_lat[start:start + chunk, None],
+                                         self.stop_lon[start:start + chunk, None],
+                                         self.stop_lat[None, :], self.stop_lon[None, :])
+            i, j = np.nonzero(dist <= max_m)
+            keep = i + start != j
+            origins.append(i[keep] + start)
+            targets.append(j[keep])
+            secs.append(np.round(walk_seconds(dist[i[keep], j[keep]])).astype(np.int64))
+        origins = np.concatenate(origins or [np.empty(0, np.int64)])
+        ptr = np.concatenate([[0], np.cumsum(np.bincount(origins, minlength=self.n_stops))])
+        return (ptr,
+                np.concatenate(targets or [np.empty(0, np.int64)]),
+                np.concatenate(secs or [np.empty(0, np.int64)]))
+
+    def reversed(self):
+        """
+        Time-reversed copy of the timetable: stop orders are flipped and
+        times negated, so an earliest-arrival search on the copy finds
+        latest departures on the original (used for arrive-by searches).
+        """
+        return Timetable(self.stop_ids, self.stop_names, self.stop_lat, self.stop_lon,
+                         [s[::-1] for s in self.pattern_stops],
+                         [-d[::-1, ::-1] for d in self.departures],
+                         [-a[::-1, ::-1] for a in self.arrivals],
+                         self.pattern_routes,
+                         transfers=(self.transfer_ptr, self.transfer_to, self.transfer_secs))
+
+
+def load_gtfs(path, service_date=None):
+    """
+    Build a Timetable from a GTFS feed for one service day.
+
+    Trips defined only through frequencies.txt are not supported.
+
+    Args:
+        path (str): GTFS .zip file or unzipped feed directory.
+        service_date (date, optional): day to build the timetable for.
+            Defaults to a Wednesday the feed has service on.
+
+    Returns:
+        Timetable
+    """
+    stops = read_gtfs_table(path, 'stops.txt')
+    routes = read_gtfs_table(path, 'routes.txt')
+    trips = read_gtfs_table(path, 'trips.txt')
+    stop_times = read_gtfs_table(path, 'stop_times.txt',
+                                 usecols=['trip_id', 'arrival_time', 'departure_time',
+                                          'stop_id', 'stop_sequence'])
+    calendar = read_gtfs_table(path, 'calendar.txt')
+    calendar_dates = read_gtfs_table(path, 'calendar_dates.txt')
+
+    service_date = service_date or default_service_date(calendar, calendar_dates)
+    services = active_services(calendar, calendar_dates, service_date)
+    trips = trips[trips['service_id'].isin(services)]
+    print('{} trips running on {}'.format(len(trips), service_date))
+
+    # route names, preferring the short name the way the Directions API does
+    routes['name'] = routes['route_id']
+    for col in ('route_long_name', 'route_short_name'):
+        if col in routes.columns:
+            routes['name'] = routes[col].fillna(routes['name'])
+    trips = trips.merge(routes[['route_id', 'name']], on='route_id')
+
+    stop_index = pd.Series(np.arange(len(stops)), index=stops['stop_id'])
+    st = stop_times[stop_times['trip_id'].isin(trips['trip_id'])].copy()
+    st['stop_sequence'] = st['stop_sequence'].astype(int)
+    st = st.sort_values(['trip_id', 'stop_sequence'])
+    st['arr'] = gtfs_seconds(st['arrival_time'].fillna(st['departure_time']))
+    st['dep'] = gtfs_seconds(st['departure_time'].fillna(st['arrival_time']))
+    # interpolate times at stops that are not timepoints
+    if st['arr'].isna().any():
+        st['arr'] = st.groupby('trip_id')['arr'].transform(lambda s: s.interpolate())
+        st['dep'] = st['dep'].fillna(st['arr'])
+    st['stop'] = stop_index.reindex(st['stop_id']).to_numpy()
+    st = st[st['stop'].notnull()]
+
+    # group trips into patterns by route and stop sequence
+    trip_col = st['trip_id'].to_numpy()
+    bounds = np.flatnonzero(trip_col[1:] != trip_col[:-1]) + 1
+    trip_starts = np.concatenate([[0], bounds])
+    trip_ends = np.concatenate([bounds, [len(st)]])
+    stop_col = st['stop'].to_numpy(dtype=np.int64)
+    arr_col = st['arr'].to_numpy(dtype=np.int64)
+    dep_col = st['dep'].to_numpy(dtype=np.int64)
+    trip_routes = trips.set_index('trip_id')['name']
+    groups = {}
+    for a, b in zip(trip_starts, trip_ends):
+        key = (trip_routes[trip_col[a]], tuple(stop_col[a:b]))
+        groups.setdefault(key, []).append((a, b))
+
+    pattern_stops, arrivals, departures, pattern_routes = [], [], [], []
+    for (route, seq), spans in groups.items():
+        if len(seq) < 2:
+            continue
+        arr = np.array([arr_col[a:b] for a, b in spans], dtype=np.int64)
+        dep = np.array([dep_col[a:b] for a, b in spans], dtype=np.int64)
+        order = np.argsort(dep[:, 0], kind='stable')
+        arr, dep = arr[order], dep[order]
+        # split trips that overtake each other into separate patterns,
+        # so departures at every stop stay sorted
+        subgroups = []
+        for t in range(len(arr)):
+            for group in subgroups:
+                last = group[-1]
+                if (arr[t] >= arr[last]).all() and (dep[t] >= dep[last]).all():
+                    group.append(t)
+                    break
+            else:
+                subgroups.append([t])
+        for group in subgroups:
+            pattern_stops.append(np.array(seq, dtype=np.int64))
+            arrivals.append(arr[group])
+            departures.append(dep[group])
+            pattern_routes.append(route)
+
+    print('{} stops, {} patterns'.format(len(stops), len(pattern_stops)))
+    return Timetable(stops['stop_id'], stops['stop_name'],
+                     stops['stop_lat'].astype(float), stops['stop_lon'].astype(float),
+                     pattern_stops, arrivals, departures, pattern_routes)
+
+
+def run_raptor(tt, access_stops, access_times, rounds=None, search=None):
+    """
+    Earliest-arrival RAPTOR search from a set of access stops.
+
+    Args:
+        tt (Timetable): timetable to search (use tt.reversed() for arrive-by).
+        access_stops (numpy array): stops reachable from the origin on foot.
+        access_times (numpy array): time the traveler reaches each access stop.
+        rounds (int, optional): maximum number of vehicles. Defaults to max_rounds.
+        search (dict, optional): result of a previous search from the same
+            origin with a later start. Its arrival times are reused as upper
+            bounds, so a range of start times can be searched latest-first
+            for little more than the cost of one search (range RAPTOR).
+            The dict is updated in place.
+
+    Returns:
+        dict:
+            best (numpy array): earliest arrival at each stop.
+            best_round (numpy array): round in which each best arrival was found.
+            tau (list of numpy arrays): earliest arrival at each stop using
+                at most k vehicles, for each round k.
+            labels (list of dicts): for each round, how each stop improved by
+                this search was reached: ('ride', pattern, trip, board_pos, alight_pos)
+                or ('walk', from_stop, seconds).
+    """
+    rounds = rounds or max_rounds
+    if search is None:
+        search = {'best': np.full(tt.n_stops, unreachable, dtype=np.int64),
+                  'best_round': np.zeros(tt.n_stops, dtype=np.int64),
+                  'tau': [np.full(tt.n_stops, unreachable, dtype=np.int64)
+                          for k in range(rounds + 1)]}
+    best = search['best']
+    best_round = search['best_round']
+    tau = search['tau']
+
+    before = tau[0].copy()
+    np.minimum.at(tau[0], access_stops, access_times)
+    marked = set(np.flatnonzero(tau[0] < before).tolist())
+    for s in marked:
+        if tau[0][s] < best[s]:
+            best[s] = tau[0][s]
+            best_round[s] = 0
+    labels = [{}]
+
+    for k in range(1, rounds + 1):
+        # earliest marked position on each pattern
+        queue = {}
+        for s in marked:
+            for j in range(tt.stop_pattern_ptr[s], tt.stop_pattern_ptr[s + 1]):
+                p, pos = tt.stop_patterns[j], tt.stop_pattern_pos[j]
+                if pos < queue.get(p, pos + 1):
+                    queue[p] = pos
+
+        prev = tau[k - 1]
+        current = tau[k]
+        np.minimum(current, prev, out=current)
+        improved = {}
+        for p, start in queue.items():
+            stops = tt.pattern_stops[p]
+            arr = tt.arrivals[p]
+            dep = tt.departures[p]
+            trip = -1
+            board_pos = -1
+            for pos in range(start, len(stops)):
+                s = stops[pos]
+                if trip >= 0 and arr[trip, pos] < best[s]:
+                    best[s] = current[s] = arr[trip, pos]
+                    best_round[s] = k
+                    improved[s] = ('ride', p, trip, board_pos, pos)
+                # catch an earlier trip if we can reach this stop in time for it
+                if prev[s] < unreachable and (trip < 0 or prev[s] <= dep[trip, pos]):
+                    t = np.searchsorted(dep[:, pos], prev[s])
+                    if t < len(dep) and (trip < 0 or t < trip):
+                        trip = t
+                        board_pos = pos
+
+        # walking transfers from stops reached by vehicle this round
+        for s in list(improved):
+            for j in range(tt.transfer_ptr[s], tt.transfer_ptr[s + 1]):
+                u = tt.transfer_to[j]
+                t = current[s] + tt.transfer_secs[j]
+                if t < best[u]:
+                    best[u] = current[u] = t
+                    best_round[u] = k
+                    improved[u] = ('walk', s, tt.transfer_secs[j])
+
+        labels.append(improved)
+        if not improved:
+            break
+        marked = set(improved)
+
+    search['labels'] = labels
+    return search
+
+
+def trace_legs(tt, search, stop):
+    """
+    Rebuild the legs of the best journey to a stop, in search order.
+
+    Returns:
+        list: ('ride', route, board_stop, alight_stop, dep_time, arr_time, meters)
+            and ('walk', from_stop, to_stop, seconds) tuples.
+    """
+    legs = []
+    k = search['best_round'][stop]
+    labels = search['labels']
+    while k > 0:
+        # stops not improved in round k kept their round k - 1 label
+        while k > 0 and stop not in labels[k]:
+            k -= 1
+        if k == 0:
+            break
+        label = labels[k][stop]
+        if label[0] == 'walk':
+            legs.append(('walk', label[1], stop, label[2]))
+            stop = label[1]
+            continue
+        _, p, trip, board_pos, alight_pos = label
+        board_stop = tt.pattern_stops[p][board_pos]
+        legs.append(('ride', tt.pattern_routes[p], board_stop, stop,
+                     tt.departures[p][trip, board_pos], tt.arrivals[p][trip, alight_pos],
+                     tt.pattern_dist[p][alight_pos] - tt.pattern_dist[p][board_pos]))
+        stop = board_stop
+        k -= 1
+    return legs[::-1]
+
+
+def school_search(tt, school_lat, school_lon, seconds, ampm):
+    """
+    Run one search from a school covering every student's journey.
+
+    PM searches depart the school at `seconds`. AM searches run on the
+    reversed timetable so that arrival at the school is by `seconds`.
+    Times in the result are in search time: negated for AM searches.
+    """
+    dist = geo_utils.haversine_m(school_lat, school_lon, tt.stop_lat, tt.stop_lon)
+    access = np.flatnonzero(dist <= max_walk_miles / 0.00062137)
+    start = -seconds if ampm == 'am' else seconds
+    access_times = start + np.round(walk_seconds(dist[access])).astype(np.int64)
+    search = run_raptor(tt, access, access_times)
+    search['start'] = start
+    search['access_secs'] = dict(zip(access.tolist(), (access_times - start).tolist()))
+    return search
+
+
+def best_egress(tt, search, home_lat, home_lon, chunk=2000):
+    """
+    For each home, find the stop giving the earliest (search time) arrival
+    at the home, walking from the stop.
+
+    Returns:
+        tuple of numpy arrays: best stop (-1 if none), arrival at the home
+            via that stop, and the egress walk in seconds.
+    """
+    n = len(home_lat)
+    best_stop = np.full(n, -1, dtype=np.int64)
+    best_time = np.full(n, unreachable, dtype=np.int64)
+    egress = np.zeros(n, dtype=np.int64)
+    reached = np.flatnonzero(search['best'] < unreachable)
+    if len(reached) == 0:
+        return best_stop, best_time, egress
+    max_m = max_walk_miles / 0.00062137
+    for start in range(0, n, chunk):
+        dist = geo_utils.haversine_m(home_lat[start:start + chunk, None],
+                                     home_lon[start:start + chunk, None],
+                                     tt.stop_lat[None, reached], tt.stop_lon[None, reached])
+        walk = np.round(walk_seconds(dist)).astype(np.int64)
+        total = np.where(dist <= max_m, search['best'][reached][None, :] + walk, unreachable)
+        j = np.argmin(total, axis=1)
+        rows = np.arange(len(j))
+        ok = total[rows, j] < unreachable
+        best_stop[start:start + chunk] = np.where(ok, reached[j], -1)
+        best_time[start:start + chunk] = total[rows, j]
+        egress[start:start + chunk] = walk[rows, j]
+    return best_stop, best_time, egress
+
+
+def journey_record(tt, search, stop, egress_secs, direct_secs, direct_m, ampm):
+    """
+    Turn a search result for one student into a journey attribute record
+    with the same fields postprocess_journeys.extract_properties produces.
+    Origin and destination fields are filled in by the caller.
+    """
+    legs = trace_legs(tt, search, stop) if stop >= 0 else []
+    rides = [leg for leg in legs if leg[0] == 'ride']
+    if rides:
+        first_board = rides[0][2]
+        access_secs = search['access_secs'].get(first_board, 0)
+        walk_secs = access_secs + egress_secs + sum(leg[3] for leg in legs if leg[0] == 'walk')
+        transit_secs = sum(leg[5] - leg[4] for leg in rides)
+        start = rides[0][4] - access_secs
+        end = search['best'][stop] + egress_secs
+        walk_m = walk_secs * walk_speed / detour_factor
+        total_m = walk_m + sum(leg[6] for leg in rides)
+        if ampm == 'am':
+            # AM searches run backwards in negated time
+            start, end = -end, -start
+            rides = rides[::-1]
+
+    # walk instead if it's quicker than transit (or there is no transit),
+    # unless the walk is too long, as in travel_time_matrix
+    walkable = direct_m <= max_walk_miles / 0.00062137 * 3
+    if not rides and not walkable:
+        return {'notes': 'ZERO_RESULTS'}
+    if not rides or (walkable and direct_secs <= end - start):
+        return {'departure_time': None,
+                'arrival_time': None,
+                'total_minutes': round(direct_secs / 60, 1),
+                'total_miles': round(direct_m * detour_factor * 0.00062137, 2),
+                'notes': '',
+                'walk_time_minutes': round(direct_secs / 60, 1),
+                'walk_dist_miles': round(direct_m * detour_factor * 0.00062137, 2),
+                'transit_time_minutes': 0.0,
+                'num_transfers': 0,
+                'starting_stop': None,
+                'end_stop': None,
+                'routes_taken': ''}
+
+    if ampm == 'am':
+        starting_stop, end_stop = rides[0][3], rides[-1][2]
+    else:
+        starting_stop, end_stop = rides[0][2], rides[-1][3]
+    return {'departure_time': format_clock(start),
+            'arrival_time': format_clock(end),
+            'total_minutes': round((end - start) / 60, 1),
+            'total_miles': round(total_m * 0.00062137, 2),
+            'notes': '',
+            'walk_time_minutes': round(walk_secs / 60, 1),
+            'walk_dist_miles': round(walk_m * 0.00062137, 2),
+            'transit_time_minutes': round(transit_secs / 60, 1),
+            'num_transfers': len(rides) - 1,
+            'starting_stop': tt.stop_names[starting_stop],
+            'end_stop': tt.stop_names[end_stop],
+            'routes_taken': ', '.join(leg[1] for leg in rides)}
+
+
+def route_od(od, tt, ampm):
+    """
+    Route every row of an od_df dataset, with one search per distinct
+    school location and bell time.
+
+    Args:
+        od (pandas DataFrame): od_df dataset with home_lat, home_lon,
+            school_lat, school_lon and am_latest_arr / pm_earliest_dep.
+        tt (Timetable): timetable from load_gtfs.
+        ampm (str): whether the journeys are 'am' or 'pm'
+
+    Returns:
+        list: journey attribute records, in the same order as od.
+    """
+    search_tt = tt.reversed() if ampm == 'am' else tt
+    time_col = 'am_latest_arr' if ampm == 'am' else 'pm_earliest_dep'
+    records = [None] * len(od)
+    positions = np.arange(len(od))
+    keys = od[['school_lat', 'school_lon', time_col]].astype(str).agg('|'.join, axis=1)
+
+    for key, idx in pd.Series(positions).groupby(keys.to_numpy()):
+        rows = od.iloc[idx.to_numpy()]
+        first = rows.iloc[0]
+        school_lat, school_lon = float(first['school_lat']), float(first['school_lon'])
+        search = school_search(search_tt, school_lat, school_lon,
+                               clock_seconds(first[time_col]), ampm)
+        home_lat = rows['home_lat'].astype(float).to_numpy()
+        home_lon = rows['home_lon'].astype(float).to_numpy()
+        stops, times, egress = best_egress(search_tt, search, home_lat, home_lon)
+        direct_m = geo_utils.haversine_m(home_lat, home_lon, school_lat, school_lon)
+        direct_secs = walk_seconds(direct_m)
+
+        for i, pos in enumerate(idx.to_numpy()):
+            record = journey_record(search_tt, search, stops[i], egress[i],
+                                    direct_secs[i], direct_m[i], ampm)
+            home = {'address': rows['home_address'].iloc[i],
+                    'lat': home_lat[i], 'lon': home_lon[i]}
+            dest = {'address': first['school_address'],
+                    'lat': school_lat, 'lon': school_lon}
+            if ampm == 'pm':
+                home, dest = dest, home
+            record.update({'origin': home['address'],
+                           'origin_lat': home['lat'],
+                           'origin_lon': home['lon'],
+                           'dest': dest['address'],
+                           'dest_lat': dest['lat'],
+                           'dest_lon': dest['lon']})
+            records[pos] = record
+    return records
+
+
+def travel_time_matrix(tt, home_lat, home_lon, schools, ampm):
+    """
+    Door-to-door travel times from every home to every school.
+
+    Args:
+        tt (Timetable): timetable from load_gtfs.
+        home_lat, home_lon (numpy arrays): home coordinates.
+        schools (pandas DataFrame): school_lat, school_lon and bell time
+            (am_latest_arr or pm_earliest_dep) for each school.
+        ampm (str): whether the journeys are 'am' or 'pm'
+
+    Returns:
+        numpy array: (n_homes, n_schools) travel minutes, counted from the
+            bell (AM) or to the bell (PM), walking if that is quicker.
+            NaN where a school cannot be reached.
+    """
+    search_tt = tt.reversed() if ampm == 'am' else tt
+    time_col = 'am_latest_arr' if ampm == 'am' else 'pm_earliest_dep'
+    home_lat = np.asarray(home_lat, dtype=np.float64)
+    home_lon = np.asarray(home_lon, dtype=np.float64)
+    matrix = np.full((len(home_lat), len(schools)), np.nan)
+    for j, (_, row) in enumerate(schools.iterrows()):
+        search = school_search(search_tt, row['school_lat'], row['school_lon'],
+                               clock_seconds(row[time_col]), ampm)
+        stops, times, egress = best_egress(search_tt, search, home_lat, home_lon)
+        direct_m = geo_utils.haversine_m(home_lat, home_lon, row['school_lat'], row['school_lon'])
+        transit = np.where(stops >= 0, times - search['start'], np.inf)
+        direct = np.where(direct_m <= max_walk_miles / 0.00062137 * 3,
+                          walk_seconds(direct_m), np.inf)
+        best = np.minimum(transit, direct)
+        matrix[:, j] = np.where(np.isfinite(best), best / 60, np.nan)
+    return matrix
+
+
+def window_times(earliest, latest, step_minutes=5):
+    """
+    Times from earliest to latest (inclusive) every step_minutes,
+    e.g. the AM window between am_earliest_arr and am_latest_arr.
+
+    Returns:
+        list: seconds after midnight.
+    """
+    start, end = clock_seconds(earliest), clock_seconds(latest)
+    return list(range(start, end + 1, step_minutes * 60))
+
+
+def sweep(tt, school_lat, school_lon, times, target_lat, target_lon, ampm):
+    """
+    Travel times between a school and many targets (homes or grid points)
+    for every time in a window, using one range-RAPTOR search.
+
+    The search for each time reuses the results of the search for the
+    next later start, so the whole window costs little more than one search.
+
+    Args:
+        tt (Timetable): timetable from load_gtfs (not reversed).
+        school_lat, school_lon (float): school location.
+        times (list): seconds after midnight -- arrive-by times for AM,
+            departure times for PM. See window_times.
+        target_lat, target_lon (numpy arrays): target coordinates.
+        ampm (str): whether the journeys are 'am' or 'pm'
+
+    Returns:
+        numpy array: (n_targets, n_times) travel minutes, counted from the
+            bell (AM) or to the bell (PM), walking if that is quicker.
+            inf where the school cannot be reached.
+    """
+    search_tt = tt.reversed() if ampm == 'am' else tt
+    target_lat = np.asarray(target_lat, dtype=np.float64)
+    target_lon = np.asarray(target_lon, dtype=np.float64)
+    dist = geo_utils.haversine_m(school_lat, school_lon, search_tt.stop_lat, search_tt.stop_lon)
+    access = np.flatnonzero(dist <= max_walk_miles / 0.00062137)
+    access_walk = np.round(walk_seconds(dist[access])).astype(np.int64)
+    direct_m = geo_utils.haversine_m(target_lat, target_lon, school_lat, school_lon)
+    direct = np.where(direct_m <= max_walk_miles / 0.00062137 * 3,
+                      walk_seconds(direct_m), np.inf)
+
+    minutes = np.full((len(target_lat), len(times)), np.inf)
+    starts = [-t if ampm == 'am' else t for t in times]
+    search = None
+    # range RAPTOR: latest start first, so each result bounds the next search
+    for j in np.argsort(starts)[::-1]:
+        search = run_raptor(search_tt, access, starts[j] + access_walk, search=search)
+        stops, arrival, egress = best_egress(search_tt, search, target_lat, target_lon)
+        transit = np.where(stops >= 0, arrival - starts[j], np.inf)
+        minutes[:, j] = np.minimum(transit, direct) / 60
+    return minutes
+
+
+def window_surface(tt, schools, target_lat, target_lon, ampm, step_minutes=5,
+                   percentiles=(5, 25, 50, 75, 95), cutoffs=(30, 45, 60, 75, 90)):
+    """
+    Percentile travel-time surfaces over each school's arrival (AM) or
+    departure (PM) window, rather than a single snapshot time.
+
+    Args:
+        tt (Timetable): timetable from load_gtfs.
+        schools (pandas DataFrame): school_name, school_lat, school_lon and
+            am_earliest_arr / am_latest_arr (AM) or
+            pm_earliest_dep / pm_latest_dep (PM) for each school.
+        target_lat, target_lon (numpy arrays): points to measure, e.g.
+            student homes or a grid covering the district.
+        ampm (str): whether the journeys are 'am' or 'pm'
+        step_minutes (int): spacing of times across the window.
+        percentiles (tuple): travel-time percentiles to report.
+        cutoffs (tuple): minutes; for each cutoff, report the share of the
+            window in which the school is reachable within it.
+
+    Returns:
+        pandas DataFrame: one row per school and target, with columns
+            school_name, target, lat, lon, p[N] travel minutes
+            (empty where unreachable) and within_[cutoff] shares.
+    """
+    if ampm == 'am':
+        first_col, last_col = 'am_earliest_arr', 'am_latest_arr'
+    else:
+        first_col, last_col = 'pm_earliest_dep', 'pm_latest_dep'
+    frames = []
+    for _, row in schools.iterrows():
+        times = window_times(row[first_col], row[last_col], step_minutes)
+        minutes = sweep(tt, row['school_lat'], row['school_lon'], times,
+                        target_lat, target_lon, ampm)
+        frame = pd.DataFrame({'school_name': row['school_name'],
+                              'target': np.arange(len(minutes)),
+                              'lat': target_lat,
+                              'lon': target_lon})
+        # 'nearest' avoids interpolating with unreachable (infinite) times
+        values = np.percentile(minutes, percentiles, axis=1, method='nearest')
+        for pct, value in zip(percentiles, values):
+            frame['p{}'.format(pct)] = np.where(np.isfinite(value), np.round(value, 1), np.nan)
+        for cutoff in cutoffs:
+            frame['within_{}'.format(cutoff)] = (minutes <= cutoff).mean(axis=1)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def make_grid(lat_min, lat_max, lon_min, lon_max, spacing_miles=0.25):
+    """
+    Regular grid of points covering a bounding box, for window_surface.
+
+    Returns:
+        tuple of numpy arrays: grid latitudes and longitudes.
+    """
+    dlat = spacing_miles / 69.0
+    dlon = dlat / np.cos(np.radians((lat_min + lat_max) / 2))
+    lats, lons = np.meshgrid(np.arange(lat_min, lat_max, dlat),
+                             np.arange(lon_min, lon_max, dlon), indexing='ij')
+    return lats.ravel(), lons.ravel()
+
+
+def main():
+    import postprocess_journeys
+
+    tt = load_gtfs(gtfs_path)
+    od = od_store.read_table(od_path)
+    records = route_od(od, tt, ampm)
+    postprocess_journeys.write_records(records, out_path)
+
+
+if __name__ == '__main__':
+    main()
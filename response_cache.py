@@ -0,0 +1,153 @@
+# Persistent on-disk cache for API responses
+# Responses are stored in a SQLite file, keyed by a hash of the normalized request,
+# so re-running a school only pays for requests that actually changed
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+# Directions API statuses that are safe to cache -- anything else
+# (quota errors, server errors) should be retried on the next run
+CACHEABLE_STATUSES = ('OK', 'ZERO_RESULTS', 'NOT_FOUND')
+
+
+def make_key(request):
+    """
+    Hash a JSON-serializable request description into a cache key.
+    """
+    text = json.dumps(request, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def normalize_directions_params(params):
+    """
+    Normalize Google Directions API parameters for use as a cache key.
+
+    The API key is dropped, addresses are whitespace- and case-normalized,
+    and arrival/departure timestamps are mapped to weekday and time of day
+    (in UTC) so that runs on different weeks share cache entries.
+
+    Args:
+        params (dict): output of gen_student_journeys.format_params
+
+    Returns:
+        dict: normalized parameters
+    """
+    normalized = {}
+    for k, v in params.items():
+        if k == 'key':
+            continue
+        if k in ('origin', 'destination'):
+            v = ' '.join(str(v).split()).casefold()
+        elif k in ('arrival_time', 'departure_time'):
+            v = datetime.fromtimestamp(int(v), tz=timezone.utc).strftime('%a %H:%M:%S')
+        normalized[k] = v
+    return normalized
+
+
+def directions_key(params):
+    return make_key(normalize_directions_params(params))
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache with TTL and size-based eviction.
+
+    Safe to share between threads.
+
+    Args:
+        path (str): SQLite file to store responses in.
+        namespace (str): table name, so several APIs can share one file.
+        max_age_days (float, optional): entries older than this are evicted.
+        max_entries (int, optional): keep at most this many entries,
+            evicting the least recently used ones first.
+        offline (bool): cache-only mode. Callers should check this flag
+            and skip the API on a miss.
+    """
+    def __init__(self, path, namespace='directions', max_age_days=None,
+                 max_entries=None, offline=False):
+        self.path = path
+        self.table = namespace
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS {} (
+                                 key TEXT PRIMARY KEY,
+                                 value TEXT NOT NULL,
+                                 created REAL NOT NULL,
+                                 accessed REAL NOT NULL)'''.format(self.table))
+        self.conn.commit()
+        self.evict()
+
+    def get(self, key):
+        """
+        Look up a cached response.
+
+        Returns:
+            dict: the cached response, or None on a miss.
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT value, created FROM {} WHERE key = ?'.format(self.table),
+                                    (key,)).fetchone()
+            now = time.time()
+            if row is not None and self.max_age_days is not None \
+                    and now - row[1] > self.max_age_days * 86400:
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute('UPDATE {} SET accessed = ? WHERE key = ?'.format(self.table),
+                              (now, key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Store a JSON-serializable response under key.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?)'.format(self.table),
+                              (key, json.dumps(value), now, now))
+            self.conn.commit()
+
+    def evict(self):
+        """
+        Remove expired entries, then trim to max_entries by least recent access.
+        """
+        with self.lock:
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 86400
+                self.conn.execute('DELETE FROM {} WHERE created < ?'.format(self.table),
+                                  (cutoff,))
+            if self.max_entries is not None:
+                self.conn.execute('''DELETE FROM {0} WHERE key NOT IN (
+                                         SELECT key FROM {0}
+                                         ORDER BY accessed DESC LIMIT ?)'''.format(self.table),
+                                  (self.max_entries,))
+            self.conn.commit()
+
+    def stats(self):
+        """
+        Returns:
+            dict: hit and miss counts, hit rate and number of stored entries.
+        """
+        with self.lock:
+            size = self.conn.execute('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'entries': size}
+
+    def close(self):
+        self.evict()
+        self.conn.close()
@@ -0,0 +1,194 @@
+# Spatial indexes over the GeoJSON layers (stops, ZCTAs, isochrones)
+# Answers point-in-polygon and nearest-stop questions for whole OD tables at once
+# using shapely's STRtree, instead of testing every student against every feature
+# Requires shapely 2.0 or later
+
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+import geo_utils
+import od_store
+
+# example layers
+isochrone_path = 'outputs/elpaso/otp_isochrones_720am.geojson'
+zcta_path = 'outputs/elpaso/el_paso_zctas.geojson'
+stop_path = 'outputs/elpaso/SunMetroElPaso_Stops.geojson'
+
+
+class LayerIndex:
+    """
+    STRtree index over the features of one layer.
+
+    Point layers are indexed in locally scaled coordinates
+    (longitude times the cosine of the layer's mean latitude), so that
+    nearest-neighbor searches are not skewed by degrees of longitude
+    being shorter than degrees of latitude.
+
+    Args:
+        geometries (numpy array): shapely geometries, in lon/lat.
+        properties (pandas DataFrame): one row of attributes per geometry.
+    """
+    def __init__(self, geometries, properties):
+        self.geometries = np.asarray(geometries)
+        self.properties = properties.reset_index(drop=True)
+        self.points = bool(len(self.geometries)) and \
+            (shapely.get_type_id(self.geometries) == 0).all()
+        if self.points:
+            coords = shapely.get_coordinates(self.geometries)
+            self.scale = np.cos(np.radians(coords[:, 1].mean()))
+            self.tree = STRtree(shapely.points(coords[:, 0] * self.scale, coords[:, 1]))
+        else:
+            self.scale = 1.0
+            self.tree = STRtree(self.geometries)
+
+    @classmethod
+    def from_geojson(cls, path):
+        """
+        Build an index from a GeoJSON file.
+        """
+        with open(path) as f:
+            features = json.load(f)['features']
+        geometries = shapely.from_geojson([json.dumps(f['geometry']) for f in features])
+        properties = pd.DataFrame([f.get('properties') or {} for f in features])
+        return cls(geometries, properties)
+
+    def containing(self, lon, lat):
+        """
+        Find the features containing each point.
+
+        Args:
+            lon, lat (array-like): point coordinates.
+
+        Returns:
+            tuple of numpy arrays: (point index, feature index) pairs,
+                one pair for every point-feature match.
+        """
+        pts = shapely.points(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        matches = self.tree.query(pts, predicate='within')
+        return matches[0], matches[1]
+
+    def nearest(self, lon, lat):
+        """
+        Find the nearest feature of a point layer to each point.
+
+        Returns:
+            tuple of numpy arrays: nearest feature index for each point,
+                and the distance to it in miles.
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        pts = shapely.points(lon * self.scale, lat)
+        point_idx, feature_idx = self.tree.query_nearest(pts, all_matches=False)
+        nearest = np.full(len(pts), -1, dtype=np.int64)
+        nearest[point_idx] = feature_idx
+        coords = shapely.get_coordinates(self.geometries)[nearest]
+        miles = geo_utils.haversine_miles(lat, lon, coords[:, 1], coords[:, 0])
+        return nearest, miles
+
+
+def isochrone_band(index, lon, lat, time_field='time'):
+    """
+    Smallest isochrone cutoff containing each point.
+
+    Isochrone times straight from OTP are in seconds, while the files
+    gen_transit_isochrones writes are in minutes. Times over 180 are
+    assumed to be seconds and converted.
+
+    Returns:
+        numpy array: cutoff in minutes for each point, NaN if outside all bands.
+    """
+    times = index.properties[time_field].to_numpy(dtype=float)
+    if times.max() > 180:
+        times = times / 60
+    point_idx, feature_idx = index.containing(lon, lat)
+    band = np.full(len(np.atleast_1d(lon)), np.inf)
+    np.minimum.at(band, point_idx, times[feature_idx])
+    band[np.isinf(band)] = np.nan
+    return band
+
+
+def polygon_attribute(index, lon, lat, field):
+    """
+    Attribute of the polygon containing each point (e.g. a ZCTA code).
+    If polygons overlap, the first match wins.
+
+    Returns:
+        numpy array: the attribute for each point, None if outside all polygons.
+    """
+    point_idx, feature_idx = index.containing(lon, lat)
+    values = np.full(len(np.atleast_1d(lon)), None, dtype=object)
+    first = np.unique(point_idx, return_index=True)[1]
+    values[point_idx[first]] = index.properties[field].to_numpy()[feature_idx[first]]
+    return values
+
+
+def annotate_od(od, isochrones=None, zctas=None, stops=None,
+                lat_col='home_lat', lon_col='home_lon', zcta_field='ZCTA5CE10'):
+    """
+    Add isochrone band, ZCTA and nearest stop columns to an OD table.
+
+    Args:
+        od (pandas DataFrame): table with point coordinates, e.g. an od_df.
+        isochrones (LayerIndex, optional): one school's isochrones.
+        zctas (LayerIndex, optional): ZCTA polygons.
+        stops (LayerIndex, optional): transit stop points.
+        lat_col, lon_col (str): coordinate columns to use.
+        zcta_field (str): ZCTA code property in the ZCTA layer.
+
+    Returns:
+        pandas DataFrame: copy of od with iso_band_minutes, zcta,
+            nearest_stop_id, nearest_stop_name and nearest_stop_miles
+            columns (for the layers given).
+    """
+    od = od.copy()
+    lat = pd.to_numeric(od[lat_col], errors='coerce').to_numpy()
+    lon = pd.to_numeric(od[lon_col], errors='coerce').to_numpy()
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+
+    if isochrones is not None:
+        band = np.full(len(od), np.nan)
+        band[valid] = isochrone_band(isochrones, lon[valid], lat[valid])
+        od['iso_band_minutes'] = band
+    if zctas is not None:
+        codes = np.full(len(od), None, dtype=object)
+        codes[valid] = polygon_attribute(zctas, lon[valid], lat[valid], zcta_field)
+        od['zcta'] = codes
+    if stops is not None:
+        nearest = np.full(len(od), -1, dtype=np.int64)
+        miles = np.full(len(od), np.nan)
+        nearest[valid], miles[valid] = stops.nearest(lon[valid], lat[valid])
+        found = nearest >= 0
+        for col in ('stop_id', 'stop_name'):
+            values = np.full(len(od), None, dtype=object)
+            values[found] = stops.properties[col].to_numpy()[nearest[found]]
+            od['nearest_' + col] = values
+        od['nearest_stop_miles'] = np.round(miles, 3)
+    return od
+
+
+def students_per_zcta(od, zctas, **kwargs):
+    """
+    Count students by home ZCTA.
+
+    Returns:
+        pandas Series: student counts indexed by ZCTA code.
+    """
+    return annotate_od(od, zctas=zctas, **kwargs)['zcta'].value_counts()
+
+
+def main():
+    od = od_store.read_table('temp/indy/od/school=999_school_name')
+    annotated = annotate_od(od,
+                            isochrones=LayerIndex.from_geojson(isochrone_path),
+                            zctas=LayerIndex.from_geojson(zcta_path),
+                            stops=LayerIndex.from_geojson(stop_path))
+    print(annotated[['home_address', 'iso_band_minutes', 'zcta',
+                     'nearest_stop_name', 'nearest_stop_miles']])
+
+
+if __name__ == '__main__':
+    main()
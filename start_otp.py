@@ -1,26 +1,231 @@
+import argparse
+import os
+import signal
 import socket
 import subprocess
+import sys
+import time
+import requests
 
-import win32api
-import win32con
+# server settings
+otp_dir = 'otp'  # folder with the OTP jar and graphs folder
+otp_jar = 'otp-1.4.0-shaded.jar'
+graphs_dir = 'graphs'  # relative to otp_dir
+java = 'java'
+default_heap = '4096m'  # JVM heap, passed to -Xmx
+default_port = 8080
+startup_timeout = 900  # seconds to wait for graphs to load
+log_path = 'otp/otp_server.log'
+
+# warm-up query settings
+warm_up_date = '06-17-2020'
+warm_up_time = '7:30am'
 
 
 def port_is_free(port):
+    # connect rather than bind: SO_REUSEADDR would let a bind succeed on
+    # Windows while a server is still listening, and a plain bind fails on
+    # connections left in TIME_WAIT by a server that just stopped
     s = socket.socket()
-    result = False
-    try:
-        s.bind(("0.0.0.0", port))
-        result = True
-    except:
+    s.settimeout(1)
+    result = s.connect_ex(("localhost", port)) != 0
+    if not result:
         print("Port {} is in use".format(port))
     s.close()
     return result
 
-if port_is_free(8080):
-    print('port is free')
-    subprocess.Popen('''powershell.exe 
-                        cd otp;
-                        java -Xmx4096m -jar otp-1.4.0-shaded.jar --router houston --graphs graphs --server''')
-else:
-    win32api.GenerateConsoleCtrlEvent(win32con.CTRL_C_EVENT, 0)
-    print('Server stopped')
+
+class OTPServer:
+    """
+    Start, health check, warm up and stop a local OpenTripPlanner server.
+
+    Works as a context manager, so the server is stopped even if a batch
+    run fails:
+
+        with OTPServer('indy2') as server:
+            server.warm_up()
+            gen_transit_isochrones.batch_process(school_list, 'indy2')
+
+    If a server that already serves all the routers is listening on the
+    port, it is reused and left running on exit.
+
+    Args:
+        routers (str or list): router name(s) to load, i.e. folders in graphs_dir.
+        port (int, optional): port to serve on. Defaults to default_port.
+        heap (str, optional): JVM maximum heap size, e.g. '4096m' or '12g'.
+            Defaults to default_heap.
+    """
+    def __init__(self, routers, port=None, heap=None):
+        self.routers = [routers] if isinstance(routers, str) else list(routers)
+        self.port = port or default_port
+        self.heap = heap or default_heap
+        self.url = 'http://localhost:{}'.format(self.port)
+        self.process = None
+        self.log = None
+        self.timings = {}
+
+    def command(self):
+        cmd = [java, '-Xmx{}'.format(self.heap), '-jar', otp_jar,
+               '--graphs', graphs_dir, '--port', str(self.port), '--server']
+        for router in self.routers:
+            cmd += ['--router', router]
+        return cmd
+
+    def is_ready(self):
+        """
+        Readiness probe: every router answers on /otp/routers/[router].
+        """
+        try:
+            for router in self.routers:
+                r = requests.get('{}/otp/routers/{}'.format(self.url, router),
+                                 headers={'Accept': 'application/json'}, timeout=10)
+                if r.status_code != 200:
+                    return False
+        except requests.RequestException:
+            return False
+        return True
+
+    def start(self, timeout=startup_timeout):
+        """
+        Launch the server and wait until every router is loaded.
+
+        Returns:
+            float: cold start time in seconds.
+        """
+        if not port_is_free(self.port):
+            if self.is_ready():
+                print('Using the OTP server already running at {}'.format(self.url))
+                return 0.0
+            raise RuntimeError('Port {} is in use by something other than an OTP '
+                               'server for {}'.format(self.port, ', '.join(self.routers)))
+
+        os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+        self.log = open(log_path, 'w')
+        kwargs = {}
+        if os.name == 'nt':
+            kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs['start_new_session'] = True
+        print('Starting OTP: {}'.format(' '.join(self.command())))
+        start = time.perf_counter()
+        self.process = subprocess.Popen(self.command(), cwd=otp_dir, stdout=self.log,
+                                        stderr=subprocess.STDOUT, **kwargs)
+        try:
+            self.wait_ready(timeout)
+        except Exception:
+            self.stop()
+            raise
+        self.timings['cold_start_seconds'] = round(time.perf_counter() - start, 1)
+        print('OTP ready in {}s'.format(self.timings['cold_start_seconds']))
+        return self.timings['cold_start_seconds']
+
+    def wait_ready(self, timeout=startup_timeout, interval=2):
+        """
+        Poll the readiness probe until it passes, the server exits, or
+        timeout seconds pass.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.is_ready():
+            if self.process is not None and self.process.poll() is not None:
+                raise RuntimeError('OTP exited with code {}, see {}'.format(
+                    self.process.returncode, log_path))
+            if time.monotonic() > deadline:
+                raise TimeoutError('OTP was not ready after {}s, see {}'.format(timeout, log_path))
+            time.sleep(interval)
+
+    def warm_up(self, places=None):
+        """
+        Send a trip plan and an isochrone request to each router, so that
+        lazy loading and JIT compilation don't slow down the first real requests.
+
+        Args:
+            places (dict, optional): router -> 'lat,lon' to query from.
+                Defaults to the center of each router's graph.
+
+        Returns:
+            float: warm-up time in seconds.
+        """
+        places = places or {}
+        start = time.perf_counter()
+        for router in self.routers:
+            base = '{}/otp/routers/{}'.format(self.url, router)
+            place = places.get(router)
+            if place is None:
+                info = requests.get(base, headers={'Accept': 'application/json'},
+                                    timeout=60).json()
+                place = '{},{}'.format(info['centerLatitude'], info['centerLongitude'])
+            params = {'fromPlace': place,
+                      'toPlace': place,
+                      'mode': 'WALK,TRANSIT',
+                      'date': warm_up_date,
+                      'time': warm_up_time}
+            for endpoint, extra in (('plan', {}), ('isochrone', {'cutoffSec': 1800})):
+                query_start = time.perf_counter()
+                try:
+                    r = requests.get('{}/{}'.format(base, endpoint), params=dict(params, **extra),
+                                     headers={'Accept': 'application/json'}, timeout=600)
+                    status = r.status_code
+                except requests.RequestException as e:
+                    status = type(e).__name__
+                print('Warm-up {} {}: {} in {:.2f}s'.format(router, endpoint, status,
+                                                           time.perf_counter() - query_start))
+        self.timings['warm_up_seconds'] = round(time.perf_counter() - start, 1)
+        return self.timings['warm_up_seconds']
+
+    def stop(self, timeout=30):
+        """
+        Stop the server if this object started it: interrupt it first,
+        and kill it if it hasn't exited after timeout seconds.
+        """
+        if self.process is not None and self.process.poll() is None:
+            if os.name == 'nt':
+                self.process.send_signal(signal.CTRL_BREAK_EVENT)
+            else:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            print('OTP server stopped')
+        self.process = None
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local OpenTripPlanner server.')
+    parser.add_argument('--router', action='append', required=True,
+                        help='router to load; repeat to load several')
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--heap', default=default_heap, help='JVM heap size, e.g. 4096m')
+    parser.add_argument('--no-warm-up', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = OTPServer(args.router, port=args.port, heap=args.heap)
+    with server:
+        if not args.no_warm_up:
+            server.warm_up()
+        print(server.timings)
+        if server.process is None:
+            return
+        print('Serving at {}, press Ctrl-C to stop'.format(server.url))
+        try:
+            server.process.wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
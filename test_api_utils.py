@@ -0,0 +1,114 @@
+import time
+
+import pytest
+
+import api_utils
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(api_utils, 'backoff_delay', lambda status, attempt: 0)
+
+
+def test_token_bucket_below_one_per_second():
+    bucket = api_utils.TokenBucket(0.5)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start < 0.1
+
+
+def test_token_bucket_limits_rate():
+    bucket = api_utils.TokenBucket(20, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # the first token is free, the other five take 1/20s each
+    assert time.monotonic() - start >= 0.2
+
+
+def test_token_bucket_disabled():
+    bucket = api_utils.TokenBucket(None)
+    start = time.monotonic()
+    for _ in range(100):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.1
+
+
+def test_get_with_retry_retries_retryable_status(stub_server):
+    calls = []
+
+    def respond(path, params):
+        calls.append(path)
+        return (503, {}) if len(calls) < 3 else (200, {'status': 'OK'})
+
+    server = stub_server(respond)
+    r = api_utils.get_with_retry(server.url + '/maps/api/directions/json',
+                                 session=api_utils.make_session(2))
+    assert r.status_code == 200
+    assert len(calls) == 3
+
+
+def test_get_with_retry_gives_up(stub_server):
+    server = stub_server(lambda path, params: (503, {}))
+    r = api_utils.get_with_retry(server.url, max_retries=2)
+    assert r.status_code == 503
+    assert len(server.requests) == 3
+
+
+def test_get_with_retry_is_retryable(stub_server):
+    calls = []
+
+    def respond(path, params):
+        calls.append(path)
+        return 200, {'status': 'OVER_QUERY_LIMIT' if len(calls) == 1 else 'OK'}
+
+    server = stub_server(respond)
+    r = api_utils.get_with_retry(server.url, is_retryable=lambda r: r.json()['status']
+                                 if r.json()['status'] == 'OVER_QUERY_LIMIT' else None)
+    assert r.json()['status'] == 'OK'
+    assert len(calls) == 2
+
+
+def test_get_with_retry_does_not_retry_client_errors(stub_server):
+    server = stub_server(lambda path, params: (400, {}))
+    r = api_utils.get_with_retry(server.url)
+    assert r.status_code == 400
+    assert len(server.requests) == 1
+
+
+def test_map_ordered_keeps_order_and_bounds_concurrency(stub_server):
+    server = stub_server(lambda path, params: (200, {'i': int(params['i'])}), delay=0.02)
+    session = api_utils.make_session(4)
+
+    def fetch(i):
+        return api_utils.get_with_retry(server.url, params={'i': i}, session=session).json()['i']
+
+    results = list(api_utils.map_ordered(fetch, range(40), max_workers=4))
+    session.close()
+    assert results == list(range(40))
+    assert 1 < server.max_in_flight <= 4
+
+
+def test_map_ordered_with_rate_limit(stub_server):
+    server = stub_server(lambda path, params: (200, {}))
+    bucket = api_utils.TokenBucket(50, capacity=1)
+    start = time.monotonic()
+    list(api_utils.map_ordered(lambda i: api_utils.get_with_retry(server.url, bucket=bucket),
+                               range(11), max_workers=8))
+    # 8 threads, but still no more than 50 requests per second
+    assert time.monotonic() - start >= 0.2
+    assert len(server.requests) == 11
+
+
+def test_map_ordered_bounds_in_flight_items():
+    submitted = []
+
+    def items():
+        for i in range(100):
+            submitted.append(i)
+            yield i
+
+    results = api_utils.map_ordered(lambda i: i, items(), max_workers=2, max_in_flight=5)
+    assert next(results) == 0
+    assert len(submitted) <= 6
+    assert list(results) == list(range(1, 100))
@@ -0,0 +1,86 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import api_utils
+import gen_transit_isochrones
+
+
+def isochrone(path, params):
+    if params['fromPlace'].startswith('0.0'):
+        return 400, {'error': 'no stops nearby'}
+    # the stub only sees the first cutoff
+    return 200, {'type': 'FeatureCollection',
+                 'features': [{'type': 'Feature',
+                               'properties': {'time': int(params['cutoffSec'])},
+                               'geometry': {'type': 'MultiPolygon', 'coordinates': []}}]}
+
+
+@pytest.fixture
+def otp(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api_utils, 'backoff_delay', lambda status, attempt: 0)
+    server = stub_server(lambda path, params: isochrone(path, params)
+                         if path.endswith('/isochrone') else (200, {'routerId': 'indy'}),
+                         delay=0.02)
+    monkeypatch.setattr(gen_transit_isochrones, 'otp_url', server.url)
+    monkeypatch.setattr(gen_transit_isochrones, 'iso_cache_path',
+                        str(tmp_path / 'isochrone_cache.sqlite'))
+    monkeypatch.setattr(gen_transit_isochrones, 'otp_graphs_dir', str(tmp_path / 'graphs'))
+    return server
+
+
+def write_locations(path, coords):
+    pd.DataFrame({'school_name': ['School {}'.format(i) for i in range(len(coords))],
+                  'school_lat': [lat for lat, lon in coords],
+                  'school_lon': [lon for lat, lon in coords],
+                  'am_latest_arr': '7:30 AM',
+                  'pm_earliest_dep': '2:30 PM'}).to_csv(path, index=False)
+    return str(path)
+
+
+def test_batch_process_writes_isochrones(otp, tmp_path):
+    coords = [(39.7 + i / 100, -86.1) for i in range(6)]
+    locations = write_locations(tmp_path / 'schools.csv', coords)
+    failed = gen_transit_isochrones.batch_process(locations, 'indy', workers=3, use_cache=False)
+    assert failed == []
+    isochrone_requests = [r for r in otp.requests if r[0] == '/otp/routers/indy/isochrone']
+    assert len(isochrone_requests) == 12
+    assert 1 < otp.max_in_flight <= 3
+    with open('outputs/indy/school_0/isos_730am_jun17.geojson') as f:
+        isos = json.load(f)
+    assert isos['name'] == 'school_0_am_isochrones'
+    assert isos['features'][0]['properties']['time'] == 30
+    assert os.path.exists('outputs/indy/school_5/isos_230pm_jun17.geojson')
+
+
+def test_batch_process_reports_failures(otp, tmp_path):
+    locations = write_locations(tmp_path / 'schools.csv', [(39.7, -86.1), (0.0, 0.0)])
+    failed = gen_transit_isochrones.batch_process(locations, 'indy', workers=2, use_cache=False)
+    assert sorted((job['school_name'], job['ampm']) for job in failed) == \
+        [('school_1', 'am'), ('school_1', 'pm')]
+    assert os.path.exists('outputs/indy/school_0/isos_730am_jun17.geojson')
+
+
+def test_batch_process_skips_unchanged(otp, tmp_path):
+    locations = write_locations(tmp_path / 'schools.csv', [(39.7, -86.1), (39.8, -86.2)])
+    gen_transit_isochrones.batch_process(locations, 'indy', workers=2)
+    first = len([r for r in otp.requests if r[0].endswith('/isochrone')])
+    assert first == 4
+
+    # nothing changed: no isochrone requests
+    assert gen_transit_isochrones.batch_process(locations, 'indy', workers=2) == []
+    assert len([r for r in otp.requests if r[0].endswith('/isochrone')]) == first
+
+    # a deleted output comes back from the cache
+    os.remove('outputs/indy/school_1/isos_730am_jun17.geojson')
+    gen_transit_isochrones.batch_process(locations, 'indy', workers=2)
+    assert len([r for r in otp.requests if r[0].endswith('/isochrone')]) == first
+    assert os.path.exists('outputs/indy/school_1/isos_730am_jun17.geojson')
+
+    # a moved school is requested again
+    write_locations(tmp_path / 'schools.csv', [(39.7, -86.1), (39.9, -86.2)])
+    gen_transit_isochrones.batch_process(locations, 'indy', workers=2)
+    assert len([r for r in otp.requests if r[0].endswith('/isochrone')]) == first + 2
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+import api_utils
+import metrics
+import response_cache
+
+
+@pytest.fixture(scope='module')
+def geocode_and_prep(tmp_path_factory):
+    # the script reads its key from config.ini when imported
+    config_dir = tmp_path_factory.mktemp('config')
+    (config_dir / 'config.ini').write_text('[auth]\ngkey = test\ngkey2 = test\n')
+    cwd = os.getcwd()
+    os.chdir(config_dir)
+    try:
+        import geocode_and_prep
+    finally:
+        os.chdir(cwd)
+    return geocode_and_prep
+
+
+@pytest.fixture
+def geocoder(geocode_and_prep, stub_server, monkeypatch):
+    """
+    Stub Geocoding API: '1 Main St' is found, 'nowhere' isn't, 'flaky' is
+    over the query limit once and 'broken' always fails with UNKNOWN_ERROR.
+    """
+    monkeypatch.setattr(api_utils, 'backoff_delay', lambda status, attempt: 0)
+    metrics.metrics.reset()
+    calls = []
+
+    def respond(path, params):
+        address = params['address']
+        calls.append(address)
+        if address == 'nowhere':
+            return 200, {'status': 'ZERO_RESULTS', 'results': []}
+        if address == 'flaky' and calls.count(address) == 1:
+            return 200, {'status': 'OVER_QUERY_LIMIT', 'results': []}
+        if address == 'broken':
+            return 200, {'status': 'UNKNOWN_ERROR', 'results': []}
+        if address == 'denied':
+            return 200, {'status': 'REQUEST_DENIED', 'results': [],
+                         'error_message': 'The provided API key is invalid.'}
+        return 200, {'status': 'OK',
+                     'results': [{'geometry': {'location': {'lat': 39.7, 'lng': -86.1}}}]}
+
+    server = stub_server(respond)
+    monkeypatch.setattr(geocode_and_prep, 'g_api', server.url + '/maps/api/geocode/json')
+    return calls
+
+
+def test_retries_over_query_limit(geocode_and_prep, geocoder):
+    assert geocode_and_prep.google_geocode_address('flaky') == (-86.1, 39.7)
+    assert geocoder == ['flaky', 'flaky']
+
+
+def test_failures_are_not_cached(geocode_and_prep, geocoder, tmp_path):
+    cache = response_cache.ResponseCache(str(tmp_path / 'geocode.sqlite'))
+    addresses = ['1 Main St', 'nowhere', 'broken']
+    coords = geocode_and_prep.geocode_unique(addresses, cache=cache, workers=2)
+    assert coords == {'1 MAIN ST': (-86.1, 39.7), 'NOWHERE': (None, None),
+                      'BROKEN': (None, None)}
+    counters = metrics.summary()['counters']
+    assert counters['geocode_failures'] == {'status=UNKNOWN_ERROR': 1}
+
+    # only the found address is reused, the others are asked again
+    geocoder.clear()
+    geocode_and_prep.geocode_unique(addresses, cache=cache, workers=2)
+    assert sorted(set(geocoder)) == ['broken', 'nowhere']
+    cache.close()
+
+
+def test_denied_requests_raise(geocode_and_prep, geocoder):
+    with pytest.raises(RuntimeError, match='REQUEST_DENIED'):
+        geocode_and_prep.geocode_unique(['1 Main St', 'denied'], workers=1)
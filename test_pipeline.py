@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from functools import partial
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def pipeline(tmp_path_factory):
+    # the API scripts read their keys from config.ini when imported
+    config_dir = tmp_path_factory.mktemp('config')
+    (config_dir / 'config.ini').write_text('[auth]\ngkey = test\ngkey2 = test\n')
+    cwd = os.getcwd()
+    os.chdir(config_dir)
+    try:
+        import pipeline
+    finally:
+        os.chdir(cwd)
+    return pipeline
+
+
+def copy_upper(src, dst, calls):
+    calls.append(os.path.basename(dst))
+    with open(src) as f:
+        text = f.read()
+    with open(dst, 'w') as f:
+        f.write(text.upper())
+
+
+def fail(calls):
+    calls.append('fail')
+    raise RuntimeError('stage failed')
+
+
+def toy_stages(pipeline, tmp_path, calls):
+    """
+    a.txt -> b.txt -> c.txt, and a separate branch x.txt -> y.txt
+    """
+    paths = {name: str(tmp_path / '{}.txt'.format(name)) for name in 'abcxy'}
+    for name in 'ax':
+        if not os.path.exists(paths[name]):
+            with open(paths[name], 'w') as f:
+                f.write(name)
+    return [pipeline.Stage('c', partial(copy_upper, paths['b'], paths['c'], calls),
+                           inputs=[paths['b']], outputs=[paths['c']]),
+            pipeline.Stage('b', partial(copy_upper, paths['a'], paths['b'], calls),
+                           inputs=[paths['a']], outputs=[paths['b']]),
+            pipeline.Stage('y', partial(copy_upper, paths['x'], paths['y'], calls),
+                           inputs=[paths['x']], outputs=[paths['y']])]
+
+
+def test_runs_in_order_then_skips(pipeline, tmp_path):
+    calls = []
+    state = str(tmp_path / 'state.json')
+    stages = toy_stages(pipeline, tmp_path, calls)
+    assert pipeline.run(stages, path=state) == {'b': 'ran', 'c': 'ran', 'y': 'ran'}
+    assert calls.index('b.txt') < calls.index('c.txt')
+    assert (tmp_path / 'c.txt').read_text() == 'A'
+
+    calls.clear()
+    assert set(pipeline.run(stages, path=state).values()) == {'skipped'}
+    assert calls == []
+
+    # a changed input reruns its stage and everything downstream of it
+    (tmp_path / 'a.txt').write_text('aa')
+    assert pipeline.run(stages, path=state) == {'b': 'ran', 'c': 'ran', 'y': 'skipped'}
+    assert (tmp_path / 'c.txt').read_text() == 'AA'
+
+    # so does a changed or missing output
+    os.remove(str(tmp_path / 'c.txt'))
+    assert pipeline.run(stages, path=state)['c'] == 'ran'
+    assert pipeline.run(stages, force={'y'}, path=state)['y'] == 'ran'
+
+
+def test_changed_params_rerun(pipeline, tmp_path):
+    calls = []
+    state = str(tmp_path / 'state.json')
+    pipeline.run(toy_stages(pipeline, tmp_path, calls), path=state)
+    stages = toy_stages(pipeline, tmp_path, calls)
+    stages[2].params = {'setting': 1}
+    assert pipeline.run(stages, path=state)['y'] == 'ran'
+
+
+def test_failure_blocks_downstream(pipeline, tmp_path):
+    calls = []
+    stages = toy_stages(pipeline, tmp_path, calls)
+    stages[1].func = partial(fail, calls)
+    status = pipeline.run(stages, path=str(tmp_path / 'state.json'))
+    assert status == {'b': 'failed', 'c': 'blocked', 'y': 'ran'}
+    assert 'c.txt' not in calls
+
+    # a stage that doesn't write its outputs fails too
+    stages = toy_stages(pipeline, tmp_path, calls)
+    stages[1].outputs.append(str(tmp_path / 'never.txt'))
+    status = pipeline.run(stages, path=str(tmp_path / 'state.json'))
+    assert status['b'] == 'failed' and status['c'] == 'blocked'
+
+
+def test_resource_limits(pipeline, tmp_path, monkeypatch):
+    monkeypatch.setitem(pipeline.resource_limits, 'toy', 2)
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+
+    def work(path):
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        time.sleep(0.05)
+        with lock:
+            running['now'] -= 1
+        with open(path, 'w') as f:
+            f.write('done')
+
+    stages = [pipeline.Stage('s{}'.format(i), partial(work, str(tmp_path / '{}.txt'.format(i))),
+                             outputs=[str(tmp_path / '{}.txt'.format(i))], resource='toy')
+              for i in range(6)]
+    status = pipeline.run(stages, workers=6, path=str(tmp_path / 'state.json'))
+    assert set(status.values()) == {'ran'}
+    assert running['max'] == 2
+
+
+def test_cycles_and_unknown_stages(pipeline, tmp_path):
+    a, b = str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')
+    stages = [pipeline.Stage('ab', print, inputs=[a], outputs=[b]),
+              pipeline.Stage('ba', print, inputs=[b], outputs=[a])]
+    with pytest.raises(ValueError, match='cycle'):
+        pipeline.run(stages, path=str(tmp_path / 'state.json'))
+    with pytest.raises(ValueError, match='unknown'):
+        pipeline.dependencies([pipeline.Stage('a', print, after=['z'])])
+    with pytest.raises(ValueError, match='unique'):
+        pipeline.dependencies([pipeline.Stage('a', print), pipeline.Stage('a', print)])
+
+
+def test_code_hash_covers_called_modules(pipeline, tmp_path):
+    names = lambda func: {os.path.basename(path) for path in pipeline.code_files(func)}
+    journeys = names(partial(pipeline.journeys, 'od.csv', 'am', 'out.jsonl'))
+    assert {'gen_student_journeys.py', 'convert_times.py', 'postprocess_journeys.py'} <= journeys
+    assert 'pipeline.py' not in journeys
+    attributes = names(pipeline.postprocess_journeys.process_journey_file)
+    assert 'postprocess_journeys.py' in attributes
+    assert 'gen_student_journeys.py' not in attributes
+    assert names(print) == set()
+
+    # editing a module a stage calls changes its key
+    state = pipeline.load_state(str(tmp_path / 'state.json'))
+    func = partial(pipeline.journeys, 'od.csv', 'am', 'out.jsonl')
+    before = pipeline.code_hash(func, state)
+    path = os.path.abspath(pipeline.gen_student_journeys.__file__)
+    size, mtime, digest = state['files'][path]
+    state['files'][path] = [size, mtime, 'edited']
+    assert pipeline.code_hash(func, state) != before
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import postprocess_journeys
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+def unique_records(n):
+    return ({'origin': 'home {}'.format(i),
+             'dest': 'school',
+             'origin_lat': 39.7 + i / 1e6,
+             'total_minutes': float(i % 90),
+             'num_transfers': i % 3,
+             'notes': ''} for i in range(n))
+
+
+def test_cleared_table_starts_new_dictionaries():
+    tables = postprocess_journeys.records_to_tables(unique_records(25), size=10)
+    sizes = []
+    for table in tables:
+        sizes.append((len(table), len(table.values['origin']), len(table.values['dest'])))
+    assert sizes == [(10, 10, 1), (10, 10, 1), (5, 5, 1)]
+
+
+def test_kept_frames_are_unchanged():
+    frames = [table.to_pandas() for table in
+              postprocess_journeys.records_to_tables(unique_records(25), size=10)]
+    assert [frame['origin'].iloc[0] for frame in frames] == ['home 0', 'home 10', 'home 20']
+    assert frames[0]['num_transfers'].tolist() == [i % 3 for i in range(10)]
+
+
+def test_parquet_batches_stay_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(postprocess_journeys, 'chunk_size', 1000)
+    sizes = {}
+    for n in (4000, 16000):
+        path = str(tmp_path / '{}.parquet'.format(n))
+        assert postprocess_journeys.write_records(unique_records(n), path) == n
+        sizes[n] = os.path.getsize(path)
+        metadata = pq.ParquetFile(path).metadata
+        origin = metadata.schema.to_arrow_schema().get_field_index('origin')
+        chunks = [metadata.row_group(i).column(origin).total_compressed_size
+                  for i in range(metadata.num_row_groups)]
+        # every row group only holds its own 1000 distinct origins
+        assert max(chunks) < 2 * min(chunks)
+    # size grows with the rows, not with the square of them
+    assert sizes[16000] < 5 * sizes[4000]
+
+    table = pq.read_table(str(tmp_path / '16000.parquet'))
+    assert table['origin'].to_pylist()[-1] == 'home 15999'
+    assert table['num_transfers'].to_pylist()[:4] == [0, 1, 2, 0]
+
+
+def test_batch_postprocess_rejects_clashing_schools(tmp_path):
+    for subdir in ('hs', 'ms'):
+        os.makedirs(str(tmp_path / 'temp' / subdir))
+        with open(str(tmp_path / 'temp' / subdir / '123_school_am_journeys.jsonl'), 'w') as f:
+            f.write('')
+    with pytest.raises(ValueError, match='123_school_am_journey_attributes.csv'):
+        postprocess_journeys.batch_postprocess(str(tmp_path / 'temp'), str(tmp_path / 'out'))
+    assert not os.path.exists(str(tmp_path / 'out'))
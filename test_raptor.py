@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import postprocess_journeys
+import raptor
+
+# A tiny two-route feed (test_data/gtfs):
+#   route A runs A1 -> A2 -> A3 in the morning and back in the afternoon,
+#   route B runs B1 -> B2 in the morning and back in the afternoon,
+#   B1 is about 55 m from A3, so riders can transfer between them.
+gtfs_path = os.path.join(os.path.dirname(__file__), 'test_data', 'gtfs')
+
+stops = {'A1': (39.70, -86.20), 'B2': (39.70, -86.05)}
+
+
+@pytest.fixture(scope='module')
+def tt():
+    return raptor.load_gtfs(gtfs_path)
+
+
+def od_rows(homes):
+    """
+    od_df rows for homes going to a school at stop B2, with a 7:40 AM
+    arrival bell and a 3:30 PM departure bell.
+    """
+    return pd.DataFrame({'home_address': ['home {}'.format(i) for i in range(len(homes))],
+                         'home_lat': [lat for lat, lon in homes],
+                         'home_lon': [lon for lat, lon in homes],
+                         'school_address': 'school',
+                         'school_lat': stops['B2'][0],
+                         'school_lon': stops['B2'][1],
+                         'am_latest_arr': '7:40 AM',
+                         'pm_earliest_dep': '3:30 PM'})
+
+
+def test_load_gtfs(tt):
+    assert list(tt.stop_names) == ['Stop A1', 'Stop A2', 'Stop A3', 'Stop B1', 'Stop B2']
+    # the Saturday trip is not running on the (Wednesday) service day
+    assert sum(len(deps) for deps in tt.departures) == 7
+    # the A2 time missing from the first trip is interpolated
+    morning = [deps for seq, deps in zip(tt.pattern_stops, tt.departures)
+               if list(seq) == [0, 1, 2]]
+    assert len(morning) == 1
+    assert morning[0][:, 1].tolist() == [7 * 3600 + 10 * 60, 8 * 3600 + 10 * 60]
+
+
+def test_am_journey_with_transfer(tt):
+    record = raptor.route_od(od_rows([stops['A1']]), tt, 'am')[0]
+    assert record['departure_time'] == '7:00am'
+    assert record['arrival_time'] == '7:35am'
+    assert record['total_minutes'] == 35.0
+    assert record['transit_time_minutes'] == 30.0
+    assert record['num_transfers'] == 1
+    assert record['routes_taken'] == 'A, B'
+    assert record['starting_stop'] == 'Stop A1'
+    assert record['end_stop'] == 'Stop B2'
+    # the only walking is the transfer from A3 to B1
+    assert 0.5 < record['walk_time_minutes'] < 1.5
+    assert record['origin'] == 'home 0'
+    assert record['dest'] == 'school'
+
+
+def test_pm_journey_with_transfer(tt):
+    record = raptor.route_od(od_rows([stops['A1']]), tt, 'pm')[0]
+    # the 3:45 A trip leaves before B gets to B1, so the 4:00 one is taken
+    assert record['departure_time'] == '3:40pm'
+    assert record['arrival_time'] == '4:20pm'
+    assert record['num_transfers'] == 1
+    assert record['routes_taken'] == 'B, A'
+    assert record['starting_stop'] == 'Stop B2'
+    assert record['end_stop'] == 'Stop A1'
+    assert record['origin'] == 'school'
+    assert record['dest'] == 'home 0'
+
+
+def test_rounds_limit_transfers(tt, monkeypatch):
+    monkeypatch.setattr(raptor, 'max_rounds', 1)
+    record = raptor.route_od(od_rows([stops['A1']]), tt, 'am')[0]
+    assert record['notes'] == 'ZERO_RESULTS'
+
+
+def test_walk_only_and_unreachable(tt):
+    near = (39.703, -86.05)  # about 330 m from school
+    far = (40.0, -85.5)
+    walk, none = raptor.route_od(od_rows([near, far]), tt, 'am')
+    assert walk['transit_time_minutes'] == 0.0
+    assert walk['num_transfers'] == 0
+    assert walk['departure_time'] is None
+    assert 4 < walk['total_minutes'] < 7
+    assert none['notes'] == 'ZERO_RESULTS'
+    assert none['origin'] == 'home 1'
+
+
+def test_records_match_record_fields(tt):
+    homes = [stops['A1'], (39.703, -86.05), (40.0, -85.5)]
+    for ampm in ('am', 'pm'):
+        records = raptor.route_od(od_rows(homes), tt, ampm)
+        for record in records:
+            assert set(record) <= set(postprocess_journeys.RECORD_FIELDS)
+        # transit journeys fill in everything except the clustering field
+        assert set(records[0]) == set(postprocess_journeys.RECORD_FIELDS) - {'snap_error_miles'}
+        df = next(postprocess_journeys.records_to_tables(records)).to_pandas()
+        assert list(df.columns) == list(postprocess_journeys.RECORD_FIELDS)
+        assert df['num_transfers'].tolist()[:2] == [1, 0]
+
+
+def test_travel_time_matrix(tt):
+    schools = od_rows([stops['A1']])[['school_lat', 'school_lon',
+                                      'am_latest_arr', 'pm_earliest_dep']]
+    homes = np.array([stops['A1'], (40.0, -85.5)])
+    am = raptor.travel_time_matrix(tt, homes[:, 0], homes[:, 1], schools, 'am')
+    pm = raptor.travel_time_matrix(tt, homes[:, 0], homes[:, 1], schools, 'pm')
+    # leave at 7:00 for a 7:40 bell; leave at the 3:30 bell, home at 4:20
+    assert am[0, 0] == pytest.approx(40)
+    assert pm[0, 0] == pytest.approx(50)
+    assert np.isnan(am[1, 0]) and np.isnan(pm[1, 0])